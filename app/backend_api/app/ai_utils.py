@@ -1,14 +1,25 @@
-import asyncio
 import json
 import logging
+import os
 import re
-from typing import List
+from typing import AsyncIterator, List, Optional, Tuple
 
 import httpx
 import openai
 
 from . import schemas
-from .openrouter_client import get_openrouter_client
+from .singleflight import coalesce
+from .openrouter_client import (
+    UpstreamBusyError,
+    UpstreamTimeoutError,
+    create_chat_completion,
+    get_openrouter_client,
+    stream_chat_completion,
+)
+
+
+# Galat dari OpenRouter (atau batas waktunya) yang diteruskan sebagai NetworkError.
+UPSTREAM_ERRORS = (openai.OpenAIError, httpx.HTTPError, UpstreamTimeoutError)
 
 
 # === Custom Error Classes ===
@@ -61,7 +72,13 @@ def extract_json_from_markdown(text: str) -> str:
 
 # === OpenRouter Functionalities ===
 
+# Versi template prompt; naikkan saat prompt berubah agar cache respons lama
+# tidak dipakai lagi (lihat app/cache.py).
+CAPTION_PROMPT_VERSION = "1"
+ARTICLES_PROMPT_VERSION = "1"
+
 
+@coalesce
 async def caption_image_with_openrouter(image_url: str) -> str:
     """
     Generates a caption for an image using the OpenRouter API.
@@ -74,6 +91,7 @@ async def caption_image_with_openrouter(image_url: str) -> str:
 
     Raises:
         MissingAPIKeyError: If API key is not set.
+        UpstreamBusyError: If no upstream slot frees up in time.
         RuntimeError: If OpenRouter API fails to return valid result.
     """
     try:
@@ -82,7 +100,6 @@ async def caption_image_with_openrouter(image_url: str) -> str:
         raise MissingAPIKeyError(str(e)) from e
 
     payload = {
-        "model": "deepseek/deepseek-chat-v3-0324:free",
         "messages": [
             {
                 "role": "user",
@@ -95,15 +112,18 @@ async def caption_image_with_openrouter(image_url: str) -> str:
     }
 
     try:
-        data = await asyncio.to_thread(client.chat.completions.create, **payload)
+        data = await create_chat_completion(client, operation="caption", **payload)
         return data.choices[0].message.content
-    except (openai.OpenAIError, httpx.HTTPError) as e:
+    except UpstreamBusyError:
+        raise
+    except UPSTREAM_ERRORS as e:
         raise NetworkError(str(e)) from e
     except Exception as e:
         raise RuntimeError(f"Error from OpenRouter API: {e}") from e
 
 
-def generate_articles_with_openrouter(text: str) -> List[schemas.ArticleResponse]:
+@coalesce
+async def generate_articles_with_openrouter(text: str) -> List[schemas.ArticleResponse]:
     """
     Requests the OpenRouter API to generate three article titles and summaries in JSON format.
 
@@ -115,6 +135,7 @@ def generate_articles_with_openrouter(text: str) -> List[schemas.ArticleResponse
 
     Raises:
         MissingAPIKeyError: If API key is missing.
+        UpstreamBusyError: If no upstream slot frees up in time.
         InvalidResponseError: If response is malformed or not JSON.
     """
     try:
@@ -123,7 +144,6 @@ def generate_articles_with_openrouter(text: str) -> List[schemas.ArticleResponse
         raise MissingAPIKeyError(str(e)) from e
 
     payload = {
-        "model": "deepseek/deepseek-chat-v3-0324:free",
         "messages": [
             {
                 "role": "user",
@@ -137,7 +157,7 @@ def generate_articles_with_openrouter(text: str) -> List[schemas.ArticleResponse
     }
 
     try:
-        data = client.chat.completions.create(**payload)
+        data = await create_chat_completion(client, operation="articles", **payload)
         text_resp = data.choices[0].message.content
 
         try:
@@ -151,21 +171,162 @@ def generate_articles_with_openrouter(text: str) -> List[schemas.ArticleResponse
 
         return [schemas.ArticleResponse(**a) for a in articles]
 
-    except (openai.OpenAIError, httpx.HTTPError) as e:
+    except UpstreamBusyError:
+        raise
+    except UPSTREAM_ERRORS as e:
+        raise NetworkError(str(e)) from e
+    except Exception as e:
+        raise InvalidResponseError(f"Malformed response from OpenRouter: {e}") from e
+
+
+# Mode pipeline /chat/: "two_step" (analisis lalu balasan, dua panggilan) atau
+# "single" (analisis dan balasan dalam satu panggilan dengan output terstruktur,
+# kembali ke two_step bila output tidak valid).
+CHAT_PIPELINE = os.getenv("OPENROUTER_CHAT_PIPELINE", "two_step").lower()
+
+CHAT_TURN_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "chat_turn",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "issue": {"type": "string"},
+                "technique": {"type": "string"},
+                "tone": {"type": "string"},
+                "reply": {"type": "string"},
+            },
+            "required": ["issue", "technique", "tone", "reply"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+
+def _chat_user_text(text: str, history: str | None, mood: str | None) -> str:
+    user_text = text
+    if history:
+        user_text += f"\nRiwayat: {history}"
+    if mood:
+        user_text += f"\nMood: {mood}"
+    return user_text
+
+
+async def _analyze_chat_message(
+    client, text: str, history: str | None, mood: str | None
+) -> Tuple[str, str, str]:
+    """Run the first chat completion and return ``(issue, technique, tone)``."""
+    base_prompt = (
+        "Identifikasi masalah utama pengguna dan sarankan teknik coping dalam"
+        " format JSON seperti {'issue': '', 'technique': '', 'tone': ''}. "
+        "Balas hanya dengan JSON."
+    )
+
+    payload_first = {
+        "messages": [
+            {
+                "role": "user",
+                "content": base_prompt + "\n" + _chat_user_text(text, history, mood),
+            }
+        ],
+    }
+
+    raw = None
+    try:
+        first = await create_chat_completion(client, operation="chat_analysis", **payload_first)
+        raw = first.choices[0].message.content
+        json_str = extract_json_from_markdown(raw)
+        info = json.loads(json_str)
+        issue = info.get("issue")
+        technique = info.get("technique")
+        tone = info.get("tone")
+        if not all(isinstance(v, str) for v in (issue, technique, tone)):
+            raise InvalidResponseError("Missing keys in OpenRouter response")
+    except (InvalidResponseError, UpstreamBusyError):
+        raise
+    except UPSTREAM_ERRORS as e:
         raise NetworkError(str(e)) from e
     except Exception as e:
+        logging.error("[OpenRouter JSON Parsing Error] Raw response: %s", raw)
         raise InvalidResponseError(f"Malformed response from OpenRouter: {e}") from e
+    return issue, technique, tone
+
+
+def _chat_reply_payload(issue: str, technique: str, tone: str) -> dict:
+    """Build the second-step request that phrases the reply to the user."""
+    second_prompt = (
+        f"Dengan nada {tone}, buat pertanyaan singkat mengenai {issue} "
+        f"dan anjurkan {technique}."
+    )
+    return {
+        "messages": [{"role": "user", "content": second_prompt}],
+    }
+
+
+async def _single_call_chat(
+    client, text: str, history: str | None, mood: str | None
+) -> Optional[str]:
+    """Ask for analysis and reply in one structured completion.
+
+    Returns:
+        The validated reply, or ``None`` when the model rejected the
+        structured-output request or its output failed validation, in which
+        case the caller falls back to the two-step flow.
+    """
+    prompt = (
+        "Identifikasi masalah utama pengguna, sarankan teknik coping, tentukan "
+        "nada yang sesuai, lalu tulis balasan berupa pertanyaan singkat dengan "
+        "nada tersebut mengenai masalah itu yang menganjurkan teknik tersebut. "
+        "Balas hanya dengan JSON berisi 'issue', 'technique', 'tone' dan 'reply'."
+    )
+    payload = {
+        "messages": [
+            {"role": "user", "content": prompt + "\n" + _chat_user_text(text, history, mood)}
+        ],
+        "response_format": CHAT_TURN_RESPONSE_FORMAT,
+    }
+
+    raw = None
+    try:
+        data = await create_chat_completion(client, operation="chat_single", **payload)
+        raw = data.choices[0].message.content
+        turn = schemas.ChatTurn.model_validate_json(extract_json_from_markdown(raw))
+    except UpstreamBusyError:
+        raise
+    except openai.BadRequestError as e:
+        logging.warning("[OpenRouter] Structured output ditolak model: %s", e)
+        return None
+    except UPSTREAM_ERRORS as e:
+        raise NetworkError(str(e)) from e
+    except Exception as e:
+        logging.warning("[OpenRouter] Output terstruktur tidak valid (%s): %s", e, raw)
+        return None
+    return turn.reply
+
 
+def _record_pipeline(pipeline: str) -> str:
+    """Log which chat pipeline answered the turn and return its name."""
+    logging.info("[OpenRouter] /chat/ dijawab lewat pipeline %s", pipeline)
+    return pipeline
 
-def chat_with_openrouter(text: str, history: str | None = None, mood: str | None = None) -> str:
+
+@coalesce
+async def chat_with_openrouter(
+    text: str, history: str | None = None, mood: str | None = None
+) -> schemas.ChatReply:
     """Interact with OpenRouter to craft a follow-up question for the user.
 
-    The helper performs two requests:
+    In the default ``two_step`` pipeline the helper performs two requests:
     1. Ask OpenRouter to analyze the user's message (optionally considering
        ``history`` and ``mood``) and respond with a JSON payload containing
        ``issue``, ``technique`` and ``tone``.
     2. Use those values to request a final textual reply.
 
+    With ``OPENROUTER_CHAT_PIPELINE=single`` both are requested in one
+    structured-output completion; if that output fails validation the
+    two-step flow is used instead.
+
     Parameters
     ----------
     text: str
@@ -177,13 +338,16 @@ def chat_with_openrouter(text: str, history: str | None = None, mood: str | None
 
     Returns
     -------
-    str
-        The final response text from OpenRouter.
+    schemas.ChatReply
+        The final response text and the pipeline that produced it
+        (``single``, ``two_step`` or ``fallback``).
 
     Raises
     ------
     MissingAPIKeyError
         If the API key is not configured.
+    UpstreamBusyError
+        If no upstream slot frees up in time.
     InvalidResponseError
         If OpenRouter returns malformed or unexpected data.
     """
@@ -193,57 +357,122 @@ def chat_with_openrouter(text: str, history: str | None = None, mood: str | None
     except RuntimeError as e:
         raise MissingAPIKeyError(str(e)) from e
 
-    base_prompt = (
-        "Identifikasi masalah utama pengguna dan sarankan teknik coping dalam"
-        " format JSON seperti {'issue': '', 'technique': '', 'tone': ''}. "
-        "Balas hanya dengan JSON."
-    )
+    pipeline = "two_step"
+    if CHAT_PIPELINE == "single":
+        reply = await _single_call_chat(client, text, history, mood)
+        if reply is not None:
+            return schemas.ChatReply(reply=reply, pipeline=_record_pipeline("single"))
+        pipeline = "fallback"
 
-    user_text = text
-    if history:
-        user_text += f"\nRiwayat: {history}"
-    if mood:
-        user_text += f"\nMood: {mood}"
+    issue, technique, tone = await _analyze_chat_message(client, text, history, mood)
 
-    payload_first = {
-        "model": "deepseek/deepseek-chat-v3-0324:free",
-        "messages": [
-            {"role": "user", "content": base_prompt + "\n" + user_text}
-        ],
-    }
+    try:
+        second = await create_chat_completion(
+            client, operation="chat_reply", **_chat_reply_payload(issue, technique, tone)
+        )
+        return schemas.ChatReply(
+            reply=second.choices[0].message.content,
+            pipeline=_record_pipeline(pipeline),
+        )
+    except UpstreamBusyError:
+        raise
+    except UPSTREAM_ERRORS as e:
+        raise NetworkError(str(e)) from e
+    except Exception as e:
+        raise InvalidResponseError(f"Malformed response from OpenRouter: {e}") from e
+
+
+async def stream_chat_with_openrouter(
+    text: str, history: str | None = None, mood: str | None = None
+) -> Tuple[str, AsyncIterator[str]]:
+    """Streaming variant of :func:`chat_with_openrouter`.
+
+    Everything before the reply (and the whole turn in the ``single``
+    pipeline) runs before this coroutine returns. The reply of the two-step
+    flow is requested with ``stream=True`` and its tokens are yielded by the
+    returned iterator as they arrive; errors while opening or reading that
+    stream are raised from the iteration.
+
+    Returns:
+        ``(pipeline, tokens)`` where ``pipeline`` is as in
+        :func:`chat_with_openrouter`.
 
+    Raises:
+        MissingAPIKeyError, UpstreamBusyError, NetworkError,
+        InvalidResponseError: Same conditions as :func:`chat_with_openrouter`.
+    """
     try:
-        first = client.chat.completions.create(**payload_first)
-        raw = first.choices[0].message.content
-        json_str = extract_json_from_markdown(raw)
-        info = json.loads(json_str)
-        issue = info.get("issue")
-        technique = info.get("technique")
-        tone = info.get("tone")
-        if not all(isinstance(v, str) for v in (issue, technique, tone)):
-            raise InvalidResponseError("Missing keys in OpenRouter response")
-    except InvalidResponseError:
+        client = get_openrouter_client()
+    except RuntimeError as e:
+        raise MissingAPIKeyError(str(e)) from e
+
+    pipeline = "two_step"
+    if CHAT_PIPELINE == "single":
+        reply = await _single_call_chat(client, text, history, mood)
+        if reply is not None:
+            return _record_pipeline("single"), _iter_once(reply)
+        pipeline = "fallback"
+
+    issue, technique, tone = await _analyze_chat_message(client, text, history, mood)
+    tokens = _stream_reply(client, _chat_reply_payload(issue, technique, tone))
+    return _record_pipeline(pipeline), tokens
+
+
+async def _iter_once(text: str) -> AsyncIterator[str]:
+    yield text
+
+
+async def _stream_reply(client, payload: dict) -> AsyncIterator[str]:
+    try:
+        async for token in stream_chat_completion(client, operation="chat_reply", **payload):
+            yield token
+    except UpstreamBusyError:
         raise
-    except (openai.OpenAIError, httpx.HTTPError) as e:
+    except UPSTREAM_ERRORS as e:
         raise NetworkError(str(e)) from e
     except Exception as e:
-        logging.error("[OpenRouter JSON Parsing Error] Raw response: %s", raw)
         raise InvalidResponseError(f"Malformed response from OpenRouter: {e}") from e
 
-    second_prompt = (
-        f"Dengan nada {tone}, buat pertanyaan singkat mengenai {issue} "
-        f"dan anjurkan {technique}."
-    )
 
-    payload_second = {
-        "model": "deepseek/deepseek-chat-v3-0324:free",
-        "messages": [{"role": "user", "content": second_prompt}],
+async def summarize_conversation(summary: str | None, transcript: str, max_tokens: int) -> str:
+    """Fold older chat turns into the rolling summary of a conversation.
+
+    Args:
+        summary: The current summary, or ``None`` for the first compaction.
+        transcript: The turns to fold in, one ``Role: text`` line per turn.
+        max_tokens: Upper bound for the length of the new summary.
+
+    Raises:
+        MissingAPIKeyError, UpstreamBusyError, NetworkError,
+        InvalidResponseError: Same conditions as :func:`chat_with_openrouter`.
+    """
+    try:
+        client = get_openrouter_client()
+    except RuntimeError as e:
+        raise MissingAPIKeyError(str(e)) from e
+
+    prompt = (
+        "Ringkas percakapan konseling berikut dalam bahasa Indonesia, paling banyak "
+        f"{max_tokens // 2} kata. Pertahankan masalah utama pengguna, perasaannya, "
+        "teknik yang sudah disarankan dan hal penting lain untuk giliran berikutnya. "
+        "Balas hanya dengan ringkasannya."
+    )
+    if summary:
+        prompt += f"\nRingkasan sebelumnya: {summary}"
+    payload = {
+        "messages": [{"role": "user", "content": prompt + "\nPercakapan:\n" + transcript}],
+        "max_tokens": max_tokens,
     }
 
     try:
-        second = client.chat.completions.create(**payload_second)
-        return second.choices[0].message.content
-    except (openai.OpenAIError, httpx.HTTPError) as e:
+        data = await create_chat_completion(client, operation="chat_summary", **payload)
+        content = data.choices[0].message.content
+    except UpstreamBusyError:
+        raise
+    except UPSTREAM_ERRORS as e:
         raise NetworkError(str(e)) from e
     except Exception as e:
         raise InvalidResponseError(f"Malformed response from OpenRouter: {e}") from e
+    if not isinstance(content, str) or not content.strip():
+        raise InvalidResponseError("Empty summary in OpenRouter response")
+    return content.strip()
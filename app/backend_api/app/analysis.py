@@ -0,0 +1,178 @@
+"""Background AI analysis of new diary entries.
+
+With ``ANALYSIS_ON_CREATE`` enabled, saving an entry also queues it in
+``analysis_jobs`` (same transaction) and the request returns immediately
+with ``analysis_status="pending"``. Workers claim due jobs in batches of
+``ANALYSIS_BATCH_SIZE``, call :func:`app.openrouter.analyze_text` with at
+most ``ANALYSIS_CONCURRENCY`` calls in flight, and store the result on the
+entry. Texts the local classifier (:mod:`app.sentiment`) is confident about
+never reach OpenRouter. Failed calls are retried with exponential backoff up
+to ``ANALYSIS_MAX_ATTEMPTS`` times.
+
+Workers run inside the API process (started by the lifespan when
+``ANALYSIS_IN_PROCESS`` is true) or as a separate process with
+``python -m app.cli analysis-worker``. Because the queue is a database table,
+both modes can run side by side; the claim is atomic, so a job is analyzed
+once. Results also go through the ``/analyze/`` response cache, so an entry
+whose text was analyzed before costs no upstream call.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Dict, Optional
+
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from . import async_crud, cache, metrics, openrouter, sentiment
+from .database import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+
+def _env_flag(name: str, default: str) -> bool:
+    return os.getenv(name, default).lower() in ("1", "true", "yes")
+
+
+ANALYSIS_ON_CREATE = _env_flag("ANALYSIS_ON_CREATE", "false")
+ANALYSIS_IN_PROCESS = _env_flag("ANALYSIS_IN_PROCESS", "true")
+ANALYSIS_CONCURRENCY = int(os.getenv("ANALYSIS_CONCURRENCY", "4"))
+ANALYSIS_BATCH_SIZE = int(os.getenv("ANALYSIS_BATCH_SIZE", "16"))
+ANALYSIS_POLL_INTERVAL = float(os.getenv("ANALYSIS_POLL_INTERVAL", "5"))
+ANALYSIS_MAX_ATTEMPTS = int(os.getenv("ANALYSIS_MAX_ATTEMPTS", "5"))
+ANALYSIS_RETRY_DELAY = float(os.getenv("ANALYSIS_RETRY_DELAY", "30"))
+# Harus lebih lama dari satu panggilan OpenRouter; job yang sewanya habis
+# dianggap ditinggalkan worker yang mati dan diklaim ulang.
+ANALYSIS_LEASE_SECONDS = int(os.getenv("ANALYSIS_LEASE_SECONDS", "300"))
+
+
+def retry_delay(attempts: int) -> float:
+    """Backoff before the next try after ``attempts`` failed tries."""
+    return ANALYSIS_RETRY_DELAY * 2 ** (attempts - 1)
+
+
+async def _analyze(content: str) -> str:
+    prediction = sentiment.classify(content)
+    if prediction.is_confident():
+        metrics.sentiment_predictions.inc("local")
+        return sentiment.describe(prediction)
+    metrics.sentiment_predictions.inc("llm")
+    # Kunci yang sama dengan /analyze/, jadi teks yang sudah pernah dianalisis
+    # tidak memanggil OpenRouter lagi.
+    result, _ = await cache.get_or_compute_ai(
+        "analyze",
+        openrouter.ANALYZE_PROMPT_VERSION,
+        cache.normalize_text(content),
+        lambda: openrouter.analyze_text(content),
+    )
+    return result
+
+
+async def process_batch(session_factory: async_sessionmaker = AsyncSessionLocal) -> int:
+    """Claim one batch of due jobs, analyze the entries and store the results.
+
+    Returns:
+        The number of jobs claimed.
+    """
+    now = int(time.time())
+    async with session_factory() as db:
+        jobs = await async_crud.claim_analysis_jobs(
+            db, ANALYSIS_BATCH_SIZE, now, ANALYSIS_LEASE_SECONDS
+        )
+    if not jobs:
+        return 0
+
+    slots = asyncio.Semaphore(ANALYSIS_CONCURRENCY)
+
+    async def run(job: Dict[str, Any]):
+        async with slots:
+            try:
+                return await _analyze(job["content"]), None
+            except Exception as e:
+                return None, e
+
+    outcomes = await asyncio.gather(*(run(job) for job in jobs))
+
+    done, failed = [], []
+    finished_at = time.time()
+    for job, (result, error) in zip(jobs, outcomes):
+        if error is None:
+            done.append((job["job_id"], job["entry_id"], result))
+            continue
+        retry_at: Optional[int] = None
+        if job["attempts"] < ANALYSIS_MAX_ATTEMPTS:
+            retry_at = int(finished_at + retry_delay(job["attempts"]))
+        logger.warning(
+            "Analisis entri %s gagal (percobaan %s): %s", job["entry_id"], job["attempts"], error
+        )
+        failed.append((job["job_id"], job["entry_id"], f"{type(error).__name__}: {error}", retry_at))
+    async with session_factory() as db:
+        await async_crud.finish_analysis_jobs(db, done, failed)
+    return len(jobs)
+
+
+class AnalysisWorker:
+    """Polls the queue until stopped; :meth:`notify` wakes it up early."""
+
+    def __init__(self, session_factory: async_sessionmaker = AsyncSessionLocal) -> None:
+        self.session_factory = session_factory
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+
+    def notify(self) -> None:
+        self._wakeup.set()
+
+    def stop(self) -> None:
+        self._stopping = True
+        self._wakeup.set()
+
+    async def run(self) -> None:
+        while not self._stopping:
+            self._wakeup.clear()
+            try:
+                claimed = await process_batch(self.session_factory)
+            except Exception:
+                logger.exception("Worker analisis gagal memproses antrean")
+                claimed = 0
+            # Batch penuh: kemungkinan masih ada job lain, langsung lanjut.
+            if claimed >= ANALYSIS_BATCH_SIZE:
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), ANALYSIS_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+
+_worker: Optional[AnalysisWorker] = None
+_task: Optional[asyncio.Task] = None
+
+
+def start_worker() -> None:
+    """Start the in-process worker (lifespan startup) when configured."""
+    global _worker, _task
+    if not (ANALYSIS_ON_CREATE and ANALYSIS_IN_PROCESS) or _task is not None:
+        return
+    _worker = AnalysisWorker()
+    _task = asyncio.get_running_loop().create_task(_worker.run())
+
+
+async def stop_worker(timeout: float = 10) -> None:
+    """Stop the in-process worker, giving the current batch ``timeout`` seconds.
+
+    A batch cut short stays leased and is picked up again once the lease
+    expires.
+    """
+    global _worker, _task
+    worker, task, _worker, _task = _worker, _task, None, None
+    if worker is not None and task is not None:
+        worker.stop()
+        try:
+            await asyncio.wait_for(task, timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Worker analisis dihentikan di tengah batch")
+
+
+def notify() -> None:
+    """Tell the in-process worker that new jobs were queued."""
+    if _worker is not None:
+        _worker.notify()
@@ -0,0 +1,168 @@
+"""Async counterparts of :mod:`app.crud` for ``AsyncSession``.
+
+Each helper runs the synchronous implementation through
+``AsyncSession.run_sync`` so the query logic lives in one place while the
+I/O goes through the async driver instead of blocking the event loop.
+"""
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import crud, models, passwords, schemas
+
+
+async def create_diary_entry(
+    db: AsyncSession,
+    entry: schemas.DiaryEntryCreate,
+    user_id: Optional[int] = None,
+    analyze: bool = False,
+) -> models.DiaryEntry:
+    return await db.run_sync(crud.create_diary_entry, entry, user_id, analyze)
+
+
+async def create_diary_entries(
+    db: AsyncSession,
+    entries: Sequence[schemas.DiaryEntryCreate],
+    user_id: Optional[int] = None,
+    analyze: bool = False,
+) -> List[models.DiaryEntry]:
+    return await db.run_sync(crud.create_diary_entries, entries, user_id, analyze)
+
+
+async def get_diary_entries(
+    db: AsyncSession,
+    skip: int = 0,
+    limit: int = 100,
+    cursor: Optional[Tuple[int, int]] = None,
+    activity: Optional[str] = None,
+    user_id: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    return await db.run_sync(
+        crud.get_diary_entries, skip, limit, cursor, activity, user_id
+    )
+
+
+async def iter_diary_entry_batches(
+    db: AsyncSession, batch_size: int = 500, user_id: Optional[int] = None
+) -> AsyncIterator[List[Dict[str, Any]]]:
+    """Async version of :func:`app.crud.iter_diary_entry_batches`."""
+    stmt = crud.select_diary_entry_rows(user_id).execution_options(yield_per=batch_size)
+    result = await db.stream(stmt)
+    async for batch in result.mappings().partitions():
+        yield await db.run_sync(crud.with_activities, batch)
+
+
+async def get_diary_entry(
+    db: AsyncSession, entry_id: int, user_id: Optional[int] = None
+) -> Optional[Dict[str, Any]]:
+    return await db.run_sync(crud.get_diary_entry, entry_id, user_id)
+
+
+async def search_diary_entries(
+    db: AsyncSession,
+    q: str,
+    limit: int = 20,
+    cursor: Optional[Tuple[float, int]] = None,
+    user_id: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    return await db.run_sync(crud.search_diary_entries, q, limit, cursor, user_id)
+
+
+async def get_mood_stats(db: AsyncSession, user_id: Optional[int] = None) -> Dict[str, int]:
+    return await db.run_sync(crud.get_mood_stats, user_id)
+
+
+async def get_activity_mood_stats(
+    db: AsyncSession, activity: Optional[str] = None, user_id: Optional[int] = None
+) -> Dict[str, Dict[str, int]]:
+    return await db.run_sync(crud.get_activity_mood_stats, activity, user_id)
+
+
+async def get_mood_timeseries(
+    db: AsyncSession, bucket: str, start: int, end: int, user_id: Optional[int] = None
+) -> Dict[int, Dict[str, int]]:
+    return await db.run_sync(crud.get_mood_timeseries, bucket, start, end, user_id)
+
+
+async def revoke_token(db: AsyncSession, jti: str, expires_at: int, now: int) -> None:
+    await db.run_sync(crud.revoke_token, jti, expires_at, now)
+
+
+async def get_revoked_tokens(db: AsyncSession, now: int) -> Dict[str, int]:
+    return await db.run_sync(crud.get_revoked_tokens, now)
+
+
+async def get_user_by_email(db: AsyncSession, email: str) -> Optional[models.User]:
+    return await db.run_sync(crud.get_user_by_email, email)
+
+
+async def create_user(db: AsyncSession, user: schemas.UserCreate) -> models.User:
+    hashed_password = await passwords.hash_password(user.password)
+    return await db.run_sync(crud.create_user, user, hashed_password)
+
+
+async def authenticate_user(
+    db: AsyncSession, email: str, password: str
+) -> Optional[models.User]:
+    """Return the user when the credentials are valid, else ``None``.
+
+    bcrypt runs in the password pool, also for unknown emails, and a hash
+    with an outdated cost factor is replaced transparently.
+    """
+    user = await get_user_by_email(db, email)
+    valid, new_hash = await passwords.verify_password(
+        password, user.hashed_password if user else None
+    )
+    if not valid:
+        return None
+    if new_hash:
+        await db.run_sync(crud.update_password_hash, user, new_hash)
+    return user
+
+
+async def claim_analysis_jobs(
+    db: AsyncSession, limit: int, now: int, lease_seconds: int
+) -> List[Dict[str, Any]]:
+    return await db.run_sync(crud.claim_analysis_jobs, limit, now, lease_seconds)
+
+
+async def finish_analysis_jobs(
+    db: AsyncSession,
+    done: Sequence[Tuple[int, int, str]],
+    failed: Sequence[Tuple[int, int, str, Optional[int]]] = (),
+) -> None:
+    await db.run_sync(crud.finish_analysis_jobs, done, failed)
+
+
+async def create_conversation(db: AsyncSession, user_id: Optional[int], now: int) -> Dict[str, Any]:
+    return await db.run_sync(crud.create_conversation, user_id, now)
+
+
+async def get_conversation(
+    db: AsyncSession, conversation_id: str, user_id: Optional[int] = None
+) -> Optional[Dict[str, Any]]:
+    return await db.run_sync(crud.get_conversation, conversation_id, user_id)
+
+
+async def get_conversation_messages(
+    db: AsyncSession, conversation_id: str, after_id: int = 0
+) -> List[Dict[str, Any]]:
+    return await db.run_sync(crud.get_conversation_messages, conversation_id, after_id)
+
+
+async def add_conversation_messages(
+    db: AsyncSession, conversation_id: str, messages: Sequence[Tuple[str, str, int]], now: int
+) -> None:
+    await db.run_sync(crud.add_conversation_messages, conversation_id, messages, now)
+
+
+async def update_conversation_summary(
+    db: AsyncSession, conversation_id: str, summary: str, summarized_until: int, now: int
+) -> None:
+    await db.run_sync(crud.update_conversation_summary, conversation_id, summary, summarized_until, now)
+
+
+async def delete_conversation(
+    db: AsyncSession, conversation_id: str, user_id: Optional[int] = None
+) -> bool:
+    return await db.run_sync(crud.delete_conversation, conversation_id, user_id)
@@ -0,0 +1,196 @@
+"""Signed access tokens (JWT, HS256) and the FastAPI dependencies using them.
+
+Tokens carry the user ID, so a request is authenticated without reading the
+``users`` table: the signature is checked once and the claims are kept in a
+small LRU keyed by the token. Revoked tokens (``/logout/``) are stored in
+``revoked_tokens``; each worker copies that table into memory at most every
+``AUTH_REVOCATION_SYNC_INTERVAL`` seconds, so revocation reaches the other
+workers within that interval without a query per request.
+"""
+import logging
+import os
+import secrets
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+import jwt
+from fastapi import Depends, HTTPException
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import async_crud
+from .database import get_async_db
+
+logger = logging.getLogger(__name__)
+
+JWT_ALGORITHM = "HS256"
+JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY")
+if not JWT_SECRET_KEY:
+    logger.warning(
+        "JWT_SECRET_KEY belum diatur; memakai kunci acak sehingga token hanya "
+        "berlaku di proses ini sampai restart"
+    )
+    JWT_SECRET_KEY = secrets.token_urlsafe(32)
+ACCESS_TOKEN_TTL = int(os.getenv("ACCESS_TOKEN_TTL", str(7 * 24 * 3600)))
+AUTH_TOKEN_CACHE_SIZE = int(os.getenv("AUTH_TOKEN_CACHE_SIZE", "4096"))
+AUTH_REVOCATION_SYNC_INTERVAL = float(os.getenv("AUTH_REVOCATION_SYNC_INTERVAL", "30"))
+# Jika true, rute entri menolak permintaan tanpa token (401). Default false
+# agar klien lama tanpa login tetap bisa memakai data tanpa pemilik.
+AUTH_REQUIRED = os.getenv("AUTH_REQUIRED", "false").lower() in ("1", "true", "yes")
+
+
+@dataclass(frozen=True)
+class CurrentUser:
+    """Identity taken from a verified access token."""
+
+    id: int
+    jti: str
+    expires_at: int
+
+
+class TokenCache:
+    """Thread-safe LRU of verified tokens."""
+
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self._data: "OrderedDict[str, CurrentUser]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token: str) -> Optional[CurrentUser]:
+        with self._lock:
+            user = self._data.get(token)
+            if user is not None:
+                self._data.move_to_end(token)
+            return user
+
+    def set(self, token: str, user: CurrentUser) -> None:
+        with self._lock:
+            self._data[token] = user
+            self._data.move_to_end(token)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def discard(self, token: str) -> None:
+        with self._lock:
+            self._data.pop(token, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+class RevocationList:
+    """In-memory copy of ``revoked_tokens``, refreshed periodically."""
+
+    def __init__(self, sync_interval: float) -> None:
+        self.sync_interval = sync_interval
+        self._revoked: Dict[str, int] = {}
+        self._synced_at = float("-inf")
+
+    def is_revoked(self, jti: str) -> bool:
+        return jti in self._revoked
+
+    def add(self, jti: str, expires_at: int) -> None:
+        self._revoked[jti] = expires_at
+
+    async def maybe_sync(self, db: AsyncSession) -> None:
+        """Reload the list from the database once the interval has passed."""
+        now = time.monotonic()
+        if now - self._synced_at < self.sync_interval:
+            return
+        self._synced_at = now
+        self._revoked = await async_crud.get_revoked_tokens(db, int(time.time()))
+
+    def clear(self) -> None:
+        self._revoked = {}
+        self._synced_at = float("-inf")
+
+
+token_cache = TokenCache(AUTH_TOKEN_CACHE_SIZE)
+revocations = RevocationList(AUTH_REVOCATION_SYNC_INTERVAL)
+bearer_scheme = HTTPBearer(auto_error=False)
+
+
+def create_access_token(user_id: int) -> Tuple[str, int]:
+    """Issue a signed access token for ``user_id``.
+
+    Returns:
+        ``(token, expires_at)`` with the expiry in epoch seconds.
+    """
+    now = int(time.time())
+    expires_at = now + ACCESS_TOKEN_TTL
+    claims = {"sub": str(user_id), "jti": uuid.uuid4().hex, "iat": now, "exp": expires_at}
+    return jwt.encode(claims, JWT_SECRET_KEY, algorithm=JWT_ALGORITHM), expires_at
+
+
+def verify_access_token(token: str) -> CurrentUser:
+    """Return the identity in ``token`` without touching the database.
+
+    Raises:
+        HTTPException: 401 if the token is invalid, expired or revoked.
+    """
+    user = token_cache.get(token)
+    if user is None:
+        try:
+            claims = jwt.decode(
+                token,
+                JWT_SECRET_KEY,
+                algorithms=[JWT_ALGORITHM],
+                options={"require": ["sub", "jti", "exp"]},
+            )
+            user = CurrentUser(
+                id=int(claims["sub"]), jti=claims["jti"], expires_at=int(claims["exp"])
+            )
+        except (jwt.InvalidTokenError, ValueError) as e:
+            raise _unauthorized("Token tidak valid") from e
+        token_cache.set(token, user)
+    elif user.expires_at <= time.time():
+        token_cache.discard(token)
+        raise _unauthorized("Token sudah kedaluwarsa")
+    if revocations.is_revoked(user.jti):
+        raise _unauthorized("Token sudah dicabut")
+    return user
+
+
+def _unauthorized(detail: str) -> HTTPException:
+    return HTTPException(
+        status_code=401, detail=detail, headers={"WWW-Authenticate": "Bearer"}
+    )
+
+
+async def get_optional_user(
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(bearer_scheme),
+    db: AsyncSession = Depends(get_async_db),
+) -> Optional[CurrentUser]:
+    """Identity of the request, or ``None`` when no bearer token was sent."""
+    if credentials is None:
+        return None
+    await revocations.maybe_sync(db)
+    return verify_access_token(credentials.credentials)
+
+
+async def get_current_user(
+    user: Optional[CurrentUser] = Depends(get_optional_user),
+) -> CurrentUser:
+    """Identity of the request; 401 when no bearer token was sent."""
+    if user is None:
+        raise _unauthorized("Token diperlukan")
+    return user
+
+
+async def get_owner_id(
+    user: Optional[CurrentUser] = Depends(get_optional_user),
+) -> Optional[int]:
+    """User ID that scopes entry data; ``None`` for requests without a token.
+
+    With ``AUTH_REQUIRED`` enabled, requests without a token get 401 instead.
+    """
+    if user is None:
+        if AUTH_REQUIRED:
+            raise _unauthorized("Token diperlukan")
+        return None
+    return user.id
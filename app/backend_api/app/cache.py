@@ -0,0 +1,261 @@
+"""Response cache for the AI endpoints.
+
+Results are stored as JSON strings under a key derived from the namespace
+(endpoint), the model, the prompt template version and the normalized
+input. Two backends are available:
+
+* ``memory``: in-process LRU with TTL, bounded by entry count and bytes.
+* ``sqlite``: a file shared by every worker on the host (FIFO + TTL).
+
+The backend is chosen with ``AI_CACHE_BACKEND`` (``memory``, ``sqlite`` or
+``none``).
+
+Lookups use the configured model, but :func:`get_or_compute_ai` stores a
+result under the model that actually answered, so an answer from a fallback
+model is never served later as the primary model's.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, defaultdict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from . import metrics, openrouter_client
+
+logger = logging.getLogger(__name__)
+
+AI_CACHE_BACKEND = os.getenv("AI_CACHE_BACKEND", "memory").lower()
+AI_CACHE_TTL = float(os.getenv("AI_CACHE_TTL", "3600"))
+AI_CACHE_MAX_ENTRIES = int(os.getenv("AI_CACHE_MAX_ENTRIES", "1024"))
+AI_CACHE_MAX_BYTES = int(os.getenv("AI_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+AI_CACHE_PATH = os.getenv("AI_CACHE_PATH", "./ai_cache.db")
+
+HIT = "HIT"
+MISS = "MISS"
+BYPASS = "BYPASS"
+
+
+def normalize_text(text: str) -> str:
+    """Normalize free text so trivially different inputs share a cache key."""
+    return " ".join(unicodedata.normalize("NFKC", text).split()).casefold()
+
+
+def normalize_url(url: str) -> str:
+    """Normalize an URL without changing its (case-sensitive) path."""
+    return url.strip()
+
+
+def make_cache_key(namespace: str, model: str, template_version: str, value: str) -> str:
+    """Hash the parts that determine an AI response into a cache key."""
+    raw = json.dumps([namespace, model, template_version, value], ensure_ascii=False)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class MemoryCache:
+    """Thread-safe in-process LRU cache with TTL and size-based eviction."""
+
+    def __init__(self, max_entries: int, max_bytes: int) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str, ttl: float) -> None:
+        size = len(value.encode())
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._bytes += size
+            while len(self._data) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._data)))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def close(self) -> None:
+        pass
+
+    def _remove(self, key: str) -> None:
+        _, value = self._data.pop(key)
+        self._bytes -= len(value.encode())
+
+
+class SQLiteCache:
+    """Cache stored in a SQLite file so several workers can share it.
+
+    Eviction is FIFO by insertion time once ``max_entries`` is exceeded;
+    reads do not write, which keeps hits cheap under concurrency.
+    """
+
+    def __init__(self, path: str, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=5)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS ai_cache ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+            " created_at REAL NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS ix_ai_cache_created_at ON ai_cache (created_at)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM ai_cache WHERE key = ? AND expires_at > ?",
+                (key, time.time()),
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str, ttl: float) -> None:
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO ai_cache (key, value, created_at, expires_at)"
+                " VALUES (?, ?, ?, ?)",
+                (key, value, now, now + ttl),
+            )
+            self._conn.execute("DELETE FROM ai_cache WHERE expires_at <= ?", (now,))
+            self._conn.execute(
+                "DELETE FROM ai_cache WHERE key IN ("
+                " SELECT key FROM ai_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def clear(self) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM ai_cache")
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class ResponseCache:
+    """Read-through cache with per-namespace hit/miss counters."""
+
+    def __init__(self, backend: Optional[Any], ttl: float) -> None:
+        self.backend = backend
+        self.ttl = ttl
+        self.counters: Dict[str, Dict[str, int]] = defaultdict(
+            lambda: {HIT: 0, MISS: 0, BYPASS: 0}
+        )
+
+    async def get_or_compute(
+        self,
+        namespace: str,
+        key: str,
+        compute: Callable[[], Awaitable[Any]],
+        *,
+        bypass: bool = False,
+        store_key: Optional[Callable[[], Optional[str]]] = None,
+    ) -> Tuple[Any, str]:
+        """Return ``(value, status)`` where status is HIT, MISS or BYPASS.
+
+        ``compute`` must return a JSON-serializable value. Errors are not
+        cached. A bypassed request skips the lookup but still refreshes the
+        stored value. When given, ``store_key`` is called after ``compute``
+        and returns the key to store the value under instead of ``key``, or
+        None to not store it.
+        """
+        if self.backend is None:
+            return await compute(), BYPASS
+
+        if not bypass:
+            cached = await self._call(self.backend.get, key)
+            if cached is not None:
+                self.counters[namespace][HIT] += 1
+                metrics.ai_cache_requests.inc(namespace, HIT.lower())
+                return json.loads(cached), HIT
+
+        status = BYPASS if bypass else MISS
+        self.counters[namespace][status] += 1
+        metrics.ai_cache_requests.inc(namespace, status.lower())
+        value = await compute()
+        if store_key is not None:
+            key = store_key()
+        if key is not None:
+            await self._call(self.backend.set, key, json.dumps(value), self.ttl)
+        return value, status
+
+    def clear(self) -> None:
+        if self.backend is not None:
+            self.backend.clear()
+
+    def close(self) -> None:
+        if self.backend is not None:
+            self.backend.close()
+
+    async def _call(self, fn: Callable, *args: Any) -> Any:
+        # SQLite menulis ke disk; jalankan di thread agar event loop tidak tertahan.
+        if isinstance(self.backend, SQLiteCache):
+            return await asyncio.to_thread(fn, *args)
+        return fn(*args)
+
+
+def build_cache() -> ResponseCache:
+    """Create the response cache configured through the environment."""
+    if AI_CACHE_BACKEND == "none":
+        backend = None
+    elif AI_CACHE_BACKEND == "sqlite":
+        backend = SQLiteCache(AI_CACHE_PATH, AI_CACHE_MAX_ENTRIES)
+    else:
+        if AI_CACHE_BACKEND != "memory":
+            logger.warning("AI_CACHE_BACKEND=%s tidak dikenal; memakai memory", AI_CACHE_BACKEND)
+        backend = MemoryCache(AI_CACHE_MAX_ENTRIES, AI_CACHE_MAX_BYTES)
+    return ResponseCache(backend, AI_CACHE_TTL)
+
+
+ai_cache = build_cache()
+
+
+async def get_or_compute_ai(
+    namespace: str,
+    template_version: str,
+    normalized_input: str,
+    compute: Callable[[], Awaitable[Any]],
+    *,
+    bypass: bool = False,
+) -> Tuple[Any, str]:
+    """Run an OpenRouter call through :data:`ai_cache`, keyed on the answering model."""
+
+    def key_for(model: str) -> str:
+        return make_cache_key(namespace, model, template_version, normalized_input)
+
+    answered = openrouter_client.track_answering_models()
+    # Pemanggil yang berbagi panggilan single-flight tidak tahu model mana
+    # yang menjawab; pemilik panggilan itu yang menyimpannya.
+    return await ai_cache.get_or_compute(
+        namespace,
+        key_for(openrouter_client.OPENROUTER_MODEL),
+        compute,
+        bypass=bypass,
+        store_key=lambda: key_for(answered[-1]) if answered else None,
+    )
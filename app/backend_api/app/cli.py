@@ -0,0 +1,83 @@
+"""Perintah pemeliharaan database.
+
+Contoh::
+
+    python -m app.cli rebuild-mood-stats
+    python -m app.cli rebuild-search-index
+    python -m app.cli migrate-activities
+    python -m app.cli migrate-client-id
+    python -m app.cli migrate-user-scope
+    python -m app.cli migrate-entry-analysis
+    python -m app.cli analysis-worker
+"""
+import argparse
+import asyncio
+from typing import List, Optional
+
+from . import analysis, crud, models
+from .database import SessionLocal, engine
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m app.cli", description=__doc__)
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser(
+        "rebuild-mood-stats",
+        help="Bangun ulang tabel rollup statistik mood dari diary_entries",
+    )
+    commands.add_parser(
+        "rebuild-search-index",
+        help="Buat dan isi ulang indeks full-text untuk pencarian entri",
+    )
+    commands.add_parser(
+        "migrate-activities",
+        help="Pindahkan aktivitas format lama (dipisah '|') ke tabel entry_activities",
+    )
+    commands.add_parser(
+        "migrate-client-id",
+        help="Tambahkan kolom client_id untuk unggahan idempoten (database lama)",
+    )
+    commands.add_parser(
+        "migrate-user-scope",
+        help="Tambahkan kolom user_id dan bangun ulang rollup per pengguna (database lama)",
+    )
+    commands.add_parser(
+        "migrate-entry-analysis",
+        help="Tambahkan kolom hasil analisis AI dan tabel antreannya (database lama)",
+    )
+    commands.add_parser(
+        "analysis-worker",
+        help="Jalankan worker analisis AI entri sebagai proses terpisah",
+    )
+    args = parser.parse_args(argv)
+
+    models.Base.metadata.create_all(bind=engine)
+    with SessionLocal() as db:
+        if args.command == "rebuild-mood-stats":
+            total = crud.rebuild_mood_stats(db)
+            print(f"Statistik mood dibangun ulang dari {total} entri")
+        elif args.command == "rebuild-search-index":
+            crud.rebuild_search_index(db)
+            print("Indeks pencarian dibangun ulang")
+        elif args.command == "migrate-activities":
+            total = crud.migrate_legacy_activities(db)
+            print(f"Aktivitas {total} entri dipindahkan")
+        elif args.command == "migrate-client-id":
+            crud.migrate_entry_client_id(db)
+            print("Skema diperbarui untuk client_id entri")
+        elif args.command == "migrate-user-scope":
+            crud.migrate_user_scope(db)
+            print("Skema diperbarui untuk data per pengguna")
+        elif args.command == "migrate-entry-analysis":
+            crud.migrate_entry_analysis(db)
+            print("Skema diperbarui untuk analisis entri")
+        elif args.command == "analysis-worker":
+            print("Worker analisis berjalan; hentikan dengan Ctrl+C")
+            try:
+                asyncio.run(analysis.AnalysisWorker().run())
+            except KeyboardInterrupt:
+                pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""Server-side chat history for ``/chat/`` within a token budget.
+
+Every turn of a conversation is stored in ``conversation_messages``. The
+history sent to OpenRouter is the conversation's rolling summary followed
+by the turns after it, at most ``CHAT_HISTORY_TOKEN_BUDGET`` estimated
+tokens. When those turns no longer fit, the oldest are folded into the
+summary with one extra completion and only about
+``CHAT_HISTORY_RECENT_TOKENS`` of recent turns stay verbatim, so the summary
+is regenerated when the window overflows rather than on every turn. If that
+completion fails the oldest turns are cut instead and the chat goes on.
+
+Token counts are estimated locally by :func:`estimate_tokens`, which is
+close enough for a budget without shipping the model's tokenizer.
+"""
+import logging
+import math
+import os
+import re
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import ai_utils, async_crud, metrics
+
+logger = logging.getLogger(__name__)
+
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "1200"))
+# Giliran terbaru (dalam token) yang tetap utuh setelah pemadatan; sisanya
+# dari anggaran untuk ringkasan.
+CHAT_HISTORY_RECENT_TOKENS = int(os.getenv("CHAT_HISTORY_RECENT_TOKENS", "600"))
+CHAT_SUMMARY_MAX_TOKENS = int(os.getenv("CHAT_SUMMARY_MAX_TOKENS", "300"))
+
+USER = "user"
+ASSISTANT = "assistant"
+_ROLE_LABELS = {USER: "Pengguna", ASSISTANT: "Asisten"}
+
+# Kata (grup 1) atau satu tanda baca.
+_TOKEN = re.compile(r"(\w+)|[^\w\s]")
+
+
+def _cost(match: "re.Match[str]") -> int:
+    word = match.group(1)
+    return math.ceil(len(word) / 4) if word else 1
+
+
+def estimate_tokens(text: str) -> int:
+    """Approximate BPE token count: one per 4 characters of a word, one per symbol."""
+    return sum(_cost(m) for m in _TOKEN.finditer(text))
+
+
+def trim_to_budget(text: str, budget: int) -> str:
+    """Keep the end of ``text`` that fits in ``budget`` estimated tokens."""
+    matches = list(_TOKEN.finditer(text))
+    total = sum(_cost(m) for m in matches)
+    for match in matches:
+        if total <= budget:
+            return text[match.start() :]
+        total -= _cost(match)
+    return ""
+
+
+def trim_history(history: Optional[str]) -> Optional[str]:
+    """Bound a client-sent ``history`` string to the history budget."""
+    if not history:
+        return history
+    return trim_to_budget(history, CHAT_HISTORY_TOKEN_BUDGET)
+
+
+def _transcript(messages: Sequence[Dict[str, Any]]) -> str:
+    return "\n".join(f"{_ROLE_LABELS[m['role']]}: {m['content']}" for m in messages)
+
+
+def _split_recent(
+    messages: List[Dict[str, Any]], budget: int
+) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Split into ``(older, recent)`` where ``recent`` fits in ``budget`` tokens."""
+    index, kept = len(messages), 0
+    while index > 0 and kept + messages[index - 1]["tokens"] <= budget:
+        index -= 1
+        kept += messages[index]["tokens"]
+    return messages[:index], messages[index:]
+
+
+async def load_history(db: AsyncSession, conversation: Dict[str, Any]) -> str:
+    """Build the history of ``conversation`` for the next turn, compacting if needed."""
+    summary = conversation["summary"]
+    messages = await async_crud.get_conversation_messages(
+        db, conversation["id"], conversation["summarized_until"]
+    )
+    total = (estimate_tokens(summary) if summary else 0) + sum(m["tokens"] for m in messages)
+    if total > CHAT_HISTORY_TOKEN_BUDGET:
+        older, recent = _split_recent(messages, CHAT_HISTORY_RECENT_TOKENS)
+        if older:
+            try:
+                summary = await ai_utils.summarize_conversation(
+                    summary, _transcript(older), CHAT_SUMMARY_MAX_TOKENS
+                )
+            except Exception as e:
+                metrics.chat_history_compactions.inc("error")
+                logger.warning("Ringkasan percakapan %s gagal: %s", conversation["id"], e)
+            else:
+                metrics.chat_history_compactions.inc("ok")
+                await async_crud.update_conversation_summary(
+                    db, conversation["id"], summary, older[-1]["id"], int(time.time())
+                )
+                messages = recent
+
+    parts = [f"Ringkasan percakapan sebelumnya: {summary}"] if summary else []
+    if messages:
+        parts.append(_transcript(messages))
+    # Ringkasan yang gagal dibuat atau terlalu panjang tetap tidak boleh
+    # membuat riwayat melewati anggaran: potong dari depan.
+    return trim_to_budget("\n".join(parts), CHAT_HISTORY_TOKEN_BUDGET)
+
+
+async def record_turn(db: AsyncSession, conversation_id: str, text: str, reply: str) -> None:
+    """Store the user's message and the reply as two new messages."""
+    await async_crud.add_conversation_messages(
+        db,
+        conversation_id,
+        [(USER, text, estimate_tokens(text)), (ASSISTANT, reply, estimate_tokens(reply))],
+        int(time.time()),
+    )
@@ -1,65 +1,803 @@
+import base64
+import binascii
+import re
+import time
+import uuid
+from collections import Counter
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-from sqlalchemy import func
-from typing import List, Optional, Dict
-from passlib.context import CryptContext
+from sqlalchemy import BigInteger, and_, cast, delete, extract, func, insert, inspect, or_, select, text, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.schema import CreateIndex
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 
 from . import models, schemas
 
+# Milidetik per hari; timestamp entri dikirim dalam milidetik oleh aplikasi Android.
+MS_PER_DAY = 86_400_000
+
+
+def _owned_by(column, user_id: Optional[int]):
+    """Filter on an owner column; ``None`` selects entries without an owner."""
+    return column.is_(None) if user_id is None else column == user_id
+
+
+ANALYSIS_PENDING = "pending"
+ANALYSIS_RUNNING = "running"
+ANALYSIS_DONE = "done"
+ANALYSIS_FAILED = "failed"
+
+
+def _entry_values(
+    entry: schemas.DiaryEntryCreate, user_id: Optional[int] = None, analyze: bool = False
+) -> Dict[str, object]:
+    """Map a create schema onto ``diary_entries`` column values."""
+    return {
+        "content": entry.content,
+        "mood": entry.mood,
+        "timestamp": entry.timestamp,
+        "client_id": entry.client_id,
+        "user_id": user_id,
+        "analysis_status": ANALYSIS_PENDING if analyze else None,
+    }
+
+
+def _enqueue_analysis(db: Session, entry_ids: Sequence[int]) -> None:
+    """Queue new entries for background analysis (see :mod:`app.analysis`)."""
+    if entry_ids:
+        now = int(time.time())
+        db.execute(
+            insert(models.AnalysisJob),
+            [
+                {"entry_id": entry_id, "status": ANALYSIS_PENDING, "available_at": now}
+                for entry_id in entry_ids
+            ],
+        )
+
+
+def _unique_names(names: Iterable[str]) -> List[str]:
+    """Drop empty and repeated activity names, keeping the first occurrence."""
+    return list(dict.fromkeys(name for name in names if name))
+
+
+def _activity_ids(db: Session, names: Iterable[str]) -> Dict[str, int]:
+    """Return ``{name: id}`` for ``names``, creating missing activities."""
+    names = set(names)
+    if not names:
+        return {}
+    table = models.Activity.__table__
+    dialect = db.get_bind().dialect.name
+    stmt = select(table.c.name, table.c.id).where(table.c.name.in_(names))
+    ids = dict(db.execute(stmt).all())
+    missing = [{"name": name} for name in names - ids.keys()]
+    if missing:
+        if dialect in ("sqlite", "postgresql"):
+            dialect_insert = sqlite.insert if dialect == "sqlite" else postgresql.insert
+            db.execute(dialect_insert(table).values(missing).on_conflict_do_nothing())
+        else:
+            db.execute(insert(table), missing)
+        ids = dict(db.execute(stmt).all())
+    return ids
+
+
+def _insert_activity_links(
+    db: Session, entries: Iterable[Tuple[int, Optional[int], str, int, Sequence[str]]]
+) -> None:
+    """Link ``(entry_id, user_id, mood, timestamp, activity_names)`` items to activities."""
+    entries = [(i, u, m, t, _unique_names(names)) for i, u, m, t, names in entries]
+    ids = _activity_ids(db, (name for *_, names in entries for name in names))
+    rows = [
+        {
+            "entry_id": entry_id,
+            "activity_id": ids[name],
+            "position": position,
+            "user_id": user_id,
+            "mood": mood,
+            "timestamp": timestamp,
+        }
+        for entry_id, user_id, mood, timestamp, names in entries
+        for position, name in enumerate(names)
+    ]
+    if rows:
+        db.execute(insert(models.EntryActivity), rows)
+
+
+def get_activity_names(db: Session, entry_ids: Sequence[int]) -> Dict[int, List[str]]:
+    """Return ``{entry_id: [activity, ...]}`` for the given entries."""
+    if not entry_ids:
+        return {}
+    results = db.execute(
+        select(models.EntryActivity.entry_id, models.Activity.name)
+        .join(models.Activity, models.Activity.id == models.EntryActivity.activity_id)
+        .where(models.EntryActivity.entry_id.in_(entry_ids))
+        .order_by(models.EntryActivity.entry_id, models.EntryActivity.position)
+    )
+    names: Dict[int, List[str]] = {}
+    for entry_id, name in results:
+        names.setdefault(entry_id, []).append(name)
+    return names
+
+
+def with_activities(db: Session, rows: Sequence[Any]) -> List[Dict[str, Any]]:
+    """Turn plain entry rows (mappings with an ``id``) into dicts with activities.
+
+    All activities for the rows are read with one query.
+    """
+    rows = [dict(row) for row in rows]
+    names = get_activity_names(db, [row["id"] for row in rows])
+    for row in rows:
+        row["activities"] = names.get(row["id"], [])
+    return rows
+
+
+def get_diary_entries_by_client_ids(
+    db: Session, client_ids: Sequence[str], user_id: Optional[int] = None
+) -> Dict[str, models.DiaryEntry]:
+    """Return already stored entries of ``user_id`` keyed by their idempotency key."""
+    if not client_ids:
+        return {}
+    stmt = select(models.DiaryEntry).where(
+        models.DiaryEntry.client_id.in_(set(client_ids)),
+        _owned_by(models.DiaryEntry.user_id, user_id),
+    )
+    return {e.client_id: e for e in db.scalars(stmt)}
+
 
 def create_diary_entry(
-    db: Session, entry: schemas.DiaryEntryCreate
+    db: Session,
+    entry: schemas.DiaryEntryCreate,
+    user_id: Optional[int] = None,
+    analyze: bool = False,
 ) -> models.DiaryEntry:
-    """Create a new diary entry and persist it to the database."""
-    data = entry.model_dump()
-    db_entry = models.DiaryEntry(
-        content=data["content"],
-        mood=data["mood"],
-        timestamp=data["timestamp"],
-        activities="|".join(data.get("activities", [])),
-    )
+    """Create a new diary entry owned by ``user_id`` and persist it.
+
+    If ``entry.client_id`` was already stored, the existing entry is returned
+    instead of creating a duplicate. With ``analyze`` the new entry is queued
+    for background analysis in the same transaction.
+    """
+    if entry.client_id:
+        existing = get_diary_entries_by_client_ids(db, [entry.client_id], user_id)
+        if entry.client_id in existing:
+            return existing[entry.client_id]
+    db_entry = models.DiaryEntry(**_entry_values(entry, user_id, analyze))
     db.add(db_entry)
+    try:
+        db.flush()
+    except IntegrityError:
+        # Permintaan paralel pemilik yang sama baru saja menyimpan client_id ini.
+        db.rollback()
+        existing = get_diary_entries_by_client_ids(db, [entry.client_id], user_id)
+        if entry.client_id not in existing:
+            raise
+        return existing[entry.client_id]
+    _insert_activity_links(
+        db, [(db_entry.id, user_id, entry.mood, entry.timestamp, entry.activities)]
+    )
+    if analyze:
+        _enqueue_analysis(db, [db_entry.id])
+    increment_mood_stats(db, [(entry.mood, entry.timestamp)], user_id)
     db.commit()
     db.refresh(db_entry)
     return db_entry
 
 
-def get_diary_entries(
-    db: Session, skip: int = 0, limit: int = 100
+def create_diary_entries(
+    db: Session,
+    entries: Sequence[schemas.DiaryEntryCreate],
+    user_id: Optional[int] = None,
+    analyze: bool = False,
 ) -> List[models.DiaryEntry]:
-    """Return a list of diary entries ordered by newest timestamp."""
+    """Insert many diary entries in a single transaction.
+
+    New rows are written with one bulk ``INSERT ... RETURNING`` where the
+    backend supports it. Entries whose ``client_id`` is already stored (or
+    repeated within the batch) are not inserted again. The result has one
+    entry per input item, in input order. With ``analyze`` the inserted
+    entries are queued for background analysis.
+    """
+    for attempt in range(2):
+        existing = get_diary_entries_by_client_ids(
+            db, [e.client_id for e in entries if e.client_id], user_id
+        )
+        pending: Dict[str, schemas.DiaryEntryCreate] = {}
+        new_entries = []
+        for entry in entries:
+            if entry.client_id:
+                if entry.client_id in existing or entry.client_id in pending:
+                    continue
+                pending[entry.client_id] = entry
+            new_entries.append(entry)
+        rows = [_entry_values(entry, user_id, analyze) for entry in new_entries]
+
+        inserted: List[models.DiaryEntry] = []
+        if rows:
+            try:
+                inserted = list(
+                    db.scalars(
+                        insert(models.DiaryEntry).returning(
+                            models.DiaryEntry, sort_by_parameter_order=True
+                        ),
+                        rows,
+                    )
+                )
+                _insert_activity_links(
+                    db,
+                    [
+                        (db_entry.id, user_id, entry.mood, entry.timestamp, entry.activities)
+                        for db_entry, entry in zip(inserted, new_entries)
+                    ],
+                )
+                increment_mood_stats(
+                    db, [(r["mood"], r["timestamp"]) for r in rows], user_id
+                )
+                if analyze:
+                    _enqueue_analysis(db, [e.id for e in inserted])
+                # INSERT ... RETURNING tidak menjalankan eager loader; muat
+                # ulang sekali agar aktivitas semua entri baru ikut terisi.
+                db.scalars(
+                    select(models.DiaryEntry)
+                    .where(models.DiaryEntry.id.in_([e.id for e in inserted]))
+                    .execution_options(populate_existing=True)
+                ).all()
+            except IntegrityError:
+                # Sinkronisasi paralel pemilik yang sama baru saja menyimpan
+                # client_id tersebut; ulangi sekali supaya pencarian ulang di
+                # atas (dengan cakupan pemilik yang sama) memakai entri itu.
+                db.rollback()
+                if attempt:
+                    raise
+                continue
+        break
+
+    by_key = dict(existing)
+    anonymous = iter(e for e in inserted if e.client_id is None)
+    for db_entry in inserted:
+        if db_entry.client_id is not None:
+            by_key[db_entry.client_id] = db_entry
+    result = [
+        by_key[e.client_id] if e.client_id else next(anonymous) for e in entries
+    ]
+
+    # Lepaskan objek dari sesi sebelum commit agar atributnya tidak
+    # di-expire dan dimuat ulang satu per satu.
+    for db_entry in {id(e): e for e in result}.values():
+        db.expunge(db_entry)
+    db.commit()
+    return result
+
+
+def encode_cursor(timestamp: int, entry_id: int) -> str:
+    """Encode a ``(timestamp, id)`` keyset position as an opaque cursor."""
+    raw = f"{timestamp}:{entry_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[int, int]:
+    """Decode a cursor produced by :func:`encode_cursor`.
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        timestamp, entry_id = base64.urlsafe_b64decode(padded).decode().split(":")
+        return int(timestamp), int(entry_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise ValueError("Cursor tidak valid") from e
+
+
+# Kolom yang dikirim ke klien; jalur baca memilih kolom ini saja sebagai baris
+# biasa sehingga tidak ada objek ORM yang dibuat, dilacak, atau diubah.
+_ENTRY_COLUMNS = (
+    models.DiaryEntry.id,
+    models.DiaryEntry.content,
+    models.DiaryEntry.mood,
+    models.DiaryEntry.timestamp,
+    models.DiaryEntry.analysis,
+    models.DiaryEntry.analysis_status,
+)
+
+
+def get_diary_entries(
+    db: Session,
+    skip: int = 0,
+    limit: int = 100,
+    cursor: Optional[Tuple[int, int]] = None,
+    activity: Optional[str] = None,
+    user_id: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """Return the entries of ``user_id`` ordered by newest timestamp.
+
+    Entries are plain dicts (see :func:`with_activities`) built from the
+    selected columns, ready to be serialized without ORM objects.
+
+    When ``cursor`` is given the page starts strictly after that
+    ``(timestamp, id)`` position and ``skip`` is ignored, so deep pages are
+    served from the ``(user_id, timestamp, id)`` index instead of scanning
+    and discarding every earlier row.
+
+    When ``activity`` is given only entries with that activity are returned,
+    walking the ``(user_id, activity_id, timestamp, entry_id)`` index of
+    ``entry_activities``.
+    """
+    stmt = select(*_ENTRY_COLUMNS)
+    if activity is None:
+        ts, entry_id_col = models.DiaryEntry.timestamp, models.DiaryEntry.id
+        stmt = stmt.where(_owned_by(models.DiaryEntry.user_id, user_id))
+    else:
+        link = models.EntryActivity
+        ts, entry_id_col = link.timestamp, link.entry_id
+        stmt = (
+            stmt.join(link, link.entry_id == models.DiaryEntry.id)
+            .join(models.Activity, models.Activity.id == link.activity_id)
+            .where(models.Activity.name == activity, _owned_by(link.user_id, user_id))
+        )
+    stmt = stmt.order_by(ts.desc(), entry_id_col.desc())
+    if cursor is not None:
+        timestamp, entry_id = cursor
+        stmt = stmt.where(
+            or_(ts < timestamp, and_(ts == timestamp, entry_id_col < entry_id))
+        )
+    else:
+        stmt = stmt.offset(skip)
+    return with_activities(db, db.execute(stmt.limit(limit)).mappings().all())
+
+
+def select_diary_entry_rows(user_id: Optional[int] = None):
+    """Return a SELECT of the plain entry rows of ``user_id``, newest first."""
     return (
-        db.query(models.DiaryEntry)
-        .order_by(models.DiaryEntry.timestamp.desc())
-        .offset(skip)
-        .limit(limit)
-        .all()
+        select(*_ENTRY_COLUMNS)
+        .where(_owned_by(models.DiaryEntry.user_id, user_id))
+        .order_by(models.DiaryEntry.timestamp.desc(), models.DiaryEntry.id.desc())
     )
 
 
-def get_diary_entry(db: Session, entry_id: int) -> Optional[models.DiaryEntry]:
-    """Return a single diary entry by ID or None if not found."""
-    return db.query(models.DiaryEntry).filter(models.DiaryEntry.id == entry_id).first()
+def iter_diary_entry_batches(
+    db: Session, batch_size: int = 500, user_id: Optional[int] = None
+) -> Iterator[List[Dict[str, Any]]]:
+    """Yield batches of entry dicts (see :func:`with_activities`).
+
+    Rows are fetched through a server-side cursor (``yield_per``) so the
+    whole table is never held in memory at once.
+    """
+    stmt = select_diary_entry_rows(user_id).execution_options(yield_per=batch_size)
+    for batch in db.execute(stmt).mappings().partitions():
+        yield with_activities(db, batch)
+
+
+def get_diary_entry(
+    db: Session, entry_id: int, user_id: Optional[int] = None
+) -> Optional[Dict[str, Any]]:
+    """Return an entry of ``user_id`` as a dict (see :func:`get_diary_entries`) or None."""
+    row = db.execute(
+        select(*_ENTRY_COLUMNS).where(
+            models.DiaryEntry.id == entry_id,
+            _owned_by(models.DiaryEntry.user_id, user_id),
+        )
+    ).mappings().first()
+    return with_activities(db, [row])[0] if row is not None else None
+
+
+def encode_search_cursor(score: float, entry_id: int) -> str:
+    """Encode a ``(score, id)`` search position as an opaque cursor."""
+    raw = f"{score!r}:{entry_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_search_cursor(cursor: str) -> Tuple[float, int]:
+    """Decode a cursor produced by :func:`encode_search_cursor`.
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        score, entry_id = base64.urlsafe_b64decode(padded).decode().split(":")
+        return float(score), int(entry_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise ValueError("Cursor tidak valid") from e
+
+
+class SearchNotSupportedError(RuntimeError):
+    """Raised when the database dialect has no full-text search query."""
+
+
+HIGHLIGHT_START = "<mark>"
+HIGHLIGHT_END = "</mark>"
+
+_SEARCH_SQL = {
+    # bm25() bernilai negatif; makin kecil makin relevan.
+    "sqlite": """
+        SELECT * FROM (
+            SELECT e.id, e.content, e.mood, e.timestamp, e.analysis, e.analysis_status,
+                   bm25(diary_entries_fts) AS score,
+                   snippet(diary_entries_fts, 0, :hl_start, :hl_end, '…', 24) AS highlight
+            FROM diary_entries_fts
+            JOIN diary_entries AS e ON e.id = diary_entries_fts.rowid
+            WHERE diary_entries_fts MATCH :query AND e.user_id IS :user_id
+        )
+        WHERE :after_score IS NULL OR score > :after_score
+              OR (score = :after_score AND id > :after_id)
+        ORDER BY score, id
+        LIMIT :limit
+    """,
+    # ts_rank() makin besar makin relevan; dinegasikan agar urutannya sama.
+    "postgresql": """
+        SELECT * FROM (
+            SELECT e.id, e.content, e.mood, e.timestamp, e.analysis, e.analysis_status,
+                   -ts_rank(e.content_tsv, q) AS score,
+                   ts_headline('simple', e.content, q,
+                               'StartSel=' || :hl_start || ', StopSel=' || :hl_end
+                               || ', MaxWords=35, MinWords=15') AS highlight
+            FROM diary_entries AS e, to_tsquery('simple', :query) AS q
+            WHERE e.content_tsv @@ q
+              AND e.user_id IS NOT DISTINCT FROM CAST(:user_id AS integer)
+        ) AS hits
+        WHERE CAST(:after_score AS double precision) IS NULL
+              OR score > :after_score
+              OR (score = :after_score AND id > :after_id)
+        ORDER BY score, id
+        LIMIT :limit
+    """,
+}
+
 
+def _search_query(dialect: str, q: str) -> Optional[str]:
+    """Turn free text into an AND-of-terms query for the full-text engine.
 
-def get_mood_stats(db: Session) -> Dict[str, int]:
-    """Return counts of diary entries grouped by mood."""
-    results = (
-        db.query(models.DiaryEntry.mood, func.count(models.DiaryEntry.id))
-        .group_by(models.DiaryEntry.mood)
-        .all()
+    Only word characters are kept, so user input can never inject operators
+    of the FTS5 or ``tsquery`` syntax. Returns ``None`` when no term remains.
+    """
+    terms = re.findall(r"\w+", q)
+    if not terms:
+        return None
+    if dialect == "postgresql":
+        return " & ".join(terms)
+    return " ".join(f'"{term}"' for term in terms)
+
+
+def search_diary_entries(
+    db: Session,
+    q: str,
+    limit: int = 20,
+    cursor: Optional[Tuple[float, int]] = None,
+    user_id: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """Search the entries of ``user_id`` through the full-text index, best first.
+
+    Every term in ``q`` must occur in the entry. Rows are ordered by
+    ``(score, id)`` where a lower score is a better match, and ``cursor``
+    continues after such a position.
+
+    Returns:
+        Dicts with the entry columns plus ``score`` and ``highlight`` (a
+        snippet with matches wrapped in ``<mark>`` tags).
+
+    Raises:
+        SearchNotSupportedError: If the dialect is neither SQLite nor Postgres.
+    """
+    dialect = db.get_bind().dialect.name
+    if dialect not in _SEARCH_SQL:
+        raise SearchNotSupportedError(f"Pencarian full-text belum didukung untuk {dialect}")
+    query = _search_query(dialect, q)
+    if query is None:
+        return []
+    after_score, after_id = cursor if cursor is not None else (None, None)
+    rows = db.execute(
+        text(_SEARCH_SQL[dialect]),
+        {
+            "query": query,
+            "hl_start": HIGHLIGHT_START,
+            "hl_end": HIGHLIGHT_END,
+            "after_score": after_score,
+            "after_id": after_id,
+            "limit": limit,
+            "user_id": user_id,
+        },
     )
-    return {mood: count for mood, count in results}
+    return with_activities(db, rows.mappings().all())
+
+
+def rebuild_search_index(db: Session) -> None:
+    """Create the full-text index objects if missing and refill the index.
+
+    Also drops the B-tree index that older schemas had on ``content``.
+    """
+    dialect = db.get_bind().dialect.name
+    db.execute(text("DROP INDEX IF EXISTS ix_diary_entries_content"))
+    for statement in models.SEARCH_DDL.get(dialect, []):
+        db.execute(text(statement))
+    if dialect == "sqlite":
+        db.execute(text("INSERT INTO diary_entries_fts(diary_entries_fts) VALUES ('rebuild')"))
+    db.commit()
 
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+def _upsert_increment(db: Session, model, rows: List[Dict[str, object]]) -> None:
+    """Add ``row["count"]`` to the rollup rows identified by their primary key.
+
+    Uses ``INSERT ... ON CONFLICT DO UPDATE`` on SQLite and Postgres and an
+    UPDATE-then-INSERT fallback elsewhere.
+    """
+    table = model.__table__
+    keys = [c.name for c in table.primary_key.columns]
+    dialect = db.get_bind().dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        dialect_insert = sqlite.insert if dialect == "sqlite" else postgresql.insert
+        stmt = dialect_insert(table).values(rows)
+        db.execute(
+            stmt.on_conflict_do_update(
+                index_elements=keys, set_={"count": table.c.count + stmt.excluded.count}
+            )
+        )
+        return
+    for row in rows:
+        where = [table.c[k] == row[k] for k in keys]
+        result = db.execute(
+            update(table).where(*where).values(count=table.c.count + row["count"])
+        )
+        if result.rowcount == 0:
+            db.execute(insert(table).values(**row))
+
+
+def _rollup_user(user_id: Optional[int]) -> int:
+    """Rollup key of an owner; entries without owner are counted under 0."""
+    return 0 if user_id is None else user_id
+
+
+def increment_mood_stats(
+    db: Session, entries: Iterable[Tuple[str, int]], user_id: Optional[int] = None
+) -> None:
+    """Add ``(mood, timestamp)`` pairs of new entries to the rollup tables.
+
+    Must run in the same transaction as the inserts it accounts for.
+    """
+    owner = _rollup_user(user_id)
+    totals = Counter()
+    daily = Counter()
+    for mood, timestamp in entries:
+        totals[mood] += 1
+        daily[(timestamp // MS_PER_DAY, mood)] += 1
+    if not totals:
+        return
+    _upsert_increment(
+        db,
+        models.MoodCount,
+        [{"user_id": owner, "mood": m, "count": n} for m, n in totals.items()],
+    )
+    _upsert_increment(
+        db,
+        models.MoodDailyCount,
+        [
+            {"user_id": owner, "day": d, "mood": m, "count": n}
+            for (d, m), n in daily.items()
+        ],
+    )
+
+
+def rebuild_mood_stats(db: Session) -> int:
+    """Recompute the rollup tables from ``diary_entries``.
+
+    Returns:
+        The number of entries accounted for.
+    """
+    owner = func.coalesce(models.DiaryEntry.user_id, 0).label("user_id")
+    day = (models.DiaryEntry.timestamp // MS_PER_DAY).label("day")
+    count = func.count(models.DiaryEntry.id)
+    db.execute(delete(models.MoodCount))
+    db.execute(delete(models.MoodDailyCount))
+    db.execute(
+        insert(models.MoodCount).from_select(
+            ["user_id", "mood", "count"],
+            select(owner, models.DiaryEntry.mood, count).group_by(
+                owner, models.DiaryEntry.mood
+            ),
+        )
+    )
+    db.execute(
+        insert(models.MoodDailyCount).from_select(
+            ["user_id", "day", "mood", "count"],
+            select(owner, day, models.DiaryEntry.mood, count).group_by(
+                owner, day, models.DiaryEntry.mood
+            ),
+        )
+    )
+    total = db.scalar(select(func.coalesce(func.sum(models.MoodCount.count), 0)))
+    db.commit()
+    return total
+
+
+def _bucket_start_expr(db: Session, bucket: str):
+    """SQL expression mapping ``DiaryEntry.timestamp`` to its UTC bucket start (ms)."""
+    ts = models.DiaryEntry.timestamp
+    days = ts // MS_PER_DAY
+    if bucket == "day":
+        return days * MS_PER_DAY
+    if bucket == "week":
+        # 1970-01-01 adalah hari Kamis; geser 3 hari agar minggu dimulai Senin.
+        return ((days + 3) // 7 * 7 - 3) * MS_PER_DAY
+    if bucket != "month":
+        raise ValueError(f"Bucket tidak dikenal: {bucket}")
+    if db.get_bind().dialect.name == "postgresql":
+        month = func.date_trunc("month", func.timezone("UTC", func.to_timestamp(ts // 1000)))
+        return cast(extract("epoch", month), BigInteger) * 1000
+    month = func.strftime("%s", ts // 1000, "unixepoch", "start of month")
+    return cast(month, BigInteger) * 1000
+
+
+def get_mood_timeseries(
+    db: Session, bucket: str, start: int, end: int, user_id: Optional[int] = None
+) -> Dict[int, Dict[str, int]]:
+    """Count the entries of ``user_id`` per ``bucket`` (day, week or month) and mood.
+
+    Only entries with ``start <= timestamp <= end`` are counted; the range
+    filter uses the ``(user_id, timestamp, id)`` index.
+
+    Returns:
+        ``{bucket_start_ms: {mood: count}}`` for buckets that have entries.
+    """
+    bucket_start = _bucket_start_expr(db, bucket).label("bucket_start")
+    results = db.execute(
+        select(bucket_start, models.DiaryEntry.mood, func.count(models.DiaryEntry.id))
+        .where(
+            _owned_by(models.DiaryEntry.user_id, user_id),
+            models.DiaryEntry.timestamp.between(start, end),
+        )
+        .group_by(bucket_start, models.DiaryEntry.mood)
+    )
+    series: Dict[int, Dict[str, int]] = {}
+    for bucket_ms, mood, count in results:
+        series.setdefault(int(bucket_ms), {})[mood] = count
+    return series
+
+
+def get_activity_mood_stats(
+    db: Session, activity: Optional[str] = None, user_id: Optional[int] = None
+) -> Dict[str, Dict[str, int]]:
+    """Count the entries of ``user_id`` per activity and mood.
+
+    Counted from the ``(user_id, activity_id, mood)`` index of
+    ``entry_activities``, optionally for one activity only.
+
+    Returns:
+        ``{activity: {mood: count}}`` for activities that have entries.
+    """
+    link = models.EntryActivity
+    stmt = (
+        select(models.Activity.name, link.mood, func.count())
+        .join(link, link.activity_id == models.Activity.id)
+        .where(_owned_by(link.user_id, user_id))
+        .group_by(models.Activity.name, link.mood)
+    )
+    if activity is not None:
+        stmt = stmt.where(models.Activity.name == activity)
+    stats: Dict[str, Dict[str, int]] = {}
+    for name, mood, count in db.execute(stmt):
+        stats.setdefault(name, {})[mood] = count
+    return stats
+
+
+def migrate_legacy_activities(db: Session, batch_size: int = 1000) -> int:
+    """Move pipe-joined ``diary_entries.activities`` values into join tables.
+
+    Safe to run repeatedly: migrated entries get an empty legacy value.
+
+    Returns:
+        The number of entries migrated.
+    """
+    legacy = models.DiaryEntry.legacy_activities
+    total = 0
+    while True:
+        rows = db.execute(
+            select(
+                models.DiaryEntry.id,
+                models.DiaryEntry.user_id,
+                models.DiaryEntry.mood,
+                models.DiaryEntry.timestamp,
+                legacy,
+            )
+            .where(legacy != "")
+            .order_by(models.DiaryEntry.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            return total
+        _insert_activity_links(
+            db,
+            [(i, user, mood, ts, value.split("|")) for i, user, mood, ts, value in rows],
+        )
+        db.execute(
+            update(models.DiaryEntry)
+            .where(models.DiaryEntry.id.in_([row[0] for row in rows]))
+            .values({legacy: ""})
+        )
+        db.commit()
+        total += len(rows)
+
+
+def migrate_entry_client_id(db: Session) -> None:
+    """Add the ``client_id`` idempotency column to a database created before it."""
+    conn = db.connection()
+    columns = {c["name"] for c in inspect(conn).get_columns("diary_entries")}
+    if "client_id" not in columns:
+        db.execute(text("ALTER TABLE diary_entries ADD COLUMN client_id VARCHAR(64)"))
+    # Skema sebelum data per pengguna membuat indeks ini UNIQUE (client_id unik
+    # global); keunikannya kini per pemilik (lihat migrate_user_scope), jadi
+    # indeksnya dibuat ulang tanpa UNIQUE.
+    db.execute(text("DROP INDEX IF EXISTS ix_diary_entries_client_id"))
+    for index in models.DiaryEntry.__table__.indexes:
+        if index.name == "ix_diary_entries_client_id":
+            db.execute(CreateIndex(index, if_not_exists=True))
+    db.commit()
+
+
+def migrate_user_scope(db: Session) -> None:
+    """Bring a database created before per-user scoping up to date.
+
+    Adds the ``client_id`` and ``user_id`` columns and their indexes
+    (including ``client_id`` unique per owner), copies owners into
+    ``entry_activities`` and recreates the mood rollups keyed by user.
+    """
+    migrate_entry_client_id(db)
+    conn = db.connection()
+    columns = {
+        table: {c["name"] for c in inspect(conn).get_columns(table)}
+        for table in ("diary_entries", "entry_activities", "mood_counts")
+    }
+    if "user_id" not in columns["diary_entries"]:
+        db.execute(
+            text("ALTER TABLE diary_entries ADD COLUMN user_id INTEGER REFERENCES users (id)")
+        )
+    if "user_id" not in columns["entry_activities"]:
+        db.execute(text("ALTER TABLE entry_activities ADD COLUMN user_id INTEGER"))
+        db.execute(
+            update(models.EntryActivity).values(
+                user_id=select(models.DiaryEntry.user_id)
+                .where(models.DiaryEntry.id == models.EntryActivity.entry_id)
+                .scalar_subquery()
+            )
+        )
+    for model in (models.DiaryEntry, models.EntryActivity):
+        for index in model.__table__.indexes:
+            # IF NOT EXISTS: indeks ekspresi tidak bisa diperiksa lewat refleksi.
+            db.execute(CreateIndex(index, if_not_exists=True))
+    if "user_id" not in columns["mood_counts"]:
+        for model in (models.MoodCount, models.MoodDailyCount):
+            model.__table__.drop(conn)
+            model.__table__.create(conn)
+    rebuild_mood_stats(db)
+
+
+def migrate_entry_analysis(db: Session) -> None:
+    """Add the background analysis columns to a database created before them."""
+    conn = db.connection()
+    columns = {c["name"] for c in inspect(conn).get_columns("diary_entries")}
+    if "analysis" not in columns:
+        db.execute(text("ALTER TABLE diary_entries ADD COLUMN analysis VARCHAR"))
+    if "analysis_status" not in columns:
+        db.execute(text("ALTER TABLE diary_entries ADD COLUMN analysis_status VARCHAR(16)"))
+    models.AnalysisJob.__table__.create(conn, checkfirst=True)
+    db.commit()
+
+
+def get_mood_stats(db: Session, user_id: Optional[int] = None) -> Dict[str, int]:
+    """Return the entry counts of ``user_id`` per mood, read from the rollup."""
+    results = db.execute(
+        select(models.MoodCount.mood, models.MoodCount.count).where(
+            models.MoodCount.user_id == _rollup_user(user_id),
+            models.MoodCount.count > 0,
+        )
+    )
+    return {mood: count for mood, count in results}
 
 
 def get_user_by_email(db: Session, email: str) -> Optional[models.User]:
     return db.query(models.User).filter(models.User.email == email).first()
 
 
-def create_user(db: Session, user: schemas.UserCreate) -> models.User:
-    hashed_password = pwd_context.hash(user.password)
+def create_user(
+    db: Session, user: schemas.UserCreate, hashed_password: str
+) -> models.User:
+    """Store a new user; hash the password with :mod:`app.passwords` first."""
     db_user = models.User(
         email=user.email, name=user.name, hashed_password=hashed_password
     )
@@ -69,8 +807,237 @@ def create_user(db: Session, user: schemas.UserCreate) -> models.User:
     return db_user
 
 
-def authenticate_user(db: Session, email: str, password: str) -> bool:
-    user = get_user_by_email(db, email)
-    if not user:
+def revoke_token(db: Session, jti: str, expires_at: int, now: int) -> None:
+    """Record a revoked token and drop revocations of already expired tokens."""
+    db.execute(delete(models.RevokedToken).where(models.RevokedToken.expires_at <= now))
+    db.merge(models.RevokedToken(jti=jti, expires_at=expires_at))
+    db.commit()
+
+
+def get_revoked_tokens(db: Session, now: int) -> Dict[str, int]:
+    """Return ``{jti: expires_at}`` of revoked tokens that have not expired yet."""
+    results = db.execute(
+        select(models.RevokedToken.jti, models.RevokedToken.expires_at).where(
+            models.RevokedToken.expires_at > now
+        )
+    )
+    return dict(results.all())
+
+
+def update_password_hash(db: Session, user: models.User, hashed_password: str) -> None:
+    """Replace a user's password hash, e.g. after the bcrypt cost changed."""
+    user.hashed_password = hashed_password
+    db.commit()
+
+
+def _due_analysis_jobs(now: int):
+    job = models.AnalysisJob
+    return or_(
+        and_(job.status == ANALYSIS_PENDING, job.available_at <= now),
+        and_(job.status == ANALYSIS_RUNNING, job.locked_until < now),
+    )
+
+
+def claim_analysis_jobs(
+    db: Session, limit: int, now: int, lease_seconds: int
+) -> List[Dict[str, Any]]:
+    """Lease up to ``limit`` due analysis jobs to the calling worker.
+
+    A job is due when it is pending and past its backoff, or running with an
+    expired lease (its worker died). The claim is one ``UPDATE ... RETURNING``
+    guarded by the same condition, so concurrent workers never get the same
+    job; on Postgres the candidates are picked with ``SKIP LOCKED``.
+
+    Returns:
+        Dicts with ``job_id``, ``entry_id``, ``attempts`` (including this
+        one) and the entry ``content``.
+    """
+    job = models.AnalysisJob
+    candidates = (
+        select(job.id)
+        .where(_due_analysis_jobs(now))
+        .order_by(job.available_at, job.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    claimed = db.execute(
+        update(job)
+        .where(job.id.in_(candidates), _due_analysis_jobs(now))
+        .values(
+            status=ANALYSIS_RUNNING,
+            attempts=job.attempts + 1,
+            locked_until=now + lease_seconds,
+        )
+        .returning(job.id, job.entry_id, job.attempts),
+        execution_options={"synchronize_session": False},
+    ).all()
+    contents = dict(
+        db.execute(
+            select(models.DiaryEntry.id, models.DiaryEntry.content).where(
+                models.DiaryEntry.id.in_([entry_id for _, entry_id, _ in claimed])
+            )
+        ).all()
+    )
+    db.commit()
+    return [
+        {"job_id": job_id, "entry_id": entry_id, "attempts": attempts, "content": contents[entry_id]}
+        for job_id, entry_id, attempts in claimed
+        if entry_id in contents
+    ]
+
+
+def finish_analysis_jobs(
+    db: Session,
+    done: Sequence[Tuple[int, int, str]],
+    failed: Sequence[Tuple[int, int, str, Optional[int]]] = (),
+) -> None:
+    """Store the outcome of a batch of claimed jobs in one transaction.
+
+    Args:
+        done: ``(job_id, entry_id, analysis)`` of successful jobs; the
+            analysis is saved on the entry.
+        failed: ``(job_id, entry_id, error, retry_at)``; the job is retried
+            after ``retry_at`` (epoch seconds) or, when it is ``None``,
+            marked as failed for good.
+    """
+    entries = [
+        {"id": entry_id, "analysis": analysis, "analysis_status": ANALYSIS_DONE}
+        for _, entry_id, analysis in done
+    ] + [
+        {"id": entry_id, "analysis_status": ANALYSIS_FAILED}
+        for _, entry_id, _, retry_at in failed
+        if retry_at is None
+    ]
+    jobs = [
+        {"id": job_id, "status": ANALYSIS_DONE, "locked_until": None, "last_error": None}
+        for job_id, _, _ in done
+    ]
+    for job_id, _, error, retry_at in failed:
+        row = {"id": job_id, "locked_until": None, "last_error": error[:500]}
+        if retry_at is None:
+            row["status"] = ANALYSIS_FAILED
+        else:
+            row.update(status=ANALYSIS_PENDING, available_at=retry_at)
+        jobs.append(row)
+    # Bulk UPDATE berdasarkan primary key: satu executemany per tabel dan
+    # himpunan kolom yang sama.
+    for model, rows in ((models.DiaryEntry, entries), (models.AnalysisJob, jobs)):
+        by_columns: Dict[Tuple[str, ...], List[Dict[str, Any]]] = {}
+        for row in rows:
+            by_columns.setdefault(tuple(sorted(row)), []).append(row)
+        for group in by_columns.values():
+            db.execute(update(model), group)
+    db.commit()
+
+
+# -------------------------
+# PERCAKAPAN CHAT
+# -------------------------
+
+
+def _conversation_dict(row) -> Dict[str, Any]:
+    return {
+        "id": row.id,
+        "summary": row.summary,
+        "summarized_until": row.summarized_until,
+    }
+
+
+def create_conversation(db: Session, user_id: Optional[int], now: int) -> Dict[str, Any]:
+    """Start an empty conversation owned by ``user_id`` (``None``: no owner)."""
+    conversation = models.Conversation(
+        id=uuid.uuid4().hex, user_id=user_id, summarized_until=0, created_at=now, updated_at=now
+    )
+    db.add(conversation)
+    db.commit()
+    return _conversation_dict(conversation)
+
+
+def get_conversation(
+    db: Session, conversation_id: str, user_id: Optional[int] = None
+) -> Optional[Dict[str, Any]]:
+    """Return ``id``, ``summary`` and ``summarized_until`` if ``user_id`` owns it."""
+    conv = models.Conversation
+    row = db.execute(
+        select(conv.id, conv.summary, conv.summarized_until).where(
+            conv.id == conversation_id, _owned_by(conv.user_id, user_id)
+        )
+    ).first()
+    return _conversation_dict(row) if row is not None else None
+
+
+def get_conversation_messages(
+    db: Session, conversation_id: str, after_id: int = 0
+) -> List[Dict[str, Any]]:
+    """Messages of a conversation with an id above ``after_id``, oldest first."""
+    msg = models.ConversationMessage
+    rows = db.execute(
+        select(msg.id, msg.role, msg.content, msg.tokens, msg.created_at)
+        .where(msg.conversation_id == conversation_id, msg.id > after_id)
+        .order_by(msg.id)
+    )
+    return [dict(row._mapping) for row in rows]
+
+
+def add_conversation_messages(
+    db: Session, conversation_id: str, messages: Sequence[Tuple[str, str, int]], now: int
+) -> None:
+    """Append ``(role, content, tokens)`` messages in one transaction."""
+    db.execute(
+        insert(models.ConversationMessage),
+        [
+            {
+                "conversation_id": conversation_id,
+                "role": role,
+                "content": content,
+                "tokens": tokens,
+                "created_at": now,
+            }
+            for role, content, tokens in messages
+        ],
+    )
+    db.execute(
+        update(models.Conversation)
+        .where(models.Conversation.id == conversation_id)
+        .values(updated_at=now)
+    )
+    db.commit()
+
+
+def update_conversation_summary(
+    db: Session, conversation_id: str, summary: str, summarized_until: int, now: int
+) -> None:
+    """Store a new rolling summary covering messages up to ``summarized_until``.
+
+    A summary that covers fewer messages than the stored one (written by a
+    concurrent turn) is discarded.
+    """
+    conv = models.Conversation
+    db.execute(
+        update(conv)
+        .where(conv.id == conversation_id, conv.summarized_until < summarized_until)
+        .values(summary=summary, summarized_until=summarized_until, updated_at=now)
+    )
+    db.commit()
+
+
+def delete_conversation(
+    db: Session, conversation_id: str, user_id: Optional[int] = None
+) -> bool:
+    """Delete a conversation of ``user_id`` with its messages; False if not found."""
+    conv = models.Conversation
+    owned = db.execute(
+        select(conv.id).where(conv.id == conversation_id, _owned_by(conv.user_id, user_id))
+    ).first()
+    if owned is None:
         return False
-    return pwd_context.verify(password, user.hashed_password)
+    # Pesan dihapus eksplisit: SQLite hanya menjalankan ON DELETE CASCADE bila
+    # SQLITE_FOREIGN_KEYS dinyalakan, dan secara default tidak.
+    db.execute(
+        delete(models.ConversationMessage).where(
+            models.ConversationMessage.conversation_id == conversation_id
+        )
+    )
+    db.execute(delete(conv).where(conv.id == conversation_id))
+    db.commit()
+    return True
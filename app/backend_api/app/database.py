@@ -1,7 +1,10 @@
 # app/database.py: Inisialisasi koneksi database dan session SQLAlchemy
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session  # Import Session untuk tipe hint
+from typing import Any, Dict, Union
 import os
 
 # URL database. Untuk SQLite, ini adalah path ke file database.
@@ -11,15 +14,113 @@ import os
 # sama dengan tempat Anda menjalankan server.
 SQLALCHEMY_DATABASE_URL = os.getenv("SQLALCHEMY_DATABASE_URL", "sqlite:///./diary.db")
 
-# create_engine membuat instance engine database.
-# - connect_args={"check_same_thread": False}: Diperlukan untuk SQLite
-#   saat berinteraksi dengan multiple thread (seperti di FastAPI), untuk menghindari error.
-# - future=True: Mengaktifkan mode kompatibilitas SQLAlchemy 2.0 untuk perilaku yang lebih modern.
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL,
-    connect_args={"check_same_thread": False},
-    future=True,  # Mengaktifkan SQLAlchemy 2.0 style
-)
+
+def _env_flag(name: str, default: str) -> bool:
+    return os.getenv(name, default).lower() in ("1", "true", "yes")
+
+
+# Pool koneksi untuk server database (Postgres dan lainnya). SQLite file
+# memakai DB_POOL_SIZE/DB_MAX_OVERFLOW/DB_POOL_TIMEOUT saja; recycle dan
+# pre-ping tidak berguna untuk file lokal.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = _env_flag("DB_POOL_PRE_PING", "true")
+
+# PRAGMA SQLite yang dipasang di setiap koneksi baru. WAL membuat pembaca
+# tidak memblokir penulis (dan sebaliknya); busy_timeout membuat penulis
+# menunggu giliran alih-alih langsung gagal dengan "database is locked".
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_CACHE_SIZE_KIB = int(os.getenv("SQLITE_CACHE_SIZE_KIB", "20000"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+# Penegakan foreign key SQLite mati secara default (perilaku bawaan SQLite),
+# jadi menyalakannya mengubah apa yang ditolak database, bukan sekadar tuning.
+SQLITE_FOREIGN_KEYS = _env_flag("SQLITE_FOREIGN_KEYS", "false")
+
+
+def sqlite_pragmas() -> Dict[str, Any]:
+    """PRAGMA values applied to every new SQLite connection."""
+    return {
+        "journal_mode": SQLITE_JOURNAL_MODE,
+        "synchronous": SQLITE_SYNCHRONOUS,
+        "busy_timeout": SQLITE_BUSY_TIMEOUT_MS,
+        "cache_size": -SQLITE_CACHE_SIZE_KIB,
+        "mmap_size": SQLITE_MMAP_SIZE,
+        "foreign_keys": "ON" if SQLITE_FOREIGN_KEYS else "OFF",
+    }
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in sqlite_pragmas().items():
+            cursor.execute(f"PRAGMA {name}={value}")
+    finally:
+        cursor.close()
+
+
+def _is_memory_sqlite(url) -> bool:
+    return url.database in (None, "", ":memory:") or "mode=memory" in str(url)
+
+
+def engine_options(url: str) -> Dict[str, Any]:
+    """Keyword arguments for ``create_engine``/``create_async_engine`` of ``url``."""
+    parsed = make_url(url)
+    if parsed.get_backend_name() != "sqlite":
+        return {
+            "pool_size": DB_POOL_SIZE,
+            "max_overflow": DB_MAX_OVERFLOW,
+            "pool_timeout": DB_POOL_TIMEOUT,
+            "pool_recycle": DB_POOL_RECYCLE,
+            "pool_pre_ping": DB_POOL_PRE_PING,
+        }
+    # - check_same_thread=False: koneksi SQLite dipakai bergantian oleh
+    #   thread berbeda (FastAPI menjalankan route sync di thread pool).
+    options: Dict[str, Any] = {"connect_args": {"check_same_thread": False}}
+    if not _is_memory_sqlite(parsed):
+        # Database in-memory memakai pool bawaan SQLAlchemy (satu koneksi).
+        options.update(
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+        )
+    return options
+
+
+def _listen_for_pragmas(sync_engine: Engine) -> None:
+    if sync_engine.dialect.name == "sqlite":
+        event.listen(sync_engine, "connect", _set_sqlite_pragmas)
+
+
+def create_db_engine(url: str, **kwargs: Any) -> Engine:
+    """Create a sync engine with the configured pool and SQLite PRAGMAs."""
+    db_engine = create_engine(url, **{**engine_options(url), **kwargs})
+    _listen_for_pragmas(db_engine)
+    return db_engine
+
+
+def create_async_db_engine(url: str, **kwargs: Any) -> AsyncEngine:
+    """Async counterpart of :func:`create_db_engine`."""
+    db_engine = create_async_engine(url, **{**engine_options(url), **kwargs})
+    _listen_for_pragmas(db_engine.sync_engine)
+    return db_engine
+
+
+def pool_stats(db_engine: Union[Engine, AsyncEngine]) -> Dict[str, Any]:
+    """Return a snapshot of the connection pool of ``db_engine``."""
+    pool = db_engine.pool
+    stats: Dict[str, Any] = {"pool": type(pool).__name__}
+    for name in ("size", "checkedin", "checkedout", "overflow"):
+        method = getattr(pool, name, None)
+        if callable(method):
+            stats[name] = method()
+    return stats
+
+
+engine = create_db_engine(SQLALCHEMY_DATABASE_URL)
 
 # Base adalah kelas dasar tempat model database kita akan mewarisi.
 # Ini adalah bagian dari deklarasi ORM SQLAlchemy.
@@ -46,3 +147,47 @@ def get_db():
         yield db  # Mengembalikan sesi database dan menjaga agar tetap terbuka
     finally:
         db.close()  # Menutup sesi setelah request selesai (penting!)
+
+
+# -------------------------
+# JALUR ASYNC
+# -------------------------
+
+# Driver async untuk setiap backend: aiosqlite untuk SQLite lokal dan asyncpg
+# untuk Postgres. Jalur sync di atas tetap tersedia untuk skrip dan tes.
+_ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+}
+
+
+def to_async_url(url: str) -> str:
+    """Return ``url`` rewritten to use the async driver of its backend."""
+    parsed = make_url(url)
+    driver = _ASYNC_DRIVERS.get(parsed.get_backend_name())
+    if driver is None or parsed.drivername in _ASYNC_DRIVERS.values():
+        return url
+    return parsed.set(drivername=driver).render_as_string(hide_password=False)
+
+
+# URL async bisa diatur terpisah lewat ``SQLALCHEMY_ASYNC_DATABASE_URL``;
+# jika tidak, diturunkan dari ``SQLALCHEMY_DATABASE_URL``.
+ASYNC_DATABASE_URL = os.getenv(
+    "SQLALCHEMY_ASYNC_DATABASE_URL", to_async_url(SQLALCHEMY_DATABASE_URL)
+)
+
+async_engine = create_async_db_engine(ASYNC_DATABASE_URL)
+
+# expire_on_commit=False: objek tetap bisa dibaca setelah commit tanpa lazy
+# load, yang tidak diizinkan di luar konteks async.
+AsyncSessionLocal = async_sessionmaker(
+    bind=async_engine,
+    autoflush=False,
+    expire_on_commit=False,
+)
+
+
+# Dependency: sesi database async per permintaan untuk route ``async def``.
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
@@ -1,33 +1,65 @@
 # app/main.py
 
-from fastapi import FastAPI, Depends, HTTPException, status, Response
-from sqlalchemy.orm import Session
-from typing import List
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, status, Response
+from fastapi.responses import ORJSONResponse, PlainTextResponse, StreamingResponse
+from fastapi.security import HTTPAuthorizationCredentials
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Literal, Optional
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 import logging
+import time
+
+import orjson
 
 # Load environment variables
 load_dotenv()
 
 # Import internal modules
-from . import models, schemas, crud, openrouter
-from .database import engine, get_db
+from . import models, schemas, analysis, async_crud, auth, cache, conversations, crud, metrics, openrouter, openrouter_client, passwords, ratelimit, replicas, sentiment, stats
+from .database import async_engine, engine, get_async_db, pool_stats
+from .replicas import get_read_db
 from .ai_utils import (
     caption_image_with_openrouter,
     generate_articles_with_openrouter,
     chat_with_openrouter,
+    stream_chat_with_openrouter,
     MissingAPIKeyError,
     NetworkError,
     InvalidResponseError,
+    UpstreamBusyError,
+    ARTICLES_PROMPT_VERSION,
+    CAPTION_PROMPT_VERSION,
 )
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Membuat klien OpenRouter, pool hashing password dan worker analisis saat startup, menutupnya saat shutdown"""
+    openrouter_client.init_openrouter_client()
+    passwords.init_password_pool()
+    analysis.start_worker()
+    try:
+        yield
+    finally:
+        await analysis.stop_worker()
+        await openrouter_client.close_openrouter_client()
+        passwords.shutdown_password_pool()
+
+
 # Initialize FastAPI application
 app = FastAPI(
     title="Diary Depresiku API",
     description="API untuk mencatat suasana hati, menganalisis emosi, dan mendapatkan saran artikel berbasis AI.",
     version="1.0.0",
+    lifespan=lifespan,
 )
 
+# Latensi per route serta waktu DB/upstream per permintaan, lihat /metrics
+app.add_middleware(metrics.MetricsMiddleware)
+for _engine in (engine, async_engine, *replicas.replica_engines):
+    metrics.instrument_engine(getattr(_engine, "sync_engine", _engine))
+
 # Create tables if not exist
 models.Base.metadata.create_all(bind=engine)
 
@@ -35,61 +67,310 @@ models.Base.metadata.create_all(bind=engine)
 # AUTENTIKASI
 # -------------------------
 
+def _password_pool_busy(e: passwords.PasswordHashBusyError) -> HTTPException:
+    """Respons 503 saat antrean hashing password sudah penuh"""
+    return HTTPException(
+        status_code=503,
+        detail=f"Server sedang sibuk: {str(e)}",
+        headers={"Retry-After": "1"},
+    )
+
+
 @app.post("/register/", status_code=status.HTTP_201_CREATED)
-async def register_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
+async def register_user(user: schemas.UserCreate, db: AsyncSession = Depends(get_async_db)):
     """Registrasi pengguna baru"""
-    if crud.get_user_by_email(db, user.email):
+    if await async_crud.get_user_by_email(db, user.email):
         raise HTTPException(status_code=400, detail="Email sudah terdaftar")
-    crud.create_user(db, user)
+    try:
+        await async_crud.create_user(db, user)
+    except passwords.PasswordHashBusyError as e:
+        raise _password_pool_busy(e)
     return {"message": "User created"}
 
 
 @app.post("/login/", response_model=schemas.Token)
-async def login_user(user: schemas.UserLogin, db: Session = Depends(get_db)):
+async def login_user(user: schemas.UserLogin, db: AsyncSession = Depends(get_async_db)):
     """Login dan autentikasi pengguna"""
-    if not crud.authenticate_user(db, user.email, user.password):
+    try:
+        authenticated = await async_crud.authenticate_user(db, user.email, user.password)
+    except passwords.PasswordHashBusyError as e:
+        raise _password_pool_busy(e)
+    if authenticated is None:
         raise HTTPException(status_code=400, detail="Email atau password salah")
-    return {"token": "dummy"}  # Ganti dengan sistem token nyata jika perlu
+    token, expires_at = auth.create_access_token(authenticated.id)
+    return {"token": token, "token_type": "bearer", "expires_at": expires_at}
+
+
+@app.post("/logout/", status_code=status.HTTP_204_NO_CONTENT)
+async def logout_user(
+    current_user: auth.CurrentUser = Depends(auth.get_current_user),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Mencabut token yang dipakai pada permintaan ini"""
+    await async_crud.revoke_token(
+        db, current_user.jti, current_user.expires_at, int(time.time())
+    )
+    auth.revocations.add(current_user.jti, current_user.expires_at)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 # -------------------------
 # ENTRI DIARY
 # -------------------------
 
 @app.post("/entries/", response_model=schemas.DiaryEntryResponse, status_code=201)
-async def create_diary_entry(entry: schemas.DiaryEntryCreate, db: Session = Depends(get_db)):
-    """Menyimpan entri suasana hati harian"""
+async def create_diary_entry(
+    entry: schemas.DiaryEntryCreate,
+    request: Request,
+    response: Response,
+    owner_id: Optional[int] = Depends(auth.get_owner_id),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Menyimpan entri suasana hati harian.
+
+    Dengan ``ANALYSIS_ON_CREATE`` entri ikut diantrekan untuk analisis AI di
+    latar belakang; hasilnya muncul di ``analysis`` setelah selesai.
+    """
     try:
-        db_entry = crud.create_diary_entry(db, entry)
+        db_entry = await async_crud.create_diary_entry(
+            db, entry, owner_id, analyze=analysis.ANALYSIS_ON_CREATE
+        )
+        stats.invalidate([entry.timestamp], owner_id)
+        replicas.mark_write(request, response)
+        analysis.notify()
         return schemas.DiaryEntryResponse.model_validate(db_entry)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Gagal menyimpan entri: {str(e)}")
 
 
-@app.get("/entries/", response_model=List[schemas.DiaryEntryResponse])
-async def list_diary_entries(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    """Menampilkan seluruh entri diary"""
-    entries = crud.get_diary_entries(db, skip=skip, limit=limit)
-    return [schemas.DiaryEntryResponse.model_validate(e) for e in entries]
+@app.post(
+    "/entries/batch",
+    response_model=List[schemas.DiaryEntryResponse],
+    status_code=201,
+)
+async def create_diary_entries_batch(
+    batch: schemas.DiaryEntryBatchCreate,
+    request: Request,
+    response: Response,
+    owner_id: Optional[int] = Depends(auth.get_owner_id),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Menyimpan banyak entri sekaligus (sinkronisasi offline) dalam satu transaksi.
+
+    Entri dengan ``client_id`` yang sudah pernah tersimpan tidak diduplikasi;
+    respons berisi satu entri untuk setiap item permintaan sesuai urutannya.
+    """
+    try:
+        db_entries = await async_crud.create_diary_entries(
+            db, batch.entries, owner_id, analyze=analysis.ANALYSIS_ON_CREATE
+        )
+        stats.invalidate((e.timestamp for e in batch.entries), owner_id)
+        replicas.mark_write(request, response)
+        analysis.notify()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Gagal menyimpan entri: {str(e)}")
+    return [schemas.DiaryEntryResponse.model_validate(e) for e in db_entries]
+
+
+@app.get(
+    "/entries/",
+    response_model=List[schemas.DiaryEntryResponse],
+    response_class=ORJSONResponse,
+)
+async def list_diary_entries(
+    skip: int = 0,
+    limit: int = 100,
+    cursor: Optional[str] = None,
+    activity: Optional[str] = None,
+    owner_id: Optional[int] = Depends(auth.get_owner_id),
+    db: AsyncSession = Depends(get_read_db),
+):
+    """Menampilkan entri diary milik pengguna.
 
+    Jika ``cursor`` diberikan, halaman dimulai setelah posisi cursor tersebut
+    (keyset pagination) dan ``skip`` diabaikan. Cursor halaman berikutnya
+    dikirim lewat header ``X-Next-Cursor`` selama halaman masih penuh.
+    Jika ``activity`` diberikan, hanya entri dengan aktivitas tersebut.
 
-@app.get("/entries/{entry_id}", response_model=schemas.DiaryEntryResponse)
-async def get_diary_entry(entry_id: int, db: Session = Depends(get_db)):
-    """Menampilkan satu entri diary berdasarkan ID"""
-    entry = crud.get_diary_entry(db, entry_id)
+    Baris dari database sudah berbentuk respons, jadi langsung diserialisasi
+    dengan orjson tanpa validasi ulang lewat ``response_model``.
+    """
+    try:
+        position = crud.decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    entries = await async_crud.get_diary_entries(
+        db,
+        skip=skip,
+        limit=limit,
+        cursor=position,
+        activity=activity,
+        user_id=owner_id,
+    )
+    headers = {}
+    if entries and len(entries) == limit:
+        last = entries[-1]
+        headers["X-Next-Cursor"] = crud.encode_cursor(last["timestamp"], last["id"])
+    return ORJSONResponse(entries, headers=headers)
+
+
+@app.get("/entries/export")
+async def export_diary_entries(
+    batch_size: int = Query(500, ge=1, le=5000),
+    owner_id: Optional[int] = Depends(auth.get_owner_id),
+    db: AsyncSession = Depends(get_read_db),
+):
+    """Mengekspor seluruh entri pengguna sebagai NDJSON secara streaming per batch"""
+
+    async def generate():
+        # Sesi dari dependency sudah ditutup sebelum body dikirim, sehingga
+        # generator ini yang bertanggung jawab menutup koneksi yang dipakai.
+        try:
+            async for batch in async_crud.iter_diary_entry_batches(
+                db, batch_size=batch_size, user_id=owner_id
+            ):
+                yield b"".join(orjson.dumps(entry) + b"\n" for entry in batch)
+        finally:
+            await db.close()
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+
+@app.get("/entries/search", response_model=List[schemas.DiaryEntrySearchHit])
+async def search_diary_entries(
+    response: Response,
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = None,
+    owner_id: Optional[int] = Depends(auth.get_owner_id),
+    db: AsyncSession = Depends(get_read_db),
+):
+    """Mencari entri pengguna berdasarkan kata di isinya, paling relevan lebih dulu.
+
+    Setiap kata di ``q`` harus muncul di entri. ``highlight`` berisi cuplikan
+    dengan kata yang cocok dibungkus ``<mark>``. Cursor halaman berikutnya
+    dikirim lewat header ``X-Next-Cursor`` selama halaman masih penuh.
+    """
+    try:
+        position = crud.decode_search_cursor(cursor) if cursor else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        hits = await async_crud.search_diary_entries(
+            db, q, limit=limit, cursor=position, user_id=owner_id
+        )
+    except crud.SearchNotSupportedError as e:
+        raise HTTPException(status_code=501, detail=str(e))
+    if hits and len(hits) == limit:
+        last = hits[-1]
+        response.headers["X-Next-Cursor"] = crud.encode_search_cursor(
+            last["score"], last["id"]
+        )
+    return [schemas.DiaryEntrySearchHit.model_validate(hit) for hit in hits]
+
+
+@app.get(
+    "/entries/{entry_id}",
+    response_model=schemas.DiaryEntryResponse,
+    response_class=ORJSONResponse,
+)
+async def get_diary_entry(
+    entry_id: int,
+    owner_id: Optional[int] = Depends(auth.get_owner_id),
+    db: AsyncSession = Depends(get_read_db),
+):
+    """Menampilkan satu entri diary milik pengguna berdasarkan ID"""
+    entry = await async_crud.get_diary_entry(db, entry_id, owner_id)
     if entry is None:
         raise HTTPException(status_code=404, detail="Entri tidak ditemukan")
-    return schemas.DiaryEntryResponse.model_validate(entry)
+    return ORJSONResponse(entry)
 
 # -------------------------
 # ANALISIS EMOSI (AI)
 # -------------------------
 
-@app.post("/analyze/", response_model=schemas.AnalyzeResponse)
-def analyze_entry(request: schemas.AnalyzeRequest):
-    """Menganalisis teks untuk mendeteksi suasana hati menggunakan OpenRouter"""
+def _upstream_busy(e: UpstreamBusyError) -> HTTPException:
+    """Respons 503 saat antrean panggilan OpenRouter sudah penuh"""
+    return HTTPException(
+        status_code=503,
+        detail=f"Layanan AI sedang sibuk: {str(e)}",
+        headers={"Retry-After": "1"},
+    )
+
+
+def _cache_bypass(http_request: Request) -> bool:
+    """Cache dilewati bila klien mengirim ``X-Cache-Bypass: 1`` atau ``Cache-Control: no-cache``"""
+    cache_control = http_request.headers.get("Cache-Control", "")
+    return http_request.headers.get("X-Cache-Bypass") == "1" or "no-cache" in cache_control
+
+
+async def _cached_ai_call(
+    namespace: str,
+    template_version: str,
+    normalized_input: str,
+    compute,
+    http_request: Request,
+    response: Response,
+    credentials: Optional[HTTPAuthorizationCredentials],
+):
+    """Menjalankan ``compute`` lewat cache respons AI dan menandai header ``X-Cache``
+
+    Rate limit AI hanya dikenakan saat cache meleset dan OpenRouter benar-benar
+    dipanggil; jawaban dari cache tidak menghabiskan token.
+    """
+
+    async def limited_compute():
+        await ratelimit.limit_ai_requests(http_request, credentials)
+        return await compute()
+
+    result, cache_status = await cache.get_or_compute_ai(
+        namespace,
+        template_version,
+        normalized_input,
+        limited_compute,
+        bypass=_cache_bypass(http_request),
+    )
+    response.headers["X-Cache"] = cache_status
+    return result
+
+
+@app.post(
+    "/analyze/",
+    response_model=schemas.AnalyzeResponse,
+    dependencies=[Depends(openrouter_client.apply_request_deadline)],
+)
+async def analyze_entry(
+    request: schemas.AnalyzeRequest,
+    http_request: Request,
+    response: Response,
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(auth.bearer_scheme),
+):
+    """Menganalisis teks untuk mendeteksi suasana hati.
+
+    Klasifikator lokal menjawab lebih dulu; OpenRouter hanya dipanggil jika
+    keyakinannya di bawah ``SENTIMENT_CONFIDENCE_THRESHOLD``. Rate limit AI
+    hanya berlaku untuk panggilan OpenRouter tersebut (bukan jawaban cache).
+    """
+    prediction = sentiment.classify(request.text)
+    local = {"mood": prediction.mood, "confidence": prediction.confidence}
+    if prediction.is_confident():
+        metrics.sentiment_predictions.inc("local")
+        return {"analysis": sentiment.describe(prediction), "source": "local", **local}
+    metrics.sentiment_predictions.inc("llm")
     try:
-        result = openrouter.analyze_text(request.text)
-        return {"analysis": result}
+        result = await _cached_ai_call(
+            "analyze",
+            openrouter.ANALYZE_PROMPT_VERSION,
+            cache.normalize_text(request.text),
+            lambda: openrouter.analyze_text(request.text),
+            http_request,
+            response,
+            credentials,
+        )
+        return {"analysis": result, "source": "llm", **local}
+    except HTTPException:
+        raise
+    except UpstreamBusyError as e:
+        raise _upstream_busy(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Gagal menganalisis teks: {e}")
 
@@ -97,12 +378,118 @@ def analyze_entry(request: schemas.AnalyzeRequest):
 # CHAT AI
 # -------------------------
 
-@app.post("/chat/")
-def chat(request: schemas.ChatRequest):
-    """Kirim pesan pengguna ke OpenRouter dan terima balasan teks."""
+def _sse_event(data: str, event: Optional[str] = None) -> str:
+    """Format satu event Server-Sent Events (data multi-baris didukung)"""
+    lines = [f"event: {event}"] if event else []
+    lines.extend(f"data: {line}" for line in data.split("\n"))
+    return "\n".join(lines) + "\n\n"
+
+
+async def _stream_chat_events(first_token: str, tokens, on_done=None):
+    parts = [first_token]
+    if first_token:
+        yield _sse_event(first_token)
+    try:
+        async for token in tokens:
+            parts.append(token)
+            yield _sse_event(token)
+    except Exception as e:
+        # Status HTTP sudah terkirim; kabarkan kegagalan sebagai event.
+        logging.error("[OpenRouter stream error] %s", e)
+        yield _sse_event(str(e), event="error")
+        return
+    if on_done is not None:
+        try:
+            await on_done("".join(parts))
+        except Exception as e:
+            # Balasan sudah terkirim utuh, tetapi gilirannya tidak tersimpan.
+            logging.error("[Chat stream] gagal menyimpan giliran: %s", e)
+            yield _sse_event("Gagal menyimpan percakapan", event="error")
+            return
+    yield _sse_event("", event="done")
+
+
+async def _chat_conversation(
+    conversation_id: str,
+    credentials: Optional[HTTPAuthorizationCredentials],
+    db: AsyncSession,
+):
+    """Percakapan milik pemanggil; 404 jika tidak ada atau milik orang lain"""
+    # Identitas hanya diperiksa bila percakapan dipakai, sehingga /chat/ tanpa
+    # percakapan tetap terbuka untuk klien tanpa login.
+    owner_id = await auth.get_owner_id(await auth.get_optional_user(credentials, db))
+    conversation = await async_crud.get_conversation(db, conversation_id, owner_id)
+    if conversation is None:
+        raise HTTPException(status_code=404, detail="Percakapan tidak ditemukan")
+    return conversation
+
+
+@app.post(
+    "/chat/",
+    dependencies=[
+        Depends(ratelimit.limit_ai_requests),
+        Depends(openrouter_client.apply_request_deadline),
+    ],
+)
+async def chat(
+    request: schemas.ChatRequest,
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(auth.bearer_scheme),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Kirim pesan pengguna ke OpenRouter dan terima balasan teks.
+
+    Header ``X-Chat-Pipeline`` mencatat jalur yang dipakai (``single``,
+    ``two_step`` atau ``fallback``). Dengan ``stream=true`` balasan dikirim
+    per token sebagai Server-Sent Events, diakhiri event ``done`` (atau
+    ``error`` bila stream terputus atau giliran gagal disimpan).
+
+    Dengan ``conversation_id`` riwayat diambil dari percakapan di server
+    (dibatasi ``CHAT_HISTORY_TOKEN_BUDGET`` token, giliran lama diringkas)
+    dan giliran ini disimpan setelah balasan lengkap. Tanpanya ``history``
+    dari klien dipakai setelah dipotong ke anggaran yang sama.
+    """
+    conversation = None
+    if request.conversation_id is not None:
+        conversation = await _chat_conversation(request.conversation_id, credentials, db)
     try:
-        result = chat_with_openrouter(request.text, history=request.history, mood=request.mood)
-        return Response(content=result, media_type="text/plain")
+        if conversation is not None:
+            history = await conversations.load_history(db, conversation)
+        else:
+            history = conversations.trim_history(request.history)
+
+        async def save_turn(reply: str) -> None:
+            if conversation is not None:
+                await conversations.record_turn(db, conversation["id"], request.text, reply)
+
+        if request.stream:
+            pipeline, tokens = await stream_chat_with_openrouter(
+                request.text, history=history, mood=request.mood
+            )
+            # Token pertama ditunggu di sini agar kegagalan awal tetap
+            # dilaporkan dengan status HTTP yang sesuai.
+            first_token = await anext(tokens, "")
+            # Sesi dependency sudah ditutup saat body dikirim; AsyncSession
+            # yang ditutup tetap bisa dipakai lagi untuk menyimpan giliran.
+            return StreamingResponse(
+                _stream_chat_events(first_token, tokens, save_turn),
+                media_type="text/event-stream",
+                headers={
+                    "Cache-Control": "no-cache",
+                    "X-Accel-Buffering": "no",
+                    "X-Chat-Pipeline": pipeline,
+                },
+            )
+        result = await chat_with_openrouter(
+            request.text, history=history, mood=request.mood
+        )
+        await save_turn(result.reply)
+        return Response(
+            content=result.reply,
+            media_type="text/plain",
+            headers={"X-Chat-Pipeline": result.pipeline},
+        )
+    except UpstreamBusyError as e:
+        raise _upstream_busy(e)
     except MissingAPIKeyError as e:
         raise HTTPException(status_code=500, detail=f"API Key tidak ditemukan: {str(e)}")
     except NetworkError as e:
@@ -110,15 +497,77 @@ def chat(request: schemas.ChatRequest):
     except InvalidResponseError as e:
         raise HTTPException(status_code=502, detail=f"OpenRouter error: {str(e)}")
 
+
+@app.post("/conversations/", response_model=schemas.ConversationResponse, status_code=201)
+async def create_conversation(
+    owner_id: Optional[int] = Depends(auth.get_owner_id),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Memulai percakapan yang riwayatnya disimpan di server untuk /chat/"""
+    conversation = await async_crud.create_conversation(db, owner_id, int(time.time()))
+    return {"id": conversation["id"]}
+
+
+@app.get("/conversations/{conversation_id}", response_model=schemas.ConversationResponse)
+async def read_conversation(
+    conversation_id: str,
+    owner_id: Optional[int] = Depends(auth.get_owner_id),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Ringkasan dan seluruh giliran sebuah percakapan"""
+    conversation = await async_crud.get_conversation(db, conversation_id, owner_id)
+    if conversation is None:
+        raise HTTPException(status_code=404, detail="Percakapan tidak ditemukan")
+    messages = await async_crud.get_conversation_messages(db, conversation_id)
+    return {"id": conversation["id"], "summary": conversation["summary"], "messages": messages}
+
+
+@app.delete("/conversations/{conversation_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_conversation(
+    conversation_id: str,
+    owner_id: Optional[int] = Depends(auth.get_owner_id),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Menghapus percakapan beserta semua pesannya"""
+    if not await async_crud.delete_conversation(db, conversation_id, owner_id):
+        raise HTTPException(status_code=404, detail="Percakapan tidak ditemukan")
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
 # -------------------------
 # ARTIKEL OTOMATIS (AI)
 # -------------------------
 
-@app.post("/articles/", response_model=List[schemas.ArticleResponse])
-def generate_articles(request: schemas.ArticleRequest):
+@app.post(
+    "/articles/",
+    response_model=List[schemas.ArticleResponse],
+    dependencies=[Depends(openrouter_client.apply_request_deadline)],
+)
+async def generate_articles(
+    request: schemas.ArticleRequest,
+    http_request: Request,
+    response: Response,
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(auth.bearer_scheme),
+):
     """Menyarankan artikel berdasarkan isi jurnal atau emosi pengguna"""
+
+    async def compute():
+        articles = await generate_articles_with_openrouter(request.text)
+        return [a.model_dump() for a in articles]
+
     try:
-        return generate_articles_with_openrouter(request.text)
+        return await _cached_ai_call(
+            "articles",
+            ARTICLES_PROMPT_VERSION,
+            cache.normalize_text(request.text),
+            compute,
+            http_request,
+            response,
+            credentials,
+        )
+    except HTTPException:
+        raise
+    except UpstreamBusyError as e:
+        raise _upstream_busy(e)
     except MissingAPIKeyError as e:
         raise HTTPException(status_code=500, detail=f"API Key tidak ditemukan: {str(e)}")
     except (NetworkError, InvalidResponseError) as e:
@@ -130,12 +579,33 @@ def generate_articles(request: schemas.ArticleRequest):
 # CAPTION GAMBAR (AI)
 # -------------------------
 
-@app.post("/openrouter_caption/", response_model=schemas.OpenRouterCaptionResponse)
-async def caption_image(request: schemas.OpenRouterCaptionRequest):
+@app.post(
+    "/openrouter_caption/",
+    response_model=schemas.OpenRouterCaptionResponse,
+    dependencies=[Depends(openrouter_client.apply_request_deadline)],
+)
+async def caption_image(
+    request: schemas.OpenRouterCaptionRequest,
+    http_request: Request,
+    response: Response,
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(auth.bearer_scheme),
+):
     """Menghasilkan deskripsi gambar menggunakan AI"""
     try:
-        caption = await caption_image_with_openrouter(request.image_url)
+        caption = await _cached_ai_call(
+            "caption",
+            CAPTION_PROMPT_VERSION,
+            cache.normalize_url(request.image_url),
+            lambda: caption_image_with_openrouter(request.image_url),
+            http_request,
+            response,
+            credentials,
+        )
         return {"caption": caption}
+    except HTTPException:
+        raise
+    except UpstreamBusyError as e:
+        raise _upstream_busy(e)
     except MissingAPIKeyError as e:
         raise HTTPException(status_code=500, detail=f"API Key tidak ditemukan: {str(e)}")
     except NetworkError as e:
@@ -148,7 +618,76 @@ async def caption_image(request: schemas.OpenRouterCaptionRequest):
 # -------------------------
 
 @app.get("/stats/", response_model=schemas.MoodStatsResponse)
-async def get_mood_stats(db: Session = Depends(get_db)):
-    """Menghitung statistik suasana hati dari seluruh entri"""
-    stats = crud.get_mood_stats(db)
-    return {"stats": stats}
+async def get_mood_stats(
+    owner_id: Optional[int] = Depends(auth.get_owner_id),
+    db: AsyncSession = Depends(get_read_db),
+):
+    """Menghitung statistik suasana hati dari seluruh entri pengguna"""
+    mood_stats = await async_crud.get_mood_stats(db, owner_id)
+    return {"stats": mood_stats}
+
+
+@app.get("/stats/activities", response_model=List[schemas.ActivityMoodStats])
+async def get_activity_mood_stats(
+    activity: Optional[str] = None,
+    owner_id: Optional[int] = Depends(auth.get_owner_id),
+    db: AsyncSession = Depends(get_read_db),
+):
+    """Distribusi mood per aktivitas, aktivitas terbanyak lebih dulu"""
+    per_activity = await async_crud.get_activity_mood_stats(db, activity, owner_id)
+    result = [
+        {"activity": name, "total": sum(counts.values()), "stats": counts}
+        for name, counts in per_activity.items()
+    ]
+    result.sort(key=lambda item: (-item["total"], item["activity"]))
+    return result
+
+
+@app.get("/stats/timeseries", response_model=schemas.MoodTimeseriesResponse)
+async def get_mood_timeseries(
+    bucket: Literal["day", "week", "month"] = "day",
+    start: int = Query(..., alias="from", description="Awal rentang (timestamp ms, inklusif)"),
+    end: int = Query(..., alias="to", description="Akhir rentang (timestamp ms, inklusif)"),
+    owner_id: Optional[int] = Depends(auth.get_owner_id),
+    db: AsyncSession = Depends(get_read_db),
+):
+    """Menghitung jumlah mood per hari, minggu (mulai Senin) atau bulan (UTC)"""
+    try:
+        buckets = await stats.mood_timeseries(db, bucket, start, end, user_id=owner_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "bucket": bucket,
+        "buckets": [
+            {"start": first, "end": following, "stats": counts}
+            for first, following, counts in buckets
+        ],
+    }
+
+# -------------------------
+# KESEHATAN SERVER
+# -------------------------
+
+@app.get("/health/db")
+async def database_health():
+    """Statistik pool koneksi database (sync, async dan replika) untuk pemantauan"""
+    return {
+        "sync": pool_stats(engine),
+        "async": pool_stats(async_engine),
+        "replicas": replicas.replica_pool_stats(),
+    }
+
+
+@app.get("/health/upstream")
+async def upstream_health():
+    """Urutan model OpenRouter dan status circuit breaker tiap model"""
+    return {
+        "models": openrouter_client.model_chain(),
+        "circuits": openrouter_client.circuit_states(),
+    }
+
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    """Metrik proses ini dalam format teks Prometheus"""
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
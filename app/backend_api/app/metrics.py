@@ -0,0 +1,430 @@
+"""In-process metrics exposed in the Prometheus text format on ``/metrics``.
+
+Four sources feed the registry:
+
+* :class:`MetricsMiddleware` times every HTTP request per route template.
+* :func:`instrument_engine` hooks SQLAlchemy cursor events, so each query is
+  timed and also attributed to the request that issued it. Per-request
+  query counts, DB time and upstream time are recorded next to the request
+  latency, which tells whether a slow route waits on the database or on
+  OpenRouter.
+* :func:`observe_upstream_call` is called by ``openrouter_client`` for every
+  completion attempt with its model, operation, latency, token usage and
+  error class; retries, fallbacks, hedges and opened circuits have their own
+  counters.
+* Other modules increment their counters directly, e.g. the AI response
+  cache and request coalescing count their hits, misses and shared calls in
+  ``ai_cache_requests_total`` and ``singleflight_requests_total``.
+
+Values live in this process only; with several uvicorn workers each worker
+exposes its own series and Prometheus sums them per scrape target.
+"""
+import bisect
+import contextvars
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    """Monotonic counter with a fixed set of label names."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values: Dict[LabelValues, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def samples(self) -> Iterable[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            yield f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}"
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+
+class Histogram:
+    """Cumulative histogram with a fixed set of label names and buckets."""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets)
+        # Per label: hitungan per bucket (non-kumulatif, + satu untuk +Inf), jumlah.
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+            series[0][index] += 1
+            series[1][0] += value
+
+    def count(self, *labels: str) -> int:
+        series = self._values.get(labels)
+        return sum(series[0]) if series else 0
+
+    def sum(self, *labels: str) -> float:
+        series = self._values.get(labels)
+        return series[1][0] if series else 0.0
+
+    def samples(self) -> Iterable[str]:
+        with self._lock:
+            items = sorted((k, (list(c), s[0])) for k, (c, s) in self._values.items())
+        names = self.label_names + ("le",)
+        for labels, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = _format_value(bound)
+                yield f"{self.name}_bucket{_format_labels(names, labels + (le,))} {cumulative}"
+            base = _format_labels(self.label_names, labels)
+            yield f"{self.name}_sum{base} {_format_value(total)}"
+            yield f"{self.name}_count{base} {cumulative}"
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: Dict[str, "Counter | Histogram"] = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+    def clear(self) -> None:
+        for metric in self._metrics.values():
+            metric.clear()
+
+
+registry = Registry()
+
+http_requests = registry.register(
+    Counter("http_requests_total", "HTTP requests handled.", ("method", "route", "status"))
+)
+http_request_duration = registry.register(
+    Histogram(
+        "http_request_duration_seconds",
+        "HTTP request latency until the response body is sent.",
+        ("method", "route"),
+    )
+)
+http_request_db_queries = registry.register(
+    Histogram(
+        "http_request_db_queries",
+        "SQL statements executed per HTTP request.",
+        ("method", "route"),
+        COUNT_BUCKETS,
+    )
+)
+http_request_db_duration = registry.register(
+    Histogram(
+        "http_request_db_duration_seconds",
+        "Time spent in SQL statements per HTTP request.",
+        ("method", "route"),
+    )
+)
+http_request_upstream_duration = registry.register(
+    Histogram(
+        "http_request_upstream_duration_seconds",
+        "Time spent waiting on OpenRouter per HTTP request.",
+        ("method", "route"),
+    )
+)
+db_query_duration = registry.register(
+    Histogram("db_query_duration_seconds", "SQL statement latency.", ("engine",), QUERY_BUCKETS)
+)
+upstream_request_duration = registry.register(
+    Histogram(
+        "openrouter_request_duration_seconds",
+        "OpenRouter completion latency, including the wait for an upstream slot.",
+        ("model", "operation", "outcome"),
+    )
+)
+upstream_tokens = registry.register(
+    Counter(
+        "openrouter_tokens_total",
+        "Tokens reported by OpenRouter usage.",
+        ("model", "operation", "kind"),
+    )
+)
+upstream_errors = registry.register(
+    Counter(
+        "openrouter_errors_total",
+        "Failed OpenRouter completions by exception class.",
+        ("model", "operation", "error"),
+    )
+)
+upstream_retries = registry.register(
+    Counter(
+        "openrouter_retries_total",
+        "OpenRouter attempts retried on the same model after a transient error.",
+        ("model", "operation"),
+    )
+)
+upstream_fallbacks = registry.register(
+    Counter(
+        "openrouter_fallbacks_total",
+        "OpenRouter calls moved to a fallback model.",
+        ("model", "operation"),
+    )
+)
+upstream_hedged = registry.register(
+    Counter(
+        "openrouter_hedged_requests_total",
+        "Second attempts sent because the first one exceeded the model's p95.",
+        ("model", "operation"),
+    )
+)
+upstream_circuit_opened = registry.register(
+    Counter(
+        "openrouter_circuit_opened_total",
+        "Times a model's circuit breaker opened.",
+        ("model",),
+    )
+)
+sentiment_predictions = registry.register(
+    Counter(
+        "sentiment_predictions_total",
+        "Sentiment analyses by who answered them (local classifier or llm).",
+        ("source",),
+    )
+)
+chat_history_compactions = registry.register(
+    Counter(
+        "chat_history_compactions_total",
+        "Rolling conversation summaries regenerated because the history budget overflowed.",
+        ("outcome",),
+    )
+)
+ai_cache_requests = registry.register(
+    Counter(
+        "ai_cache_requests_total",
+        "AI response cache lookups by namespace and result (hit, miss or bypass).",
+        ("namespace", "result"),
+    )
+)
+singleflight_requests = registry.register(
+    Counter(
+        "singleflight_requests_total",
+        "Coalesced AI calls: started a new upstream call or shared one in flight.",
+        ("kind",),
+    )
+)
+rate_limited = registry.register(
+    Counter(
+        "rate_limited_requests_total",
+        "AI requests rejected with 429, by the bucket that was empty.",
+        ("scope",),
+    )
+)
+
+
+# -------------------------
+# STATISTIK PER PERMINTAAN
+# -------------------------
+
+
+@dataclass
+class RequestStats:
+    """Work done on behalf of the current HTTP request."""
+
+    db_queries: int = 0
+    db_seconds: float = 0.0
+    upstream_seconds: float = 0.0
+
+
+# Objeknya mutable sehingga thread pool dan greenlet SQLAlchemy yang menyalin
+# context tetap menambah statistik permintaan yang sama.
+_request_stats: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar(
+    "request_stats", default=None
+)
+
+
+def current_request_stats() -> Optional[RequestStats]:
+    return _request_stats.get()
+
+
+def _route_label(scope) -> str:
+    route = scope.get("route")
+    path = getattr(route, "path", None)
+    # Path mentah tidak dipakai sebagai label agar jumlah seri tetap terbatas.
+    return path or "unmatched"
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware recording latency and per-request DB/upstream work.
+
+    Implemented without ``BaseHTTPMiddleware`` so streaming responses are not
+    buffered and the context variable is visible to the endpoint.
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = _request_stats.set(stats)
+        status_code = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            _request_stats.reset(token)
+            method, route = scope["method"], _route_label(scope)
+            http_requests.inc(method, route, str(status_code))
+            http_request_duration.observe(elapsed, method, route)
+            http_request_db_queries.observe(stats.db_queries, method, route)
+            http_request_db_duration.observe(stats.db_seconds, method, route)
+            http_request_upstream_duration.observe(stats.upstream_seconds, method, route)
+
+
+# -------------------------
+# SQLALCHEMY
+# -------------------------
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    started = conn.info["query_started"].pop()
+    elapsed = time.perf_counter() - started
+    db_query_duration.observe(elapsed, conn.engine.dialect.name)
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.db_queries += 1
+        stats.db_seconds += elapsed
+
+
+def _handle_error(exception_context) -> None:
+    conn = exception_context.connection
+    if conn is not None and conn.info.get("query_started"):
+        conn.info["query_started"].pop()
+
+
+def instrument_engine(sync_engine: Engine) -> None:
+    """Time every SQL statement run through ``sync_engine``.
+
+    For an ``AsyncEngine`` pass its ``sync_engine``. Calling this twice for
+    the same engine is a no-op.
+    """
+    if event.contains(sync_engine, "before_cursor_execute", _before_cursor_execute):
+        return
+    event.listen(sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(sync_engine, "handle_error", _handle_error)
+
+
+# -------------------------
+# OPENROUTER
+# -------------------------
+
+
+def observe_upstream_call(
+    model: str,
+    operation: str,
+    elapsed: float,
+    usage=None,
+    error: Optional[BaseException] = None,
+) -> None:
+    """Record one OpenRouter completion (successful or not)."""
+    outcome = "ok" if error is None else "error"
+    upstream_request_duration.observe(elapsed, model, operation, outcome)
+    if error is not None:
+        upstream_errors.inc(model, operation, type(error).__name__)
+    for kind in ("prompt_tokens", "completion_tokens"):
+        count = getattr(usage, kind, None)
+        if isinstance(count, int):
+            upstream_tokens.inc(model, operation, kind.split("_")[0], amount=count)
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.upstream_seconds += elapsed
+
+
+def render() -> str:
+    return registry.render()
+
+
+def clear() -> None:
+    registry.clear()
@@ -1,5 +1,8 @@
 # app/models.py: Definisi model ORM untuk tabel diary entries
-from sqlalchemy import Column, Integer, String, BigInteger  # Penting: Import BigInteger
+from typing import List
+
+from sqlalchemy import DDL, Column, ForeignKey, Integer, String, BigInteger, Index, event, func  # Penting: Import BigInteger
+from sqlalchemy.orm import relationship
 from .database import Base
 
 
@@ -11,20 +14,137 @@ class DiaryEntry(Base):
     id = Column(Integer, primary_key=True, index=True)
 
     # Nama kolom untuk isi diary. Harus konsisten dengan 'content' di Android dan schemas.py.
-    content = Column(
-        String, nullable=False, index=True
-    )  # Menambahkan index juga untuk pencarian
+    # Tanpa index B-tree: pencarian kata memakai indeks full-text di bawah.
+    content = Column(String, nullable=False)
 
     # Nama kolom untuk mood.
     mood = Column(String, nullable=False, index=True)  # Menambahkan index
 
-    activities = Column(String, nullable=False, default="")
+    # Format lama: aktivitas digabung dengan "|". Entri baru menyimpan "" dan
+    # aktivitasnya ada di entry_activities; data lama dipindahkan dengan
+    # ``python -m app.cli migrate-activities``.
+    legacy_activities = Column("activities", String, nullable=False, default="")
 
     # Nama kolom untuk timestamp.
     # Menggunakan BigInteger agar dapat menyimpan nilai Long dari Android/Kotlin.
     # Harus konsisten dengan 'timestamp: int' di schemas.py dan 'creationTimestamp: Long' di DiaryEntry.kt.
     timestamp = Column(BigInteger, nullable=False, index=True)  # Menambahkan index
 
+    # Kunci idempotensi dari klien (lihat DiaryEntryCreate.client_id); unik
+    # per pemilik, lihat uq_diary_entries_owner_client_id di bawah.
+    client_id = Column(String(64), nullable=True, index=True)
+
+    # Pemilik entri; NULL untuk entri dari klien tanpa login.
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=True)
+
+    # Hasil analisis sentimen AI yang dikerjakan di latar belakang (lihat
+    # app.analysis). Status NULL berarti entri tidak diantrekan; selain itu
+    # "pending", "done" atau "failed".
+    analysis = Column(String, nullable=True)
+    analysis_status = Column(String(16), nullable=True)
+
+    # Index gabungan untuk keyset pagination per pengguna
+    # (WHERE user_id = ? ORDER BY timestamp DESC, id DESC).
+    __table_args__ = (
+        Index("ix_diary_entries_user_timestamp_id", "user_id", "timestamp", "id"),
+    )
+
+    # Dimuat bersama entri (selectin) agar tetap bisa dibaca di luar sesi async.
+    activity_links = relationship(
+        "EntryActivity",
+        order_by="EntryActivity.position",
+        lazy="selectin",
+        cascade="all, delete-orphan",
+        passive_deletes=True,
+    )
+
+    @property
+    def activities(self) -> List[str]:
+        """Activity names in the order the client sent them."""
+        return [link.activity.name for link in self.activity_links]
+
+
+# client_id unik per pemilik entri. user_id NULL (tanpa login) dipetakan ke 0
+# karena indeks unik tidak pernah menganggap dua NULL sama.
+Index(
+    "uq_diary_entries_owner_client_id",
+    func.coalesce(DiaryEntry.user_id, 0),
+    DiaryEntry.client_id,
+    unique=True,
+)
+
+
+class Activity(Base):
+    __tablename__ = "activities"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False, unique=True, index=True)
+
+
+# Relasi entri <-> aktivitas. ``user_id``, ``mood`` dan ``timestamp`` disalin dari entri
+# (entri tidak pernah diubah) supaya "entri dengan aktivitas X" dan
+# "distribusi mood per aktivitas" cukup dibaca dari index tabel ini.
+class EntryActivity(Base):
+    __tablename__ = "entry_activities"
+
+    entry_id = Column(
+        Integer, ForeignKey("diary_entries.id", ondelete="CASCADE"), primary_key=True
+    )
+    activity_id = Column(Integer, ForeignKey("activities.id"), primary_key=True)
+    position = Column(Integer, nullable=False, default=0)
+    user_id = Column(Integer, nullable=True)
+    mood = Column(String, nullable=False)
+    timestamp = Column(BigInteger, nullable=False)
+
+    activity = relationship(Activity, lazy="joined", innerjoin=True)
+
+    __table_args__ = (
+        Index(
+            "ix_entry_activities_user_activity_timestamp",
+            "user_id",
+            "activity_id",
+            "timestamp",
+            "entry_id",
+        ),
+        Index("ix_entry_activities_user_activity_mood", "user_id", "activity_id", "mood"),
+    )
+
+
+# Indeks full-text untuk /entries/search.
+# - SQLite: tabel virtual FTS5 (external content) yang disinkronkan lewat trigger.
+# - Postgres: kolom tsvector hasil generate + indeks GIN.
+# Untuk database lama jalankan ``python -m app.cli rebuild-search-index``.
+SEARCH_DDL = {
+    "sqlite": [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS diary_entries_fts USING fts5("
+        "content, content='diary_entries', content_rowid='id', "
+        "tokenize='unicode61 remove_diacritics 2')",
+        "CREATE TRIGGER IF NOT EXISTS diary_entries_fts_ai AFTER INSERT ON diary_entries BEGIN "
+        "INSERT INTO diary_entries_fts(rowid, content) VALUES (new.id, new.content); END",
+        "CREATE TRIGGER IF NOT EXISTS diary_entries_fts_ad AFTER DELETE ON diary_entries BEGIN "
+        "INSERT INTO diary_entries_fts(diary_entries_fts, rowid, content) "
+        "VALUES ('delete', old.id, old.content); END",
+        "CREATE TRIGGER IF NOT EXISTS diary_entries_fts_au AFTER UPDATE OF content ON diary_entries BEGIN "
+        "INSERT INTO diary_entries_fts(diary_entries_fts, rowid, content) "
+        "VALUES ('delete', old.id, old.content); "
+        "INSERT INTO diary_entries_fts(rowid, content) VALUES (new.id, new.content); END",
+    ],
+    "postgresql": [
+        "ALTER TABLE diary_entries ADD COLUMN IF NOT EXISTS content_tsv tsvector "
+        "GENERATED ALWAYS AS (to_tsvector('simple', content)) STORED",
+        "CREATE INDEX IF NOT EXISTS ix_diary_entries_content_tsv "
+        "ON diary_entries USING GIN (content_tsv)",
+    ],
+}
+
+for _dialect, _statements in SEARCH_DDL.items():
+    for _statement in _statements:
+        event.listen(
+            DiaryEntry.__table__,
+            "after_create",
+            DDL(_statement).execute_if(dialect=_dialect),
+        )
+
 
 class User(Base):
     __tablename__ = "users"
@@ -33,3 +153,96 @@ class User(Base):
     email = Column(String, unique=True, index=True, nullable=False)
     name = Column(String, nullable=False)
     hashed_password = Column(String, nullable=False)
+
+
+# Tabel rollup statistik mood. Diperbarui dalam transaksi yang sama dengan
+# penyimpanan entri (lihat crud.create_diary_entry) dan dapat dibangun ulang
+# dari diary_entries dengan ``python -m app.cli rebuild-mood-stats``.
+# ``user_id`` 0 menampung entri tanpa pemilik (kunci primer tidak boleh NULL).
+class MoodCount(Base):
+    __tablename__ = "mood_counts"
+
+    user_id = Column(Integer, primary_key=True, default=0)
+    mood = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class MoodDailyCount(Base):
+    __tablename__ = "mood_daily_counts"
+
+    user_id = Column(Integer, primary_key=True, default=0)
+    # Hari sejak epoch UTC (timestamp milidetik // 86_400_000).
+    day = Column(Integer, primary_key=True)
+    mood = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+# Token yang dicabut (logout) sebelum kedaluwarsa. Setiap worker menyalin
+# daftar ini ke memori secara berkala (lihat app.auth), sehingga verifikasi
+# token tidak perlu query database.
+class RevokedToken(Base):
+    __tablename__ = "revoked_tokens"
+
+    jti = Column(String(64), primary_key=True)
+    # Waktu kedaluwarsa token (detik epoch); baris lewat waktu boleh dihapus.
+    expires_at = Column(BigInteger, nullable=False, index=True)
+
+
+# Antrean analisis AI untuk entri baru. Satu baris per entri (entry_id unik)
+# sehingga entri yang sama tidak pernah dianalisis dua kali. Worker mengklaim
+# baris "pending" yang sudah jatuh tempo, atau "running" yang sewanya
+# (locked_until) habis karena worker sebelumnya mati.
+class AnalysisJob(Base):
+    __tablename__ = "analysis_jobs"
+
+    id = Column(Integer, primary_key=True)
+    entry_id = Column(
+        Integer,
+        ForeignKey("diary_entries.id", ondelete="CASCADE"),
+        nullable=False,
+        unique=True,
+    )
+    # "pending", "running", "done" atau "failed"
+    status = Column(String(16), nullable=False, default="pending")
+    attempts = Column(Integer, nullable=False, default=0)
+    # Detik epoch: kapan job boleh dicoba (backoff) dan sampai kapan dikunci.
+    available_at = Column(BigInteger, nullable=False)
+    locked_until = Column(BigInteger, nullable=True)
+    last_error = Column(String, nullable=True)
+
+    __table_args__ = (Index("ix_analysis_jobs_status_available", "status", "available_at"),)
+
+
+# Percakapan /chat/ yang disimpan di server (lihat app.conversations). ID-nya
+# acak (uuid4 hex) agar percakapan tanpa pemilik tidak bisa ditebak.
+class Conversation(Base):
+    __tablename__ = "conversations"
+
+    id = Column(String(32), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=True, index=True)
+    # Ringkasan bergulir dari semua pesan dengan id <= summarized_until.
+    summary = Column(String, nullable=True)
+    summarized_until = Column(Integer, nullable=False, default=0)
+    # Detik epoch
+    created_at = Column(BigInteger, nullable=False)
+    updated_at = Column(BigInteger, nullable=False)
+
+
+class ConversationMessage(Base):
+    __tablename__ = "conversation_messages"
+
+    id = Column(Integer, primary_key=True)
+    conversation_id = Column(
+        String(32), ForeignKey("conversations.id", ondelete="CASCADE"), nullable=False
+    )
+    # "user" atau "assistant"
+    role = Column(String(16), nullable=False)
+    content = Column(String, nullable=False)
+    # Perkiraan jumlah token (app.conversations.estimate_tokens), dihitung
+    # sekali saat disimpan.
+    tokens = Column(Integer, nullable=False)
+    created_at = Column(BigInteger, nullable=False)
+
+    __table_args__ = (
+        Index("ix_conversation_messages_conversation_id", "conversation_id", "id"),
+    )
@@ -1,15 +1,23 @@
-from .openrouter_client import get_openrouter_client
+from .openrouter_client import (
+    UpstreamBusyError,
+    create_chat_completion,
+    get_openrouter_client,
+)
+from .singleflight import coalesce
 import logging
 
+# Versi template prompt untuk kunci cache respons (lihat app/cache.py).
+ANALYZE_PROMPT_VERSION = "1"
 
-def analyze_text(text: str) -> str:
+
+@coalesce
+async def analyze_text(text: str) -> str:
     """Analyze text sentiment using OpenRouter."""
 
     client = get_openrouter_client()
 
     # Payload tetap sama, karena prompt Anda sudah benar dalam meminta kalimat sederhana.
     payload = {
-        "model": "deepseek/deepseek-chat-v3-0324:free",
         "messages": [
             {
                 "role": "user",
@@ -19,7 +27,7 @@ def analyze_text(text: str) -> str:
     }
 
     try:
-        data = client.chat.completions.create(**payload)
+        data = await create_chat_completion(client, operation="analyze", **payload)
 
         # Ekstrak konten respons teks dari model.
         # Ini akan berupa kalimat seperti "The sentiment is positive."
@@ -29,6 +37,8 @@ def analyze_text(text: str) -> str:
         # Tidak perlu mencoba parsing JSON yang rumit dan tidak perlu.
         return response_text
 
+    except UpstreamBusyError:
+        raise
     except Exception as e:
         # Menangkap error lain dari OpenRouter API atau Python
         logging.error("ERROR: Kesalahan API OpenRouter atau pemrosesan: %s", e)
@@ -1,38 +1,536 @@
 import os
+import asyncio
+import contextvars
 import logging
+import time
+from contextlib import aclosing, asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+import httpx
+import openai
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI
+
+from . import metrics, resilience
 
 # Memuat variabel dari file .env ke dalam environment
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+OPENROUTER_BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+OPENROUTER_MODEL = os.getenv("OPENROUTER_MODEL", "deepseek/deepseek-chat-v3-0324:free")
+# Model cadangan (dipisah koma) yang dicoba berurutan bila model utama gagal
+# atau circuit-nya sedang terbuka.
+OPENROUTER_FALLBACK_MODELS = [
+    m.strip() for m in os.getenv("OPENROUTER_FALLBACK_MODELS", "").split(",") if m.strip()
+]
 
-def get_openrouter_client() -> OpenAI:
-    """
-    Mengambil API key dari environment, memeriksanya, dan menginisialisasi
-    klien OpenRouter OpenAI.
-    """
-    api_key = os.getenv("OPENROUTER_API_KEY")
+# Pengaturan pool koneksi HTTP yang dipakai bersama oleh seluruh proses.
+# Koneksi keep-alive dipakai ulang antar permintaan sehingga tidak perlu
+# membuka koneksi dan handshake TLS baru untuk setiap panggilan AI.
+OPENROUTER_MAX_CONNECTIONS = int(os.getenv("OPENROUTER_MAX_CONNECTIONS", "100"))
+OPENROUTER_MAX_KEEPALIVE_CONNECTIONS = int(
+    os.getenv("OPENROUTER_MAX_KEEPALIVE_CONNECTIONS", "20")
+)
+OPENROUTER_KEEPALIVE_EXPIRY = float(os.getenv("OPENROUTER_KEEPALIVE_EXPIRY", "30"))
+OPENROUTER_TIMEOUT = float(os.getenv("OPENROUTER_TIMEOUT", "60"))
+# HTTP/2 membutuhkan paket opsional ``h2`` (``pip install httpx[http2]``).
+OPENROUTER_HTTP2 = os.getenv("OPENROUTER_HTTP2", "false").lower() in ("1", "true", "yes")
+
+# Batas panggilan upstream yang berjalan bersamaan, secara global dan per
+# model. Permintaan di atas batas akan mengantre paling lama
+# OPENROUTER_QUEUE_TIMEOUT detik sebelum ditolak dengan UpstreamBusyError.
+OPENROUTER_MAX_CONCURRENCY = int(os.getenv("OPENROUTER_MAX_CONCURRENCY", "64"))
+OPENROUTER_MAX_CONCURRENCY_PER_MODEL = int(
+    os.getenv("OPENROUTER_MAX_CONCURRENCY_PER_MODEL", "32")
+)
+OPENROUTER_QUEUE_TIMEOUT = float(os.getenv("OPENROUTER_QUEUE_TIMEOUT", "10"))
+
+# Anggaran waktu seluruh panggilan (semua percobaan dan model cadangan) dalam
+# satu permintaan, dan batas waktu satu percobaan.
+OPENROUTER_DEADLINE = float(os.getenv("OPENROUTER_DEADLINE", "30"))
+OPENROUTER_ATTEMPT_TIMEOUT = float(os.getenv("OPENROUTER_ATTEMPT_TIMEOUT", "20"))
+# Percobaan ulang per model untuk galat sementara (koneksi, timeout, 408/409/429/5xx).
+OPENROUTER_MAX_RETRIES = int(os.getenv("OPENROUTER_MAX_RETRIES", "2"))
+OPENROUTER_RETRY_BASE_DELAY = float(os.getenv("OPENROUTER_RETRY_BASE_DELAY", "0.5"))
+OPENROUTER_RETRY_MAX_DELAY = float(os.getenv("OPENROUTER_RETRY_MAX_DELAY", "8"))
+# Circuit breaker per model: terbuka setelah sejumlah kegagalan berturut-turut.
+OPENROUTER_BREAKER_FAILURES = int(os.getenv("OPENROUTER_BREAKER_FAILURES", "5"))
+OPENROUTER_BREAKER_RESET = float(os.getenv("OPENROUTER_BREAKER_RESET", "30"))
+# Hedging: kirim percobaan kedua bila yang pertama melewati p95 latensi model.
+# Menambah biaya token, jadi nonaktif secara default.
+OPENROUTER_HEDGE = os.getenv("OPENROUTER_HEDGE", "false").lower() in ("1", "true", "yes")
+OPENROUTER_HEDGE_MIN_SAMPLES = int(os.getenv("OPENROUTER_HEDGE_MIN_SAMPLES", "20"))
+
+_client: Optional[AsyncOpenAI] = None
+_client_api_key: Optional[str] = None
+_override: Optional[AsyncOpenAI] = None
+
+_global_slots: Optional[asyncio.Semaphore] = None
+_model_slots: Dict[str, asyncio.Semaphore] = {}
+_breakers: Dict[str, resilience.CircuitBreaker] = {}
+_latencies: Dict[str, resilience.LatencyTracker] = {}
+
+# Daftar model yang menjawab panggilan dalam konteks ini (lihat
+# track_answering_models). Objeknya mutable sehingga task single-flight yang
+# menyalin context tetap mencatat ke daftar milik pemanggilnya.
+_answering_models: contextvars.ContextVar[Optional[List[str]]] = contextvars.ContextVar(
+    "answering_models", default=None
+)
 
-    if api_key:
-        logger.debug(
-            "OpenRouter API key loaded (length: %d, prefix: %s, suffix: %s)",
-            len(api_key),
-            api_key[:4],
-            api_key[-4:],
-        )
-    else:
-        logger.debug("OPENROUTER_API_KEY not found in environment")
+
+class UpstreamBusyError(RuntimeError):
+    """Raised when no upstream slot frees up within the queue timeout."""
+
+
+class CircuitOpenError(UpstreamBusyError):
+    """Raised when the circuit of every configured model is open."""
+
+
+class UpstreamTimeoutError(TimeoutError):
+    """Raised when an attempt or the request deadline runs out."""
+
+
+def _get_api_key() -> str:
+    """Return the OpenRouter API key or raise ``RuntimeError`` if missing."""
+    api_key = os.getenv("OPENROUTER_API_KEY")
 
     # Logika ini tetap sama. Jika kunci tidak ada, program akan berhenti.
     # Ini adalah pengaman jika terjadi kesalahan.
     if not api_key:
+        logger.debug("OPENROUTER_API_KEY not found in environment")
         raise RuntimeError(
             "Kunci API 'OPENROUTER_API_KEY' tidak ada di environment. "
             "Pastikan file .env Anda benar dan berada di direktori yang tepat."
         )
+    return api_key
+
+
+def _http2_enabled() -> bool:
+    if not OPENROUTER_HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        logger.warning("OPENROUTER_HTTP2 aktif tetapi paket 'h2' tidak terpasang; memakai HTTP/1.1")
+        return False
+    return True
+
+
+def create_openrouter_client(api_key: str) -> AsyncOpenAI:
+    """Build an OpenRouter client backed by a keep-alive connection pool."""
+    logger.debug(
+        "OpenRouter API key loaded (length: %d, prefix: %s, suffix: %s)",
+        len(api_key),
+        api_key[:4],
+        api_key[-4:],
+    )
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=OPENROUTER_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENROUTER_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=OPENROUTER_KEEPALIVE_EXPIRY,
+        ),
+        http2=_http2_enabled(),
+        timeout=OPENROUTER_TIMEOUT,
+    )
+    # Percobaan ulang diatur oleh create_chat_completion, bukan oleh SDK.
+    return AsyncOpenAI(
+        base_url=OPENROUTER_BASE_URL, api_key=api_key, http_client=http_client, max_retries=0
+    )
+
+
+def get_openrouter_client() -> AsyncOpenAI:
+    """
+    Mengembalikan klien OpenRouter bersama milik proses.
+
+    Klien dibuat sekali (atau dibuat ulang jika API key berubah) dan dipakai
+    ulang oleh semua permintaan. API key tetap diperiksa pada setiap panggilan.
+    """
+    global _client, _client_api_key
+
+    api_key = _get_api_key()
+    if _override is not None:
+        return _override
+
+    if _client is None or _client_api_key != api_key:
+        if _client is not None:
+            _close_later(_client)
+        _client = create_openrouter_client(api_key)
+        _client_api_key = api_key
+    return _client
+
+
+def _close_later(client: AsyncOpenAI) -> None:
+    """Close a replaced client in the background if an event loop is running."""
+    try:
+        asyncio.get_running_loop().create_task(client.close())
+    except RuntimeError:
+        pass
+
+
+def set_openrouter_client(client: Optional[AsyncOpenAI]) -> None:
+    """Override the shared client (e.g. with a fake in tests); ``None`` resets it."""
+    global _override
+    _override = client
+
+
+def init_openrouter_client() -> None:
+    """Create the shared client at application startup when a key is configured."""
+    reset_concurrency_limits()
+    try:
+        get_openrouter_client()
+    except RuntimeError:
+        logger.warning("OPENROUTER_API_KEY belum diatur; klien OpenRouter dibuat saat dibutuhkan")
+
+
+async def close_openrouter_client() -> None:
+    """Close the shared client and its connection pool at application shutdown."""
+    global _client, _client_api_key
+    client, _client, _client_api_key = _client, None, None
+    if client is not None:
+        await client.close()
+
+
+def reset_concurrency_limits() -> None:
+    """(Re)create the upstream semaphores, circuit breakers and latency windows."""
+    global _global_slots
+    _global_slots = asyncio.Semaphore(OPENROUTER_MAX_CONCURRENCY)
+    _model_slots.clear()
+    _breakers.clear()
+    _latencies.clear()
+
+
+def model_chain(model: Optional[str] = None) -> List[str]:
+    """Models to try in order: ``model`` (default the configured one), then the fallbacks."""
+    primary = model or OPENROUTER_MODEL
+    return [primary] + [m for m in OPENROUTER_FALLBACK_MODELS if m != primary]
+
+
+def breaker_for(model: str) -> resilience.CircuitBreaker:
+    breaker = _breakers.get(model)
+    if breaker is None:
+        breaker = _breakers[model] = resilience.CircuitBreaker(
+            OPENROUTER_BREAKER_FAILURES, OPENROUTER_BREAKER_RESET
+        )
+    return breaker
+
+
+def circuit_states() -> Dict[str, str]:
+    """Circuit state of every model called so far."""
+    return {model: breaker.state for model, breaker in _breakers.items()}
+
+
+def track_answering_models() -> List[str]:
+    """Start recording which model answers each completion in this context.
+
+    Returns the list the answering models are appended to, so a caller can
+    tell a fallback model's answer from the primary's (e.g. for cache keys).
+    """
+    answered: List[str] = []
+    _answering_models.set(answered)
+    return answered
+
+
+def _record_answer(model: str) -> None:
+    answered = _answering_models.get()
+    if answered is not None:
+        answered.append(model)
+
+
+async def apply_request_deadline() -> None:
+    """Dependency giving all OpenRouter calls of a request one shared time budget."""
+    resilience.set_deadline(OPENROUTER_DEADLINE)
+
+
+async def _acquire(semaphore: asyncio.Semaphore, timeout: float) -> None:
+    if not semaphore.locked():
+        await semaphore.acquire()
+        return
+    try:
+        await asyncio.wait_for(semaphore.acquire(), timeout=max(timeout, 0))
+    except asyncio.TimeoutError as e:
+        raise UpstreamBusyError("Terlalu banyak permintaan AI yang sedang berjalan") from e
+
+
+@asynccontextmanager
+async def upstream_slot(model: str) -> AsyncIterator[None]:
+    """Hold one per-model and one global upstream slot for the block.
+
+    The per-model slot is taken first so a saturated model queues on its own
+    semaphore instead of holding global slots that other models could use.
+    """
+    if _global_slots is None:
+        reset_concurrency_limits()
+    global_slots = _global_slots
+    model_slots = _model_slots.setdefault(
+        model, asyncio.Semaphore(OPENROUTER_MAX_CONCURRENCY_PER_MODEL)
+    )
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + OPENROUTER_QUEUE_TIMEOUT
+
+    await _acquire(model_slots, OPENROUTER_QUEUE_TIMEOUT)
+    try:
+        await _acquire(global_slots, deadline - loop.time())
+    except UpstreamBusyError:
+        model_slots.release()
+        raise
+    try:
+        yield
+    finally:
+        global_slots.release()
+        model_slots.release()
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Whether ``error`` is transient: a lost connection, a timeout or 408/409/429/5xx."""
+    if isinstance(error, (openai.APIConnectionError, httpx.TransportError, UpstreamTimeoutError)):
+        return True
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return isinstance(status, int) and (status in (408, 409, 429) or status >= 500)
+
+
+def _retry_delay(error: BaseException, retries: int, deadline: float) -> Optional[float]:
+    """Seconds to wait before retrying the same model, or ``None`` to move on.
+
+    The wait is exponential backoff with full jitter, but never shorter than
+    the ``Retry-After`` the upstream asked for. A retry that could not start
+    before the deadline is not attempted.
+    """
+    if retries >= OPENROUTER_MAX_RETRIES:
+        return None
+    delay = resilience.backoff_delay(retries, OPENROUTER_RETRY_BASE_DELAY, OPENROUTER_RETRY_MAX_DELAY)
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    retry_after = resilience.parse_retry_after(headers.get("retry-after") if headers else None)
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    if time.monotonic() + delay >= deadline:
+        return None
+    return delay
+
+
+def _record_failure(model: str, breaker: resilience.CircuitBreaker) -> None:
+    if breaker.record_failure():
+        metrics.upstream_circuit_opened.inc(model)
+        logger.warning(
+            "Circuit OpenRouter untuk model %s terbuka selama %.0f detik", model, breaker.reset_timeout
+        )
+
+
+async def _create(client: AsyncOpenAI, model: str, payload: Dict[str, Any]) -> Any:
+    async with upstream_slot(model):
+        return await client.chat.completions.create(model=model, **payload)
+
+
+async def _attempt(
+    client: AsyncOpenAI, model: str, operation: str, payload: Dict[str, Any], deadline: float
+) -> Any:
+    """One bounded call to ``model``, recorded in the metrics and latency window."""
+    timeout = min(OPENROUTER_ATTEMPT_TIMEOUT, deadline - time.monotonic())
+    started = time.perf_counter()
+    try:
+        try:
+            result = await asyncio.wait_for(_create(client, model, payload), timeout=max(timeout, 0))
+        except asyncio.TimeoutError as e:
+            raise UpstreamTimeoutError(
+                f"OpenRouter tidak menjawab dalam {max(timeout, 0):.1f} detik"
+            ) from e
+    except Exception as e:
+        metrics.observe_upstream_call(model, operation, time.perf_counter() - started, error=e)
+        raise
+    elapsed = time.perf_counter() - started
+    metrics.observe_upstream_call(model, operation, elapsed, getattr(result, "usage", None))
+    _latencies.setdefault(model, resilience.LatencyTracker()).add(elapsed)
+    return result
+
+
+async def _hedged(attempt: Callable[[], Awaitable[Any]], delay: float, model: str, operation: str) -> Any:
+    """Run ``attempt``; if it is still pending after ``delay``, race a second one."""
+    first = asyncio.ensure_future(attempt())
+    done, _ = await asyncio.wait({first}, timeout=delay)
+    if done:
+        return first.result()
+    metrics.upstream_hedged.inc(model, operation)
+    pending = {first, asyncio.ensure_future(attempt())}
+    error: Optional[BaseException] = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def _call_model(
+    client: AsyncOpenAI, model: str, operation: str, payload: Dict[str, Any], deadline: float
+) -> Any:
+    """One (possibly hedged) attempt on ``model``, reported to its circuit breaker."""
+    breaker = breaker_for(model)
+
+    def attempt():
+        return _attempt(client, model, operation, payload, deadline)
+
+    hedge_after = None
+    if OPENROUTER_HEDGE:
+        tracker = _latencies.get(model)
+        if tracker is not None:
+            hedge_after = tracker.quantile(0.95, OPENROUTER_HEDGE_MIN_SAMPLES)
+    try:
+        if hedge_after is not None and time.monotonic() + hedge_after < deadline:
+            result = await _hedged(attempt, hedge_after, model, operation)
+        else:
+            result = await attempt()
+    except BaseException as e:
+        if isinstance(e, Exception) and is_retryable(e):
+            _record_failure(model, breaker)
+        else:
+            breaker.release()
+        raise
+    breaker.record_success()
+    return result
+
+
+async def create_chat_completion(
+    client: AsyncOpenAI, *, operation: str = "completion", **payload: Any
+) -> Any:
+    """Call ``client.chat.completions.create`` with retries and model fallback.
+
+    Each model of :func:`model_chain` (``payload["model"]`` first when given)
+    is tried in turn, skipping models whose circuit is open. Transient errors
+    are retried on the same model with backoff before moving on; a model with
+    no free upstream slot is skipped at once; other errors are raised at once.
+    All attempts share the request deadline. Every attempt runs inside an
+    upstream slot and is recorded in the metrics under ``operation``. The
+    model that answered is recorded for :func:`track_answering_models`.
+
+    Raises:
+        CircuitOpenError: If every model's circuit is open.
+        UpstreamBusyError: If the last model tried had no free upstream slot.
+        UpstreamTimeoutError: If the deadline passed before any attempt failed.
+        Exception: The last transient error once retries and fallbacks run out.
+    """
+    deadline = resilience.current_deadline(OPENROUTER_DEADLINE)
+    last_error: Optional[BaseException] = None
+    for index, model in enumerate(model_chain(payload.pop("model", None))):
+        breaker = breaker_for(model)
+        retries = 0
+        while time.monotonic() < deadline and breaker.allow():
+            if index > 0 and retries == 0:
+                metrics.upstream_fallbacks.inc(model, operation)
+            try:
+                result = await _call_model(client, model, operation, payload, deadline)
+            except UpstreamBusyError as e:
+                # Slot model ini penuh: model cadangan mungkin masih lowong.
+                last_error = e
+                break
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                last_error = e
+            else:
+                _record_answer(model)
+                return result
+            delay = _retry_delay(last_error, retries, deadline)
+            if delay is None:
+                break
+            retries += 1
+            metrics.upstream_retries.inc(model, operation)
+            await asyncio.sleep(delay)
+    if last_error is not None:
+        raise last_error
+    if time.monotonic() >= deadline:
+        raise UpstreamTimeoutError("Batas waktu permintaan AI habis")
+    raise CircuitOpenError("Layanan AI sedang tidak tersedia")
+
+
+async def stream_chat_completion(
+    client: AsyncOpenAI, *, operation: str = "completion", **payload: Any
+) -> AsyncIterator[str]:
+    """Yield the text deltas of a streamed completion.
+
+    Until the first delta arrives, failures are retried and fall back to the
+    next model like :func:`create_chat_completion` (and the model that
+    answers is recorded the same way); once text has been sent
+    to the consumer, errors are raised as they are. The upstream slot is held
+    until the stream is exhausted or the consumer stops iterating, at which
+    point the underlying HTTP response is closed. Each attempt is recorded in
+    the metrics once it ends.
+    """
+    deadline = resilience.current_deadline(OPENROUTER_DEADLINE)
+    last_error: Optional[BaseException] = None
+    for index, model in enumerate(model_chain(payload.pop("model", None))):
+        breaker = breaker_for(model)
+        retries = 0
+        while time.monotonic() < deadline and breaker.allow():
+            if index > 0 and retries == 0:
+                metrics.upstream_fallbacks.inc(model, operation)
+            started = time.perf_counter()
+            emitted = finished = False
+            error: Optional[BaseException] = None
+            try:
+                async with aclosing(_stream_deltas(client, model, payload)) as deltas:
+                    async for delta in deltas:
+                        if not emitted:
+                            emitted = True
+                            breaker.record_success()
+                            _record_answer(model)
+                        yield delta
+                finished = True
+            except Exception as e:
+                error = e
+                if emitted or not (is_retryable(e) or isinstance(e, UpstreamBusyError)):
+                    raise
+                last_error = e
+            finally:
+                metrics.observe_upstream_call(
+                    model, operation, time.perf_counter() - started, error=error
+                )
+                if not emitted:
+                    if error is not None and is_retryable(error):
+                        _record_failure(model, breaker)
+                    elif finished:
+                        breaker.record_success()
+                    else:
+                        breaker.release()
+            if error is None:
+                if not emitted:
+                    _record_answer(model)
+                return
+            if isinstance(error, UpstreamBusyError):
+                break
+            delay = _retry_delay(error, retries, deadline)
+            if delay is None:
+                break
+            retries += 1
+            metrics.upstream_retries.inc(model, operation)
+            await asyncio.sleep(delay)
+    if last_error is not None:
+        raise last_error
+    if time.monotonic() >= deadline:
+        raise UpstreamTimeoutError("Batas waktu permintaan AI habis")
+    raise CircuitOpenError("Layanan AI sedang tidak tersedia")
+
 
-    # Mengembalikan klien yang sudah diinisialisasi
-    return OpenAI(base_url="https://openrouter.ai/api/v1", api_key=api_key)
+async def _stream_deltas(
+    client: AsyncOpenAI, model: str, payload: Dict[str, Any]
+) -> AsyncIterator[str]:
+    async with upstream_slot(model):
+        stream = await client.chat.completions.create(model=model, stream=True, **payload)
+        try:
+            async for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    yield delta
+        finally:
+            response = getattr(stream, "response", None)
+            if response is not None:
+                await response.aclose()
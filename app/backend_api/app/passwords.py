@@ -0,0 +1,119 @@
+"""Password hashing off the event loop.
+
+bcrypt costs a few hundred milliseconds of CPU per call. Hashing and
+verification therefore run in a dedicated thread pool (the bcrypt extension
+releases the GIL while it works) of ``PASSWORD_HASH_WORKERS`` threads. At most
+``PASSWORD_HASH_MAX_PENDING`` calls may wait for a worker; callers beyond that
+wait up to ``PASSWORD_HASH_QUEUE_TIMEOUT`` seconds and then get
+:class:`PasswordHashBusyError` instead of piling up unbounded work.
+
+The cost factor comes from ``BCRYPT_ROUNDS``; hashes made with another cost
+are replaced on the next successful login.
+"""
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, Tuple, TypeVar
+
+from passlib.context import CryptContext
+
+T = TypeVar("T")
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 2)))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64"))
+PASSWORD_HASH_QUEUE_TIMEOUT = float(os.getenv("PASSWORD_HASH_QUEUE_TIMEOUT", "5"))
+
+pwd_context = CryptContext(
+    schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS
+)
+
+_executor: Optional[ThreadPoolExecutor] = None
+_slots: Optional[asyncio.Semaphore] = None
+_dummy_hash: Optional[str] = None
+
+
+class PasswordHashBusyError(RuntimeError):
+    """Raised when the hashing queue stays full for the whole queue timeout."""
+
+
+def init_password_pool() -> None:
+    """(Re)create the admission semaphore and the dummy hash; called at startup."""
+    global _slots, _dummy_hash
+    _slots = asyncio.Semaphore(PASSWORD_HASH_WORKERS + PASSWORD_HASH_MAX_PENDING)
+    # Dibuat di sini, bukan saat login pertama dengan email tak dikenal: login
+    # itu akan menjalankan bcrypt dua kali dan justru membocorkan waktunya.
+    if _dummy_hash is None or pwd_context.needs_update(_dummy_hash):
+        _dummy_hash = pwd_context.hash("dummy-password")
+
+
+def shutdown_password_pool() -> None:
+    """Stop the worker threads; a new pool is created on the next call."""
+    global _executor
+    executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash"
+        )
+    return _executor
+
+
+async def _run(fn: Callable[..., T], *args: object) -> T:
+    if _slots is None:
+        init_password_pool()
+    slots = _slots
+    if slots.locked():
+        try:
+            await asyncio.wait_for(slots.acquire(), timeout=PASSWORD_HASH_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError as e:
+            raise PasswordHashBusyError("Terlalu banyak proses login/registrasi") from e
+    else:
+        await slots.acquire()
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_get_executor(), fn, *args)
+    finally:
+        slots.release()
+
+
+async def hash_password(password: str) -> str:
+    """Hash ``password`` with the configured bcrypt cost in the worker pool."""
+    return await _run(pwd_context.hash, password)
+
+
+def _get_dummy_hash() -> str:
+    global _dummy_hash
+    # Hanya terjadi bila biaya bcrypt diubah setelah startup.
+    if pwd_context.needs_update(_dummy_hash):
+        _dummy_hash = pwd_context.hash("dummy-password")
+    return _dummy_hash
+
+
+def _verify(password: str, hashed: Optional[str]) -> Tuple[bool, Optional[str]]:
+    if hashed is None:
+        # Email tidak dikenal: tetap jalankan bcrypt dengan biaya yang sama
+        # agar waktu respons tidak membocorkan email mana yang terdaftar.
+        pwd_context.verify(password, _get_dummy_hash())
+        return False, None
+    return pwd_context.verify_and_update(password, hashed)
+
+
+async def verify_password(
+    password: str, hashed: Optional[str]
+) -> Tuple[bool, Optional[str]]:
+    """Check ``password`` against ``hashed`` in the worker pool.
+
+    Pass ``hashed=None`` for an unknown user; a dummy hash of the same cost
+    is verified so both cases take equally long.
+
+    Returns:
+        ``(valid, new_hash)`` where ``new_hash`` is set when the stored hash
+        uses an outdated cost factor and should be replaced.
+    """
+    return await _run(_verify, password, hashed)
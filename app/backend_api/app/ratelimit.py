@@ -0,0 +1,282 @@
+"""Token-bucket admission control for the AI endpoints.
+
+Every AI request takes one token from up to three buckets: the caller's user
+(when a valid bearer token is sent), the client IP and a global bucket that
+protects the shared OpenRouter quota. The request is only admitted if all
+buckets have a token, and then all are charged; otherwise it is rejected
+with 429 and ``Retry-After`` before any upstream work starts. ``/chat/``
+takes its token as a route dependency; ``/analyze/``, ``/articles/`` and
+``/openrouter_caption/`` call :func:`limit_ai_requests` themselves only when
+the response cache misses (and, for ``/analyze/``, only for texts the local
+classifier hands to OpenRouter), so answers that cost no upstream call
+never spend a token.
+
+Limits are configured per minute with a burst size (``0`` disables a
+bucket). Two backends are available through ``RATE_LIMIT_BACKEND``:
+
+* ``memory``: buckets in this process (one set per uvicorn worker).
+* ``sqlite``: buckets in a SQLite file shared by every worker on the host.
+
+``none`` turns rate limiting off.
+"""
+import asyncio
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import Depends, HTTPException, Request
+from fastapi.security import HTTPAuthorizationCredentials
+
+from . import auth, metrics
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory").lower()
+RATE_LIMIT_PATH = os.getenv("RATE_LIMIT_PATH", "./rate_limit.db")
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+# Di belakang reverse proxy (mis. Render) alamat klien ada di X-Forwarded-For.
+RATE_LIMIT_TRUST_PROXY = os.getenv("RATE_LIMIT_TRUST_PROXY", "false").lower() in ("1", "true", "yes")
+
+
+@dataclass(frozen=True)
+class Limit:
+    """Bucket refilling ``rate`` tokens per second up to ``burst`` tokens."""
+
+    rate: float
+    burst: float
+
+
+def _limit_from_env(prefix: str, per_minute: str, burst: str) -> Optional[Limit]:
+    rate = float(os.getenv(f"{prefix}_PER_MINUTE", per_minute))
+    if rate <= 0:
+        return None
+    return Limit(rate=rate / 60, burst=max(float(os.getenv(f"{prefix}_BURST", burst)), 1))
+
+
+USER_LIMIT = _limit_from_env("RATE_LIMIT_USER", "20", "5")
+IP_LIMIT = _limit_from_env("RATE_LIMIT_IP", "30", "10")
+GLOBAL_LIMIT = _limit_from_env("RATE_LIMIT_GLOBAL", "60", "20")
+
+# (kunci bucket, batasnya)
+Bucket = Tuple[str, Limit]
+
+
+def _refill(tokens: float, updated_at: float, limit: Limit, now: float) -> float:
+    return min(limit.burst, tokens + max(now - updated_at, 0) * limit.rate)
+
+
+def _wait_time(tokens: float, limit: Limit) -> float:
+    return (1 - tokens) / limit.rate
+
+
+class MemoryBuckets:
+    """Thread-safe in-process buckets, bounded to ``max_keys`` (LRU).
+
+    An evicted bucket simply starts full again the next time it is used.
+    """
+
+    def __init__(self, max_keys: int) -> None:
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, buckets: List[Bucket]) -> Tuple[float, Optional[str]]:
+        """Take one token from every bucket, or none of them.
+
+        Returns:
+            ``(0, None)`` when admitted, otherwise the seconds until the
+            most constrained bucket has a token again and its key.
+        """
+        now = time.monotonic()
+        with self._lock:
+            levels = {}
+            for key, limit in buckets:
+                tokens, updated_at = self._buckets.get(key, (limit.burst, now))
+                levels[key] = _refill(tokens, updated_at, limit, now)
+            retry_after, blocked = _worst(buckets, levels)
+            if blocked is not None:
+                return retry_after, blocked
+            for key, _ in buckets:
+                self._buckets[key] = (levels[key] - 1, now)
+                self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return 0.0, None
+
+    def clear(self) -> None:
+        with self._lock:
+            self._buckets.clear()
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteBuckets:
+    """Buckets stored in a SQLite file so several workers share the limits.
+
+    Each admission runs in one ``BEGIN IMMEDIATE`` transaction, which
+    serializes concurrent workers on the file's write lock.
+    """
+
+    def __init__(self, path: str) -> None:
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            path, check_same_thread=False, timeout=5, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS rate_limit_buckets ("
+            " key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+
+    def acquire(self, buckets: List[Bucket]) -> Tuple[float, Optional[str]]:
+        """Same contract as :meth:`MemoryBuckets.acquire`."""
+        now = time.time()
+        keys = [key for key, _ in buckets]
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows: Dict[str, Tuple[float, float]] = {
+                    key: (tokens, updated_at)
+                    for key, tokens, updated_at in self._conn.execute(
+                        "SELECT key, tokens, updated_at FROM rate_limit_buckets"
+                        f" WHERE key IN ({','.join('?' * len(keys))})",
+                        keys,
+                    )
+                }
+                levels = {
+                    key: _refill(*rows.get(key, (limit.burst, now)), limit, now)
+                    for key, limit in buckets
+                }
+                retry_after, blocked = _worst(buckets, levels)
+                if blocked is None:
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO rate_limit_buckets (key, tokens, updated_at)"
+                        " VALUES (?, ?, ?)",
+                        [(key, levels[key] - 1, now) for key in keys],
+                    )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return retry_after, blocked
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM rate_limit_buckets")
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def _worst(buckets: List[Bucket], levels: Dict[str, float]) -> Tuple[float, Optional[str]]:
+    retry_after, blocked = 0.0, None
+    for key, limit in buckets:
+        if levels[key] < 1:
+            wait = _wait_time(levels[key], limit)
+            if wait > retry_after:
+                retry_after, blocked = wait, key
+    return retry_after, blocked
+
+
+class RateLimiter:
+    """Applies the user, IP and global limits through a bucket backend."""
+
+    def __init__(
+        self,
+        backend,
+        user: Optional[Limit] = None,
+        ip: Optional[Limit] = None,
+        global_: Optional[Limit] = None,
+    ) -> None:
+        self.backend = backend
+        self.user = user
+        self.ip = ip
+        self.global_ = global_
+
+    def buckets_for(self, user_id: Optional[int], ip: Optional[str]) -> List[Bucket]:
+        buckets = []
+        if self.user is not None and user_id is not None:
+            buckets.append((f"user:{user_id}", self.user))
+        if self.ip is not None and ip:
+            buckets.append((f"ip:{ip}", self.ip))
+        if self.global_ is not None:
+            buckets.append(("global", self.global_))
+        return buckets
+
+    async def check(self, user_id: Optional[int], ip: Optional[str]) -> Tuple[float, Optional[str]]:
+        """Charge the request's buckets; see :meth:`MemoryBuckets.acquire`."""
+        buckets = self.buckets_for(user_id, ip)
+        if self.backend is None or not buckets:
+            return 0.0, None
+        if isinstance(self.backend, SQLiteBuckets):
+            # SQLite menulis ke disk; jalankan di thread agar event loop tidak tertahan.
+            return await asyncio.to_thread(self.backend.acquire, buckets)
+        return self.backend.acquire(buckets)
+
+    def clear(self) -> None:
+        if self.backend is not None:
+            self.backend.clear()
+
+    def close(self) -> None:
+        if self.backend is not None:
+            self.backend.close()
+
+
+def build_limiter() -> RateLimiter:
+    """Create the AI rate limiter configured through the environment."""
+    if RATE_LIMIT_BACKEND == "none":
+        backend = None
+    elif RATE_LIMIT_BACKEND == "sqlite":
+        backend = SQLiteBuckets(RATE_LIMIT_PATH)
+    else:
+        if RATE_LIMIT_BACKEND != "memory":
+            logger.warning("RATE_LIMIT_BACKEND=%s tidak dikenal; memakai memory", RATE_LIMIT_BACKEND)
+        backend = MemoryBuckets(RATE_LIMIT_MAX_KEYS)
+    return RateLimiter(backend, USER_LIMIT, IP_LIMIT, GLOBAL_LIMIT)
+
+
+ai_limiter = build_limiter()
+
+
+def client_ip(request: Request) -> Optional[str]:
+    if RATE_LIMIT_TRUST_PROXY:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else None
+
+
+def _user_id(credentials: Optional[HTTPAuthorizationCredentials]) -> Optional[int]:
+    # Rute AI tidak mewajibkan login; token yang tidak valid cukup diperlakukan
+    # sebagai anonim (bucket IP tetap berlaku) tanpa query ke database.
+    if credentials is None:
+        return None
+    try:
+        return auth.verify_access_token(credentials.credentials).id
+    except HTTPException:
+        return None
+
+
+async def limit_ai_requests(
+    request: Request,
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(auth.bearer_scheme),
+) -> None:
+    """Dependency rejecting the request with 429 when a bucket is empty."""
+    retry_after, blocked = await ai_limiter.check(_user_id(credentials), client_ip(request))
+    if blocked is None:
+        return
+    scope = blocked.split(":", 1)[0]
+    metrics.rate_limited.inc(scope)
+    raise HTTPException(
+        status_code=429,
+        detail="Terlalu banyak permintaan AI, coba lagi nanti",
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
@@ -0,0 +1,103 @@
+"""Routing of read-only queries to database replicas.
+
+Replicas are listed in ``SQLALCHEMY_REPLICA_URLS`` (comma-separated, same
+form as ``SQLALCHEMY_DATABASE_URL``) and used round-robin by
+:func:`get_read_db`. Without replicas every read goes to the primary.
+
+Replicas lag behind the primary, so a client that just wrote reads from the
+primary for ``READ_YOUR_WRITES_SECONDS``. Write routes call
+:func:`mark_write`, which sets a cookie so the client stays on the primary
+even when its next request lands on another worker. Authenticated writers are
+also remembered in this process, which covers clients that drop cookies;
+anonymous clients have nothing to tell them apart, so only the cookie applies.
+"""
+import itertools
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from fastapi import Depends, Request, Response
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from .database import create_async_db_engine, get_async_db, pool_stats, to_async_url
+
+REPLICA_URLS = [
+    url.strip() for url in os.getenv("SQLALCHEMY_REPLICA_URLS", "").split(",") if url.strip()
+]
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "5"))
+PRIMARY_COOKIE = "db_primary_until"
+_MAX_TRACKED_WRITERS = 10_000
+
+replica_engines = [create_async_db_engine(to_async_url(url)) for url in REPLICA_URLS]
+replica_sessions: List[async_sessionmaker] = [
+    async_sessionmaker(bind=e, autoflush=False, expire_on_commit=False)
+    for e in replica_engines
+]
+_next_replica = itertools.count()
+
+# Waktu (epoch) sampai kapan seorang penulis harus membaca dari primary,
+# per header Authorization. Klien tanpa token tidak dicatat: semuanya akan
+# berbagi satu kunci sehingga satu penulisan anonim memindahkan pembacaan
+# semua klien anonim ke primary.
+_recent_writes: "OrderedDict[str, float]" = OrderedDict()
+
+
+def _writer_key(request: Request) -> Optional[str]:
+    return request.headers.get("authorization") or None
+
+
+def mark_write(request: Request, response: Response) -> None:
+    """Route this client's reads to the primary for the next few seconds."""
+    if not replica_sessions:
+        return
+    until = time.time() + READ_YOUR_WRITES_SECONDS
+    key = _writer_key(request)
+    if key is not None:
+        _recent_writes[key] = until
+        _recent_writes.move_to_end(key)
+        while len(_recent_writes) > _MAX_TRACKED_WRITERS:
+            _recent_writes.popitem(last=False)
+    response.set_cookie(
+        PRIMARY_COOKIE,
+        f"{until:.3f}",
+        max_age=math.ceil(READ_YOUR_WRITES_SECONDS),
+        httponly=True,
+        samesite="lax",
+    )
+
+
+def _prefers_primary(request: Request) -> bool:
+    now = time.time()
+    key = _writer_key(request)
+    if key is not None and _recent_writes.get(key, 0) > now:
+        return True
+    try:
+        return float(request.cookies.get(PRIMARY_COOKIE, "0")) > now
+    except ValueError:
+        return False
+
+
+async def get_read_db(
+    request: Request, primary: AsyncSession = Depends(get_async_db)
+) -> AsyncIterator[AsyncSession]:
+    """Session for read-only routes: a replica, or the primary after a recent write.
+
+    The primary session is the same one the request's other dependencies
+    use; it does not open a connection unless it is actually queried.
+    """
+    if not replica_sessions or _prefers_primary(request):
+        yield primary
+        return
+    session_factory = replica_sessions[next(_next_replica) % len(replica_sessions)]
+    async with session_factory() as db:
+        yield db
+
+
+def replica_pool_stats() -> List[Dict[str, Any]]:
+    return [pool_stats(e) for e in replica_engines]
+
+
+def clear() -> None:
+    _recent_writes.clear()
@@ -0,0 +1,129 @@
+"""Building blocks for calling a flaky upstream: deadlines, backoff, circuit
+breakers and latency tracking.
+
+They hold no OpenRouter specifics; :mod:`app.openrouter_client` combines them
+into its retry, fallback and hedging policy.
+"""
+import contextvars
+import email.utils
+import random
+import threading
+import time
+from collections import deque
+from typing import Deque, Optional
+
+# Batas waktu absolut (time.monotonic) untuk semua panggilan upstream dalam
+# permintaan ini; None berarti tiap panggilan memakai anggaran default.
+_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar(
+    "upstream_deadline", default=None
+)
+
+
+def set_deadline(seconds: float) -> None:
+    """Give every upstream call from now on in this context ``seconds`` in total."""
+    _deadline.set(time.monotonic() + seconds)
+
+
+def current_deadline(default_seconds: float) -> float:
+    """Deadline of the current context, or ``default_seconds`` from now."""
+    deadline = _deadline.get()
+    return deadline if deadline is not None else time.monotonic() + default_seconds
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Exponential backoff with full jitter for retry number ``attempt`` (0-based)."""
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a ``Retry-After`` header (delta-seconds or HTTP date)."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(when.timestamp() - time.time(), 0.0)
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker.
+
+    After ``failure_threshold`` failures in a row the circuit opens and calls
+    are refused for ``reset_timeout`` seconds. Then one trial call is let
+    through (half-open): success closes the circuit, failure opens it again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return self.CLOSED
+        if self._probing or time.monotonic() - self._opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allow(self) -> bool:
+        """Whether a call may go out now; claims the trial call when half-open."""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._probing or time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def release(self) -> None:
+        """End a call that says nothing about upstream health (e.g. a 400)."""
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self) -> bool:
+        """Count a failure; returns True when this failure opened the circuit."""
+        with self._lock:
+            self.failures += 1
+            opened = self._probing or (
+                self._opened_at is None and self.failures >= self.failure_threshold
+            )
+            if opened:
+                self._opened_at = time.monotonic()
+                self._probing = False
+            return opened
+
+
+class LatencyTracker:
+    """Sliding window of recent successful call latencies."""
+
+    def __init__(self, window: int = 200) -> None:
+        self._samples: Deque[float] = deque(maxlen=window)
+
+    def add(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def quantile(self, q: float, min_samples: int) -> Optional[float]:
+        """The ``q`` quantile, or None with fewer than ``min_samples`` samples."""
+        if len(self._samples) < min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
@@ -3,9 +3,8 @@ from pydantic import (
     BaseModel,
     Field,
     field_serializer,
-    model_validator,
 )  # Import Field jika ingin menambahkan validasi tambahan
-from typing import Dict, List
+from typing import Dict, List, Literal, Optional
 
 
 # Schema dasar untuk entri diary (digunakan sebagai base class untuk request/response)
@@ -30,7 +29,15 @@ class DiaryEntryBase(BaseModel):
 
 # Schema untuk pembuatan entri (dikirim dari client/Android, tanpa ID)
 class DiaryEntryCreate(DiaryEntryBase):
-    pass  # Semua field sama dengan DiaryEntryBase, karena ID dibuat otomatis oleh DB
+    # Kunci idempotensi opsional yang dibuat di perangkat. Entri dengan
+    # client_id yang sudah tersimpan tidak akan dibuat ulang saat sinkronisasi diulang.
+    client_id: Optional[str] = Field(None, min_length=1, max_length=64)
+
+
+class DiaryEntryBatchCreate(BaseModel):
+    """Request body for uploading many queued entries at once."""
+
+    entries: List[DiaryEntryCreate] = Field(..., min_length=1, max_length=500)
 
 
 # Schema untuk output entri (dikembalikan ke client/Android, termasuk ID)
@@ -38,24 +45,22 @@ class DiaryEntryResponse(
     DiaryEntryBase
 ):  # Mengganti 'Entry' menjadi 'DiaryEntryResponse'
     id: int  # ID entri dari database
+    # Hasil analisis AI di latar belakang; status None jika tidak diantrekan,
+    # selain itu "pending", "done" atau "failed".
+    analysis: Optional[str] = None
+    analysis_status: Optional[str] = None
 
+    # ``activities`` dibaca langsung sebagai list dari relasi entry_activities.
     model_config = {
         "from_attributes": True,
     }
 
-    @model_validator(mode="before")
-    def _convert_activities(cls, data):
-        if isinstance(data, dict) and isinstance(data.get("activities"), str):
-            data["activities"] = (
-                data["activities"].split("|") if data["activities"] else []
-            )
-        elif hasattr(data, "activities") and isinstance(data.activities, str):
-            setattr(
-                data,
-                "activities",
-                data.activities.split("|") if data.activities else [],
-            )
-        return data
+
+class DiaryEntrySearchHit(DiaryEntryResponse):
+    """Hasil pencarian: entri beserta skor relevansi dan cuplikan yang ditandai."""
+
+    score: float  # makin kecil makin relevan
+    highlight: str
 
 
 # Schema untuk permintaan analisis AI (dummy)
@@ -63,9 +68,14 @@ class AnalyzeRequest(BaseModel):
     text: str = Field(..., min_length=1)  # Teks yang akan dianalisis
 
 
-# Schema untuk respons analisis AI (dummy)
+# Schema untuk respons analisis AI
 class AnalyzeResponse(BaseModel):
-    analysis: str  # Hasil analisis (misal: "Mood terdeteksi positif")
+    analysis: str  # Hasil analisis (misal: "Mood terdeteksi: Senang")
+    # Tebakan klasifikator lokal (None jika tidak ada kata isyarat) dan keyakinannya
+    mood: Optional[str] = None
+    confidence: Optional[float] = None
+    # "local" jika dijawab klasifikator lokal, "llm" jika diteruskan ke OpenRouter
+    source: Literal["local", "llm"] = "llm"
 
 
 class ArticleRequest(BaseModel):
@@ -85,8 +95,49 @@ class ChatRequest(BaseModel):
     """Request body for the /chat/ endpoint."""
 
     text: str = Field(..., min_length=1)
+    # Riwayat bebas dari klien (cara lama); dipotong ke anggaran token
+    # riwayat. Diabaikan bila ``conversation_id`` diisi.
     history: str | None = None
     mood: str | None = None
+    # Percakapan yang disimpan di server (lihat POST /conversations/); riwayat
+    # diambil dari sana dan giliran ini ikut disimpan.
+    conversation_id: str | None = Field(None, max_length=32)
+    # True: balasan dikirim per token lewat Server-Sent Events
+    # (text/event-stream). False: perilaku lama, satu body text/plain.
+    stream: bool = False
+
+
+class ChatTurn(BaseModel):
+    """Structured output of the single-call chat pipeline."""
+
+    issue: str = Field(..., min_length=1)
+    technique: str = Field(..., min_length=1)
+    tone: str = Field(..., min_length=1)
+    reply: str = Field(..., min_length=1)
+
+
+class ChatReply(BaseModel):
+    """Reply text of a chat turn and the pipeline that produced it."""
+
+    reply: str
+    pipeline: str
+
+
+class ConversationMessage(BaseModel):
+    """One stored chat turn."""
+
+    role: Literal["user", "assistant"]
+    content: str
+    created_at: int  # detik epoch
+
+
+class ConversationResponse(BaseModel):
+    """A server-side conversation with its rolling summary and all turns."""
+
+    id: str
+    # Ringkasan giliran lama yang tidak lagi dikirim utuh ke model
+    summary: Optional[str] = None
+    messages: List[ConversationMessage] = Field(default_factory=list)
 
 
 class OpenRouterCaptionRequest(BaseModel):
@@ -107,6 +158,29 @@ class MoodStatsResponse(BaseModel):
     stats: Dict[str, int]
 
 
+class ActivityMoodStats(BaseModel):
+    """Mood distribution of the entries that have one activity."""
+
+    activity: str
+    total: int
+    stats: Dict[str, int]
+
+
+class MoodBucket(BaseModel):
+    """Mood counts of one time bucket."""
+
+    start: int  # Awal bucket (UTC) dalam milidetik
+    end: int  # Awal bucket berikutnya (eksklusif)
+    stats: Dict[str, int]
+
+
+class MoodTimeseriesResponse(BaseModel):
+    """Response schema for bucketed mood statistics."""
+
+    bucket: Literal["day", "week", "month"]
+    buckets: List[MoodBucket]
+
+
 class UserCreate(BaseModel):
     email: str
     password: str
@@ -120,3 +194,5 @@ class UserLogin(BaseModel):
 
 class Token(BaseModel):
     token: str
+    token_type: str = "bearer"
+    expires_at: int  # detik epoch
@@ -0,0 +1,144 @@
+"""Local lexicon-based mood classifier for Indonesian and English diary text.
+
+:func:`classify` scores the five moods of ``DiaryEntryBase.mood`` from cue
+words, handling negation ("tidak senang", "not happy") and intensifiers
+("sedih banget", "very sad"). It runs in microseconds on the CPU, so
+``/analyze/`` and the background analysis only ask OpenRouter when the
+confidence is below ``SENTIMENT_CONFIDENCE_THRESHOLD``.
+
+Confidence combines how dominant the top mood is with how much evidence
+there is: one plain cue word gives about 0.63, two agreeing cue words about
+0.86. A threshold above 1 sends everything to the LLM.
+"""
+import math
+import os
+import re
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+SENTIMENT_CONFIDENCE_THRESHOLD = float(os.getenv("SENTIMENT_CONFIDENCE_THRESHOLD", "0.7"))
+
+MOODS = ("Senang", "Sedih", "Cemas", "Marah", "Tersipu")
+
+_WEAK = 0.5
+
+# Kata isyarat per mood; bobot default 1, kata yang ambigu diberi bobot lemah.
+_CUES: Dict[str, Dict[str, float]] = {
+    "Senang": {
+        **dict.fromkeys(
+            "senang bahagia gembira bersyukur syukur lega puas ceria semangat asyik seru "
+            "menyenangkan bangga cinta tertawa ketawa senyum tersenyum happy glad joy "
+            "joyful grateful thankful excited wonderful awesome amazing love loved relieved "
+            "proud enjoy enjoyed fun".split(),
+            1.0,
+        ),
+        **dict.fromkeys("suka tenang baik good great nice calm".split(), _WEAK),
+    },
+    "Sedih": {
+        **dict.fromkeys(
+            "sedih kecewa menangis nangis kesepian hampa galau hancur patah murung "
+            "kehilangan duka putus-asa sad unhappy depressed depresi lonely cry crying "
+            "cried heartbroken hopeless miserable grief empty disappointed".split(),
+            1.0,
+        ),
+        **dict.fromkeys("lelah capek sepi rindu tired down".split(), _WEAK),
+    },
+    "Cemas": {
+        **dict.fromkeys(
+            "cemas khawatir kuatir takut gelisah gugup panik tegang stres stress resah "
+            "overthinking anxious anxiety worried worry nervous afraid scared panic fear "
+            "tense uneasy restless".split(),
+            1.0,
+        ),
+        **dict.fromkeys("ragu bingung insomnia".split(), _WEAK),
+    },
+    "Marah": {
+        **dict.fromkeys(
+            "marah kesal jengkel benci geram murka dongkol sebal sebel muak frustrasi "
+            "angry mad furious annoyed irritated hate rage frustrated pissed".split(),
+            1.0,
+        ),
+        **dict.fromkeys("emosi".split(), _WEAK),
+    },
+    "Tersipu": {
+        **dict.fromkeys(
+            "malu tersipu salting salah-tingkah deg-degan baper blushing blush shy "
+            "embarrassed flustered".split(),
+            1.0,
+        ),
+        **dict.fromkeys("gebetan crush".split(), _WEAK),
+    },
+}
+_LEXICON: Dict[str, tuple] = {
+    word: (mood, weight) for mood, words in _CUES.items() for word, weight in words.items()
+}
+
+_NEGATIONS = frozenset(
+    "tidak tak bukan nggak ngga gak enggak ga belum not no never dont don't isn't wasn't "
+    "aren't didn't cannot can't".split()
+)
+# Penguat sebelum kata ("sangat sedih", "very sad") dan sesudahnya ("sedih banget").
+_INTENSIFIERS_BEFORE = frozenset("sangat amat terlalu sungguh very so really extremely super".split())
+_INTENSIFIERS_AFTER = frozenset("banget bgt sekali".split())
+_SUFFIXES = ("nya", "lah", "kah", "pun")
+
+_TOKEN = re.compile(r"[a-z]+(?:['-][a-z]+)*")
+
+
+@dataclass(frozen=True)
+class Prediction:
+    """Most likely mood (``None`` without any cue word) and its confidence."""
+
+    mood: Optional[str]
+    confidence: float
+    scores: Dict[str, float]
+
+    def is_confident(self, threshold: Optional[float] = None) -> bool:
+        if threshold is None:
+            threshold = SENTIMENT_CONFIDENCE_THRESHOLD
+        return self.mood is not None and self.confidence >= threshold
+
+
+def _lookup(token: str):
+    cue = _LEXICON.get(token)
+    if cue is None:
+        for suffix in _SUFFIXES:
+            if token.endswith(suffix) and len(token) > len(suffix) + 2:
+                cue = _LEXICON.get(token[: -len(suffix)])
+                if cue is not None:
+                    break
+    return cue
+
+
+def classify(text: str) -> Prediction:
+    """Score ``text`` against the mood lexicon."""
+    tokens = _TOKEN.findall(text.lower())
+    scores = dict.fromkeys(MOODS, 0.0)
+    for i, token in enumerate(tokens):
+        cue = _lookup(token)
+        if cue is None:
+            continue
+        mood, weight = cue
+        if i > 0 and tokens[i - 1] in _INTENSIFIERS_BEFORE:
+            weight *= 1.5
+        if i + 1 < len(tokens) and tokens[i + 1] in _INTENSIFIERS_AFTER:
+            weight *= 1.5
+        if any(t in _NEGATIONS for t in tokens[max(0, i - 2) : i]):
+            # "tidak senang" condong ke sedih; mood negatif yang disangkal
+            # ("tidak marah") tidak memberi petunjuk apa pun.
+            if mood != "Senang":
+                continue
+            mood, weight = "Sedih", weight * _WEAK
+        scores[mood] += weight
+
+    total = sum(scores.values())
+    if total == 0:
+        return Prediction(mood=None, confidence=0.0, scores=scores)
+    mood = max(MOODS, key=scores.__getitem__)
+    confidence = scores[mood] / total * (1 - math.exp(-total))
+    return Prediction(mood=mood, confidence=round(confidence, 4), scores=scores)
+
+
+def describe(prediction: Prediction) -> str:
+    """Text stored as the analysis when the local classifier is confident."""
+    return f"Mood terdeteksi: {prediction.mood}"
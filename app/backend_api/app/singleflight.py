@@ -0,0 +1,68 @@
+"""Request coalescing ("single-flight") for concurrent identical AI calls.
+
+While a call for a given key is in flight, further callers with the same key
+await the same task instead of starting their own upstream request, and all
+of them receive its result or its error.
+"""
+import asyncio
+import functools
+from typing import Any, Awaitable, Callable, Dict, Hashable, TypeVar
+
+from . import metrics
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """Deduplicate concurrent calls that share a key."""
+
+    def __init__(self) -> None:
+        self._calls: Dict[Hashable, "asyncio.Task[Any]"] = {}
+        self.started = 0
+        self.shared = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        """Run ``fn`` once for all concurrent callers of ``key``.
+
+        The call runs in its own task, so a caller that is cancelled (e.g. a
+        client that disconnects) does not cancel it for the others.
+        """
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            self.started += 1
+            metrics.singleflight_requests.inc("started")
+            task.add_done_callback(functools.partial(self._forget, key))
+        else:
+            self.shared += 1
+            metrics.singleflight_requests.inc("shared")
+        return await asyncio.shield(task)
+
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    def _forget(self, key: Hashable, task: "asyncio.Task[Any]") -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Tandai error sudah "dibaca" agar tidak muncul peringatan
+        # "exception was never retrieved" saat semua pemanggil sudah batal.
+        if not task.cancelled():
+            task.exception()
+
+
+flights = SingleFlight()
+
+
+def coalesce(fn: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+    """Decorate a coroutine function so identical concurrent calls share one run.
+
+    The key is the function plus its (hashable) arguments.
+    """
+
+    @functools.wraps(fn)
+    async def wrapper(*args: Any, **kwargs: Any) -> T:
+        key = (fn.__module__, fn.__qualname__, args, tuple(sorted(kwargs.items())))
+        return await flights.do(key, lambda: fn(*args, **kwargs))
+
+    return wrapper
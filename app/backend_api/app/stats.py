@@ -0,0 +1,151 @@
+"""Time-bucketed mood statistics with a cache for closed buckets.
+
+Counts are computed in SQL by :func:`app.crud.get_mood_timeseries`. A bucket
+whose end lies in the past ("closed") rarely changes, so its counts are kept
+in an in-process LRU and only the still-open tail of a range is queried.
+Entries synced late can still land in a closed bucket; writers call
+:func:`invalidate` for the timestamps they store, and ``STATS_CACHE_TTL``
+bounds staleness across workers.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import async_crud
+from .crud import MS_PER_DAY
+
+BUCKETS = ("day", "week", "month")
+MAX_BUCKETS = int(os.getenv("STATS_MAX_BUCKETS", "1000"))
+STATS_CACHE_TTL = float(os.getenv("STATS_CACHE_TTL", "300"))
+STATS_CACHE_MAX_ENTRIES = int(os.getenv("STATS_CACHE_MAX_ENTRIES", "10000"))
+
+_lock = threading.Lock()
+# Kunci: (user_id, bucket, bucket_start); user_id None untuk entri tanpa pemilik.
+_closed: "OrderedDict[Tuple[Optional[int], str, int], Tuple[float, Dict[str, int]]]" = OrderedDict()
+
+
+def bucket_start(bucket: str, timestamp: int) -> int:
+    """Return the UTC start (ms) of the bucket containing ``timestamp``."""
+    days = timestamp // MS_PER_DAY
+    if bucket == "day":
+        return days * MS_PER_DAY
+    if bucket == "week":
+        return ((days + 3) // 7 * 7 - 3) * MS_PER_DAY
+    moment = datetime.fromtimestamp(timestamp // 1000, tz=timezone.utc)
+    first = moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    return int(first.timestamp()) * 1000
+
+
+def next_bucket_start(bucket: str, start: int) -> int:
+    """Return the start of the bucket following the one starting at ``start``."""
+    if bucket == "day":
+        return start + MS_PER_DAY
+    if bucket == "week":
+        return start + 7 * MS_PER_DAY
+    moment = datetime.fromtimestamp(start // 1000, tz=timezone.utc)
+    if moment.month == 12:
+        moment = moment.replace(year=moment.year + 1, month=1)
+    else:
+        moment = moment.replace(month=moment.month + 1)
+    return int(moment.timestamp()) * 1000
+
+
+def bucket_ranges(bucket: str, start: int, end: int) -> List[Tuple[int, int]]:
+    """Return ``(bucket_start, next_bucket_start)`` pairs covering ``[start, end]``.
+
+    Raises:
+        ValueError: If the range is inverted or spans more than ``MAX_BUCKETS``.
+    """
+    if end < start:
+        raise ValueError("'to' harus lebih besar atau sama dengan 'from'")
+    ranges = []
+    current = bucket_start(bucket, start)
+    while current <= end:
+        following = next_bucket_start(bucket, current)
+        ranges.append((current, following))
+        if len(ranges) > MAX_BUCKETS:
+            raise ValueError(f"Rentang melebihi {MAX_BUCKETS} bucket")
+        current = following
+    return ranges
+
+
+def _get_cached(key: Tuple[Optional[int], str, int]) -> Optional[Dict[str, int]]:
+    with _lock:
+        item = _closed.get(key)
+        if item is None:
+            return None
+        if item[0] <= time.monotonic():
+            del _closed[key]
+            return None
+        _closed.move_to_end(key)
+        return item[1]
+
+
+def _set_cached(key: Tuple[Optional[int], str, int], counts: Dict[str, int]) -> None:
+    with _lock:
+        _closed[key] = (time.monotonic() + STATS_CACHE_TTL, counts)
+        _closed.move_to_end(key)
+        while len(_closed) > STATS_CACHE_MAX_ENTRIES:
+            _closed.popitem(last=False)
+
+
+def invalidate(timestamps: Iterable[int], user_id: Optional[int] = None) -> None:
+    """Drop cached buckets of ``user_id`` that contain any of ``timestamps``."""
+    with _lock:
+        for timestamp in timestamps:
+            for bucket in BUCKETS:
+                _closed.pop((user_id, bucket, bucket_start(bucket, timestamp)), None)
+
+
+def clear() -> None:
+    with _lock:
+        _closed.clear()
+
+
+async def mood_timeseries(
+    db: AsyncSession,
+    bucket: str,
+    start: int,
+    end: int,
+    now: Optional[int] = None,
+    user_id: Optional[int] = None,
+) -> List[Tuple[int, int, Dict[str, int]]]:
+    """Return ``(bucket_start, bucket_end, counts)`` of ``user_id`` for every bucket in range.
+
+    Buckets that lie entirely inside ``[start, end]`` and ended before
+    ``now`` are served from (and stored into) the closed-bucket cache; the
+    rest is counted with a single SQL query.
+    """
+    now = int(time.time() * 1000) if now is None else now
+    ranges = bucket_ranges(bucket, start, end)
+
+    def cacheable(first: int, following: int) -> bool:
+        return first >= start and following - 1 <= end and following <= now
+
+    counts: Dict[int, Dict[str, int]] = {}
+    uncached_from = None
+    for first, following in ranges:
+        key = (user_id, bucket, first)
+        cached = _get_cached(key) if cacheable(first, following) else None
+        if cached is None:
+            uncached_from = first if uncached_from is None else uncached_from
+        elif uncached_from is None:
+            counts[first] = cached
+
+    if uncached_from is not None:
+        fresh = await async_crud.get_mood_timeseries(
+            db, bucket, max(start, uncached_from), end, user_id
+        )
+        for first, following in ranges:
+            if first < uncached_from:
+                continue
+            counts[first] = fresh.get(first, {})
+            if cacheable(first, following):
+                _set_cached((user_id, bucket, first), counts[first])
+
+    return [(first, following, counts[first]) for first, following in ranges]
@@ -0,0 +1,371 @@
+"""Benchmark harness for the backend API hot paths.
+
+``run`` seeds a fresh database (SQLite file by default, or ``--database-url``)
+with N entries and N users, starts the API with uvicorn next to a local fake
+OpenRouter (``fake_openrouter.py``) and drives every scenario over HTTP,
+recording throughput and p50/p95/p99 latency. The AI rate limiter is off
+unless ``--rate-limit`` picks a backend; 429 answers are counted as
+``rate_limited``, apart from real errors. ``compare`` checks a result file
+against a baseline and exits with status 1 on regressions::
+
+    python benchmarks/bench.py run --entries 5000 --users 200 --output new.json
+    python benchmarks/bench.py compare baseline.json new.json --max-regression 0.15
+
+Run from the repository root.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND_DIR = os.path.join(ROOT, "app", "backend_api")
+BENCH_PASSWORD = "bench-password"
+MOODS = ("Senang", "Sedih", "Cemas", "Marah", "Tersipu")
+ACTIVITIES = ("Lari", "Baca", "Kerja", "Tidur", "Masak")
+
+# (method, path, body) untuk satu permintaan; dibuat ulang untuk setiap request.
+RequestSpec = Tuple[str, str, Optional[Dict[str, Any]]]
+
+
+def percentile(sorted_values: Sequence[float], q: float) -> float:
+    """Linear-interpolated percentile ``q`` (0-100) of already sorted values."""
+    if not sorted_values:
+        return 0.0
+    rank = (len(sorted_values) - 1) * q / 100
+    low = int(rank)
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (rank - low)
+
+
+def summarize(
+    latencies: List[float], errors: int, elapsed: float, rate_limited: int = 0
+) -> Dict[str, float]:
+    """Turn raw per-request latencies (seconds) into the reported metrics."""
+    ordered = sorted(latencies)
+    total = len(latencies) + errors + rate_limited
+    return {
+        "requests": total,
+        "errors": errors,
+        "error_rate": errors / total if total else 0.0,
+        "rate_limited": rate_limited,
+        "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(ordered, 50) * 1000,
+        "p95_ms": percentile(ordered, 95) * 1000,
+        "p99_ms": percentile(ordered, 99) * 1000,
+    }
+
+
+def compare(
+    baseline: Dict[str, Any], current: Dict[str, Any], max_regression: float
+) -> List[str]:
+    """Return human-readable regressions of ``current`` against ``baseline``.
+
+    A scenario regresses when its p95 latency grows, or its throughput
+    drops, by more than ``max_regression`` (a fraction), its error rate
+    increases by more than one percentage point, or it gets more 429s than
+    the baseline (its latencies then no longer measure the same work).
+    """
+    problems = []
+    for name, base in baseline["results"].items():
+        new = current["results"].get(name)
+        if new is None:
+            problems.append(f"{name}: tidak ada di hasil baru")
+            continue
+        if base["p95_ms"] and new["p95_ms"] > base["p95_ms"] * (1 + max_regression):
+            problems.append(
+                f"{name}: p95 {base['p95_ms']:.1f} -> {new['p95_ms']:.1f} ms"
+            )
+        if base["throughput_rps"] and new["throughput_rps"] < base["throughput_rps"] * (
+            1 - max_regression
+        ):
+            problems.append(
+                f"{name}: throughput {base['throughput_rps']:.1f} -> {new['throughput_rps']:.1f} rps"
+            )
+        if new["error_rate"] > base["error_rate"] + 0.01:
+            problems.append(
+                f"{name}: error rate {base['error_rate']:.2%} -> {new['error_rate']:.2%}"
+            )
+        # Hasil lama belum punya rate_limited.
+        if new.get("rate_limited", 0) > base.get("rate_limited", 0):
+            problems.append(
+                f"{name}: rate limited (429) {base.get('rate_limited', 0)} -> {new['rate_limited']}"
+            )
+    return problems
+
+
+def seed(database_url: str, entries: int, users: int, bcrypt_rounds: int) -> None:
+    """Fill a fresh database with ``entries`` anonymous entries and ``users`` users."""
+    os.environ["SQLALCHEMY_DATABASE_URL"] = database_url
+    os.environ["BCRYPT_ROUNDS"] = str(bcrypt_rounds)
+    sys.path.insert(0, BACKEND_DIR)
+    from app import crud, models, passwords, schemas
+    from app.database import SessionLocal, engine
+
+    models.Base.metadata.create_all(bind=engine)
+    rng = random.Random(42)
+    hashed = passwords.pwd_context.hash(BENCH_PASSWORD)
+    with SessionLocal() as db:
+        db.add_all(
+            models.User(email=f"user{i}@bench.local", name=f"User {i}", hashed_password=hashed)
+            for i in range(users)
+        )
+        db.commit()
+        for start in range(0, entries, 500):
+            batch = [
+                schemas.DiaryEntryCreate(
+                    content=f"Catatan ke-{i} tentang hari yang {rng.choice(['baik', 'berat', 'biasa'])}",
+                    mood=rng.choice(MOODS),
+                    timestamp=1_700_000_000_000 + i * 60_000,
+                    activities=rng.sample(ACTIVITIES, 2),
+                )
+                for i in range(start, min(start + 500, entries))
+            ]
+            crud.create_diary_entries(db, batch)
+
+
+def scenarios(entries: int, users: int) -> Dict[str, Callable[[random.Random], RequestSpec]]:
+    def entry_body(rng: random.Random) -> Dict[str, Any]:
+        return {
+            "content": f"Entri benchmark {uuid.uuid4().hex}",
+            "mood": rng.choice(MOODS),
+            "timestamp": int(time.time() * 1000),
+            "activities": rng.sample(ACTIVITIES, 2),
+        }
+
+    def login_body(rng: random.Random) -> Dict[str, Any]:
+        return {"email": f"user{rng.randrange(users)}@bench.local", "password": BENCH_PASSWORD}
+
+    def unique_text(_rng: random.Random) -> Dict[str, Any]:
+        return {"text": f"Hari ini aku merasa lelah {uuid.uuid4().hex}"}
+
+    return {
+        "entries_create": lambda rng: ("POST", "/entries/", entry_body(rng)),
+        "entries_list": lambda rng: ("GET", "/entries/?limit=50", None),
+        "entries_get": lambda rng: ("GET", f"/entries/{rng.randint(1, max(entries, 1))}", None),
+        "stats": lambda rng: ("GET", "/stats/", None),
+        "register": lambda rng: (
+            "POST",
+            "/register/",
+            {"email": f"{uuid.uuid4().hex}@bench.local", "password": BENCH_PASSWORD, "name": "B"},
+        ),
+        "login": lambda rng: ("POST", "/login/", login_body(rng)),
+        "analyze": lambda rng: ("POST", "/analyze/", unique_text(rng)),
+        "chat": lambda rng: ("POST", "/chat/", unique_text(rng)),
+        "articles": lambda rng: ("POST", "/articles/", unique_text(rng)),
+    }
+
+
+async def run_scenario(
+    client: httpx.AsyncClient,
+    make_request: Callable[[random.Random], RequestSpec],
+    requests: int,
+    concurrency: int,
+    warmup: int,
+) -> Dict[str, float]:
+    """Send ``requests`` requests with ``concurrency`` workers and summarize them."""
+    rng = random.Random(7)
+    latencies: List[float] = []
+    errors = rate_limited = 0
+    remaining = iter(range(requests))
+
+    async def send(record: bool) -> None:
+        nonlocal errors, rate_limited
+        method, path, body = make_request(rng)
+        started = time.perf_counter()
+        try:
+            status = (await client.request(method, path, json=body)).status_code
+        except httpx.HTTPError:
+            status = None
+        if not record:
+            return
+        if status is not None and status < 400:
+            latencies.append(time.perf_counter() - started)
+        elif status == 429:
+            rate_limited += 1
+        else:
+            errors += 1
+
+    async def worker() -> None:
+        for _ in remaining:
+            await send(record=True)
+
+    for _ in range(warmup):
+        await send(record=False)
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - started, rate_limited)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_until_up(port: int, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Server di port {port} tidak merespons dalam {timeout} detik")
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    workdir = tempfile.mkdtemp(prefix="diary-bench-")
+    database_url = args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    seed(database_url, args.entries, args.users, args.bcrypt_rounds)
+
+    fake_port, api_port = _free_port(), _free_port()
+    env = {
+        **os.environ,
+        "SQLALCHEMY_DATABASE_URL": database_url,
+        "OPENROUTER_BASE_URL": f"http://127.0.0.1:{fake_port}",
+        "OPENROUTER_API_KEY": "bench",
+        "BCRYPT_ROUNDS": str(args.bcrypt_rounds),
+        "AI_CACHE_BACKEND": args.ai_cache,
+        "RATE_LIMIT_BACKEND": args.rate_limit,
+        "RATE_LIMIT_PATH": os.path.join(workdir, "rate_limit.db"),
+    }
+    processes = [
+        subprocess.Popen(
+            [
+                sys.executable,
+                os.path.join(ROOT, "benchmarks", "fake_openrouter.py"),
+                "--port", str(fake_port),
+                "--latency", str(args.upstream_latency),
+                "--jitter", str(args.upstream_jitter),
+            ],
+            env=env,
+        ),
+        subprocess.Popen(
+            [
+                sys.executable, "-m", "uvicorn", "app.main:app",
+                "--port", str(api_port),
+                "--workers", str(args.workers),
+                "--log-level", "warning",
+            ],
+            cwd=BACKEND_DIR,
+            env=env,
+        ),
+    ]
+    try:
+        _wait_until_up(fake_port)
+        _wait_until_up(api_port)
+        results = asyncio.run(_run_all(args, f"http://127.0.0.1:{api_port}"))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait(timeout=10)
+
+    return {
+        "meta": {
+            "created_at": int(time.time()),
+            "git_commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "database": "sqlite" if args.database_url is None else args.database_url.split(":")[0],
+            **{k: v for k, v in vars(args).items() if k not in ("func", "database_url", "output")},
+        },
+        "results": results,
+    }
+
+
+async def _run_all(args: argparse.Namespace, base_url: str) -> Dict[str, Dict[str, float]]:
+    selected = scenarios(args.entries, args.users)
+    if args.only:
+        selected = {name: selected[name] for name in args.only}
+    limits = httpx.Limits(max_connections=args.concurrency)
+    results = {}
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        for name, make_request in selected.items():
+            results[name] = await run_scenario(
+                client, make_request, args.requests, args.concurrency, args.warmup
+            )
+            r = results[name]
+            print(
+                f"{name:16} {r['throughput_rps']:8.1f} rps  p50 {r['p50_ms']:7.1f}  "
+                f"p95 {r['p95_ms']:7.1f}  p99 {r['p99_ms']:7.1f} ms  errors {r['errors']}  429 {r['rate_limited']}",
+                file=sys.stderr,
+            )
+    return results
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT, text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Seed, start the API and measure every scenario")
+    run_parser.add_argument("--database-url", help="default: fresh SQLite file in a temp dir")
+    run_parser.add_argument("--entries", type=int, default=1000)
+    run_parser.add_argument("--users", type=int, default=100)
+    run_parser.add_argument("--requests", type=int, default=200, help="per scenario")
+    run_parser.add_argument("--concurrency", type=int, default=10)
+    run_parser.add_argument("--warmup", type=int, default=10)
+    run_parser.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+    run_parser.add_argument("--bcrypt-rounds", type=int, default=12)
+    run_parser.add_argument("--upstream-latency", type=float, default=0.2, help="seconds")
+    run_parser.add_argument("--upstream-jitter", type=float, default=0.02, help="seconds")
+    run_parser.add_argument("--ai-cache", default="none", choices=("none", "memory", "sqlite"))
+    run_parser.add_argument(
+        "--rate-limit",
+        default="none",
+        choices=("none", "memory", "sqlite"),
+        help="AI rate limiter backend (default: off, so it does not throttle the load)",
+    )
+    run_parser.add_argument("--only", nargs="+", choices=sorted(scenarios(1, 1)))
+    run_parser.add_argument("--output", help="write the JSON result here (default: stdout)")
+
+    compare_parser = commands.add_parser("compare", help="Fail if a result regressed against a baseline")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--max-regression", type=float, default=0.10)
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        result = run(args)
+        text = json.dumps(result, indent=2)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(text + "\n")
+        else:
+            print(text)
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    problems = compare(baseline, current, args.max_regression)
+    for problem in problems:
+        print(f"REGRESI {problem}")
+    if not problems:
+        print("Tidak ada regresi")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,88 @@
+"""Local stand-in for the OpenRouter chat completions API.
+
+Answers ``POST /chat/completions`` after a configurable delay with content
+shaped like what each backend prompt expects (analysis JSON, chat turn JSON,
+article list or plain text), so the AI routes can be benchmarked without
+network access or cost::
+
+    python benchmarks/fake_openrouter.py --port 8999 --latency 0.2 --jitter 0.05
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+LATENCY = 0.1
+JITTER = 0.0
+
+
+def _content_for(messages) -> str:
+    """Pick a reply matching the format the prompt asks for."""
+    prompt = " ".join(str(m.get("content", "")) for m in messages)
+    if "'reply'" in prompt:
+        return json.dumps(
+            {"issue": "stres", "technique": "napas", "tone": "hangat", "reply": "Tarik napas pelan."}
+        )
+    if "'issue'" in prompt:
+        return json.dumps({"issue": "stres", "technique": "napas", "tone": "hangat"})
+    if "'title'" in prompt:
+        return json.dumps(
+            [{"title": f"Judul {i}", "summary": "Ringkasan singkat."} for i in range(3)]
+        )
+    return "Positif"
+
+
+async def chat_completions(request: Request) -> JSONResponse:
+    body = await request.json()
+    await asyncio.sleep(max(0.0, random.gauss(LATENCY, JITTER)))
+    content = _content_for(body.get("messages", []))
+    prompt_tokens = sum(len(str(m.get("content", "")).split()) for m in body.get("messages", []))
+    completion_tokens = len(content.split())
+    return JSONResponse(
+        {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+    )
+
+
+app = Starlette(routes=[Route("/chat/completions", chat_completions, methods=["POST"])])
+
+
+def main() -> None:
+    global LATENCY, JITTER
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8999)
+    parser.add_argument("--latency", type=float, default=LATENCY, help="mean delay in seconds")
+    parser.add_argument("--jitter", type=float, default=JITTER, help="delay stddev in seconds")
+    args = parser.parse_args()
+    LATENCY, JITTER = args.latency, args.jitter
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
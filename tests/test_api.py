@@ -1,8 +1,9 @@
 import sys
 import os
+import asyncio
+import json
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.pool import StaticPool
 import pytest
 import requests
@@ -12,32 +13,74 @@ os.environ["SQLALCHEMY_DATABASE_URL"] = "sqlite:///:memory:"
 sys.path.append("app/backend_api")
 
 from app.main import app
-from app import models
-from app.database import Base, get_db
+from app import cache, metrics, models, ratelimit, stats
+from app.database import Base, get_async_db
+
+
+async def _create_tables(engine):
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
 
 
 @pytest.fixture
-def client():
-    engine = create_engine(
-        "sqlite://",
+def client(monkeypatch):
+    engine = create_async_engine(
+        "sqlite+aiosqlite://",
         connect_args={"check_same_thread": False},
         poolclass=StaticPool,
     )
-    TestingSessionLocal = sessionmaker(
-        autocommit=False, autoflush=False, bind=engine, future=True
+    TestingSessionLocal = async_sessionmaker(
+        bind=engine, autoflush=False, expire_on_commit=False
     )
-    Base.metadata.create_all(bind=engine)
 
-    def override_get_db():
-        db = TestingSessionLocal()
-        try:
+    async def override_get_async_db():
+        async with TestingSessionLocal() as db:
             yield db
-        finally:
-            db.close()
 
-    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_async_db] = override_get_async_db
+    metrics.instrument_engine(engine.sync_engine)
+    metrics.clear()
+    ratelimit.ai_limiter.clear()
+    cache.ai_cache.clear()
+    stats.clear()
+    monkeypatch.setattr("app.openrouter_client.OPENROUTER_RETRY_BASE_DELAY", 0)
     with TestClient(app) as c:
+        c.portal.call(_create_tables, engine)
         yield c
+        c.portal.call(engine.dispose)
+
+
+def _model_client(create):
+    """Fake ``AsyncOpenAI`` whose ``chat.completions.create`` is the coroutine ``create``."""
+    return type(
+        "Client",
+        (),
+        {"chat": type("Chat", (), {"completions": type("Comp", (), {"create": create})()})()},
+    )()
+
+
+def _returning(value):
+    async def create(_self, **kw):
+        return value
+
+    return create
+
+
+def _raising(error):
+    async def create(_self, **kw):
+        raise error
+
+    return create
+
+
+def _scripted_client(contents, calls):
+    async def create(_self, **kw):
+        calls.append(kw)
+        content = contents[len(calls) - 1]
+        message = type("M", (), {"content": content})()
+        return type("R", (), {"choices": [type("C", (), {"message": message})()]})()
+
+    return _model_client(create)
 
 
 def test_create_and_get_entries(client):
@@ -60,6 +103,362 @@ def test_create_and_get_entries(client):
     assert len(resp.json()) == 1
 
 
+def test_list_entries_cursor_pagination(client):
+    for ts in (1, 2, 2, 3):
+        client.post(
+            "/entries/",
+            json={"content": f"e{ts}", "mood": "Senang", "timestamp": ts},
+        )
+
+    first = client.get("/entries/", params={"limit": 2})
+    assert [e["timestamp"] for e in first.json()] == [3, 2]
+    cursor = first.headers["X-Next-Cursor"]
+
+    second = client.get("/entries/", params={"limit": 2, "cursor": cursor})
+    assert [e["timestamp"] for e in second.json()] == [2, 1]
+    ids = {e["id"] for e in first.json()} | {e["id"] for e in second.json()}
+    assert len(ids) == 4
+
+    third = client.get(
+        "/entries/", params={"limit": 2, "cursor": second.headers["X-Next-Cursor"]}
+    )
+    assert third.json() == []
+    assert "X-Next-Cursor" not in third.headers
+
+
+def test_list_entries_invalid_cursor(client):
+    resp = client.get("/entries/", params={"cursor": "!!!"})
+    assert resp.status_code == 400
+
+
+def test_export_entries_ndjson(client):
+    for ts in (1, 2, 3):
+        client.post(
+            "/entries/",
+            json={"content": f"e{ts}", "mood": "Cemas", "timestamp": ts, "activities": ["A", "B"]},
+        )
+
+    resp = client.get("/entries/export", params={"batch_size": 2})
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in resp.text.splitlines()]
+    assert [line["timestamp"] for line in lines] == [3, 2, 1]
+    assert lines[0]["activities"] == ["A", "B"]
+
+
+def test_search_entries_ranked_with_highlight(client):
+    for ts, content in enumerate(
+        [
+            "Hari ini aku pergi ke pantai bersama teman",
+            "Pantai pantai pantai, aku rindu pantai",
+            "Belajar untuk ujian besok",
+        ]
+    ):
+        client.post(
+            "/entries/", json={"content": content, "mood": "Senang", "timestamp": ts}
+        )
+
+    resp = client.get("/entries/search", params={"q": "pantai"})
+    assert resp.status_code == 200
+    hits = resp.json()
+    assert [h["content"][:6] for h in hits] == ["Pantai", "Hari i"]
+    assert "<mark>pantai</mark>" in hits[1]["highlight"]
+
+    assert client.get("/entries/search", params={"q": "pantai teman"}).json()[0]["timestamp"] == 0
+    assert client.get("/entries/search", params={"q": "\"OR*"}).json() == []
+
+
+def test_search_entries_cursor(client):
+    for ts in range(3):
+        client.post(
+            "/entries/", json={"content": f"catatan {ts}", "mood": "Sedih", "timestamp": ts}
+        )
+
+    first = client.get("/entries/search", params={"q": "catatan", "limit": 2})
+    second = client.get(
+        "/entries/search",
+        params={"q": "catatan", "limit": 2, "cursor": first.headers["X-Next-Cursor"]},
+    )
+    ids = [h["id"] for h in first.json() + second.json()]
+    assert len(ids) == len(set(ids)) == 3
+    assert "X-Next-Cursor" not in second.headers
+    assert client.get("/entries/search", params={"q": "x", "cursor": "!!!"}).status_code == 400
+
+
+def test_search_entries_unsupported_dialect(client, monkeypatch):
+    from app import crud
+
+    monkeypatch.delitem(crud._SEARCH_SQL, "sqlite")
+    resp = client.get("/entries/search", params={"q": "pantai"})
+    assert resp.status_code == 501
+    assert "sqlite" in resp.json()["detail"]
+
+
+def test_create_entries_batch(client):
+    payload = {
+        "entries": [
+            {"content": "a", "mood": "Senang", "timestamp": 1, "client_id": "k1"},
+            {"content": "b", "mood": "Sedih", "timestamp": 2, "activities": ["X"]},
+            {"content": "c", "mood": "Cemas", "timestamp": 3, "client_id": "k2"},
+        ]
+    }
+    resp = client.post("/entries/batch", json=payload)
+    assert resp.status_code == 201
+    data = resp.json()
+    assert [e["content"] for e in data] == ["a", "b", "c"]
+    assert data[1]["activities"] == ["X"]
+    assert len({e["id"] for e in data}) == 3
+
+
+def test_create_entries_batch_is_idempotent(client):
+    first = client.post(
+        "/entries/batch",
+        json={"entries": [{"content": "a", "mood": "Senang", "timestamp": 1, "client_id": "k1"}]},
+    )
+    retry = client.post(
+        "/entries/batch",
+        json={
+            "entries": [
+                {"content": "a", "mood": "Senang", "timestamp": 1, "client_id": "k1"},
+                {"content": "d", "mood": "Marah", "timestamp": 4, "client_id": "k3"},
+                {"content": "d", "mood": "Marah", "timestamp": 4, "client_id": "k3"},
+            ]
+        },
+    )
+    assert retry.status_code == 201
+    ids = [e["id"] for e in retry.json()]
+    assert ids[0] == first.json()[0]["id"]
+    assert ids[1] == ids[2]
+
+    single = client.post(
+        "/entries/",
+        json={"content": "a", "mood": "Senang", "timestamp": 1, "client_id": "k1"},
+    )
+    assert single.json()["id"] == ids[0]
+    assert len(client.get("/entries/").json()) == 2
+
+
+def test_to_async_url():
+    from app.database import to_async_url
+
+    assert to_async_url("sqlite:///./diary.db") == "sqlite+aiosqlite:///./diary.db"
+    assert (
+        to_async_url("postgresql://u:p@db/diary")
+        == "postgresql+asyncpg://u:p@db/diary"
+    )
+    assert to_async_url("sqlite+aiosqlite://") == "sqlite+aiosqlite://"
+
+
+def test_sqlite_engine_pragmas_and_pool(tmp_path):
+    from sqlalchemy import text
+    from app.database import create_db_engine, pool_stats
+
+    engine = create_db_engine(f"sqlite:///{tmp_path / 'tuned.db'}")
+    with engine.connect() as conn:
+        assert conn.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert conn.execute(text("PRAGMA synchronous")).scalar() == 1  # NORMAL
+        assert conn.execute(text("PRAGMA busy_timeout")).scalar() == 5000
+        # Penegakan foreign key tidak diubah dari bawaan SQLite.
+        assert conn.execute(text("PRAGMA foreign_keys")).scalar() == 0
+        assert pool_stats(engine)["checkedout"] == 1
+    assert pool_stats(engine) == {
+        "pool": "QueuePool", "size": 5, "checkedin": 1, "checkedout": 0, "overflow": -4
+    }
+    engine.dispose()
+
+
+def test_engine_options_for_postgres():
+    from app.database import engine_options
+
+    options = engine_options("postgresql://u:p@db/diary")
+    assert options["pool_pre_ping"] is True
+    assert options["pool_recycle"] == 1800
+    assert "connect_args" not in options
+
+
+def test_database_health(client):
+    body = client.get("/health/db").json()
+    assert {"sync", "async"} <= body.keys()
+    assert "pool" in body["async"]
+
+
+def test_metrics_record_routes_queries_and_upstream_calls(client, monkeypatch):
+    created = client.post("/entries/", json={"content": "a", "mood": "Senang", "timestamp": 1})
+    client.get(f"/entries/{created.json()['id']}")
+    client.get("/entries/999999")
+
+    usage = type("U", (), {"prompt_tokens": 12, "completion_tokens": 3})()
+    response = type(
+        "R",
+        (),
+        {
+            "choices": [type("C", (), {"message": type("M", (), {"content": "Positif"})()})()],
+            "usage": usage,
+        },
+    )()
+    fake = type(
+        "Client",
+        (),
+        {
+            "chat": type(
+                "Chat", (), {"completions": type("Comp", (), {"create": _returning(response)})()}
+            )()
+        },
+    )()
+    monkeypatch.setenv("OPENROUTER_API_KEY", "dummy")
+    monkeypatch.setattr("app.openrouter.get_openrouter_client", lambda: fake)
+    assert client.post("/analyze/", json={"text": "senang"}).status_code == 200
+
+    assert metrics.http_requests.value("GET", "/entries/{entry_id}", "200") == 1
+    assert metrics.http_requests.value("GET", "/entries/{entry_id}", "404") == 1
+    assert metrics.http_request_db_queries.sum("POST", "/entries/") >= 1
+    assert metrics.http_request_upstream_duration.count("POST", "/analyze/") == 1
+    assert metrics.http_request_upstream_duration.sum("POST", "/analyze/") > 0
+
+    body = client.get("/metrics").text
+    assert 'openrouter_tokens_total{model="' in body
+    assert 'operation="analyze",kind="prompt"} 12' in body
+    assert 'http_request_duration_seconds_bucket{method="GET",route="/entries/{entry_id}",le="+Inf"} 2' in body
+
+    # Analisis kedua dengan teks yang sama dijawab dari cache.
+    assert client.post("/analyze/", json={"text": "senang"}).status_code == 200
+    body = client.get("/metrics").text
+    assert 'ai_cache_requests_total{namespace="analyze",result="miss"} 1' in body
+    assert 'ai_cache_requests_total{namespace="analyze",result="hit"} 1' in body
+    assert 'singleflight_requests_total{kind="started"} 1' in body
+
+
+def test_metrics_count_upstream_errors_by_class(client, monkeypatch):
+    async def boom(_s, **kw):
+        raise httpx.ConnectError("down")
+
+    fake = type(
+        "Client",
+        (),
+        {"chat": type("Chat", (), {"completions": type("Comp", (), {"create": boom})()})()},
+    )()
+    monkeypatch.setenv("OPENROUTER_API_KEY", "dummy")
+    monkeypatch.setattr("app.ai_utils.get_openrouter_client", lambda: fake)
+    assert client.post("/chat/", json={"text": "hi"}).status_code == 502
+
+    from app.openrouter_client import OPENROUTER_MAX_RETRIES, OPENROUTER_MODEL
+
+    attempts = OPENROUTER_MAX_RETRIES + 1
+    assert metrics.upstream_errors.value(OPENROUTER_MODEL, "chat_analysis", "ConnectError") == attempts
+    assert metrics.upstream_retries.value(OPENROUTER_MODEL, "chat_analysis") == attempts - 1
+
+
+def test_ai_rate_limit_rejects_before_upstream_call(client, monkeypatch):
+    from app import auth
+
+    calls = []
+    monkeypatch.setenv("OPENROUTER_API_KEY", "dummy")
+    monkeypatch.setattr(
+        "app.openrouter.get_openrouter_client", lambda: _scripted_client(["Positif"] * 10, calls)
+    )
+    monkeypatch.setattr(
+        ratelimit,
+        "ai_limiter",
+        ratelimit.RateLimiter(
+            ratelimit.MemoryBuckets(100),
+            user=ratelimit.Limit(rate=1 / 60, burst=1),
+            ip=ratelimit.Limit(rate=1 / 60, burst=2),
+        ),
+    )
+    token, _ = auth.create_access_token(7)
+    headers = {"Authorization": f"Bearer {token}", "X-Cache-Bypass": "1"}
+
+    assert client.post("/analyze/", json={"text": "a"}, headers=headers).status_code == 200
+    # Bucket pengguna habis; IP yang sama masih punya satu token untuk anonim.
+    limited = client.post("/analyze/", json={"text": "b"}, headers=headers)
+    assert limited.status_code == 429
+    assert limited.headers["Retry-After"] == "60"
+    assert client.post("/analyze/", json={"text": "c"}).status_code == 200
+    assert client.post("/analyze/", json={"text": "d"}).status_code == 429
+    assert len(calls) == 2
+    assert metrics.rate_limited.value("user") == 1
+    assert metrics.rate_limited.value("ip") == 1
+
+
+def test_sqlite_rate_limit_buckets_are_shared(tmp_path):
+    path = str(tmp_path / "rate.db")
+    first, second = ratelimit.SQLiteBuckets(path), ratelimit.SQLiteBuckets(path)
+    buckets = [("global", ratelimit.Limit(rate=1, burst=2))]
+    try:
+        assert first.acquire(buckets) == (0.0, None)
+        assert second.acquire(buckets) == (0.0, None)
+        retry_after, blocked = first.acquire(buckets)
+        assert blocked == "global"
+        assert 0 < retry_after <= 1
+    finally:
+        first.close()
+        second.close()
+
+
+def test_reads_go_to_replica_except_right_after_write(client, monkeypatch):
+    from app import replicas
+
+    replica = create_async_engine(
+        "sqlite+aiosqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool
+    )
+    client.portal.call(_create_tables, replica)
+    monkeypatch.setattr(
+        replicas,
+        "replica_sessions",
+        [async_sessionmaker(bind=replica, autoflush=False, expire_on_commit=False)],
+    )
+    replicas.clear()
+
+    resp = client.post("/entries/", json={"content": "baru", "mood": "Senang", "timestamp": 1})
+    assert replicas.PRIMARY_COOKIE in resp.cookies
+    # Setelah menulis, klien membaca dari primary sehingga entrinya terlihat.
+    assert len(client.get("/entries/").json()) == 1
+
+    replicas.clear()
+    # Worker lain tidak tahu penulisan ini, tetapi cookie tetap mengarahkan ke primary.
+    assert len(client.get("/entries/").json()) == 1
+
+    client.cookies.clear()
+    # Replika (kosong di tes ini) melayani pembacaan berikutnya.
+    assert client.get("/entries/").json() == []
+    assert client.get("/stats/").json() == {"stats": {}}
+    client.portal.call(replica.dispose)
+
+
+def test_anonymous_writes_are_sticky_only_through_the_cookie(client, monkeypatch):
+    from app import auth, replicas
+
+    replica = create_async_engine(
+        "sqlite+aiosqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool
+    )
+    client.portal.call(_create_tables, replica)
+    monkeypatch.setattr(
+        replicas,
+        "replica_sessions",
+        [async_sessionmaker(bind=replica, autoflush=False, expire_on_commit=False)],
+    )
+    replicas.clear()
+
+    client.post("/entries/", json={"content": "anonim", "mood": "Senang", "timestamp": 1})
+    assert not replicas._recent_writes
+    client.cookies.clear()
+    # Tanpa cookie, penulisan anonim tidak menahan klien anonim lain di primary.
+    assert client.get("/entries/").json() == []
+
+    token, _ = auth.create_access_token(7)
+    headers = {"Authorization": f"Bearer {token}"}
+    client.post(
+        "/entries/",
+        json={"content": "milik 7", "mood": "Senang", "timestamp": 2},
+        headers=headers,
+    )
+    client.cookies.clear()
+    # Penulis terautentikasi tetap dikenali di proses ini walau cookie hilang.
+    assert [e["content"] for e in client.get("/entries/", headers=headers).json()] == ["milik 7"]
+    assert client.get("/entries/").json() == []
+    client.portal.call(replica.dispose)
+
+
 def test_mood_stats(client):
     client.post(
         "/entries/",
@@ -74,6 +473,312 @@ def test_mood_stats(client):
     assert resp.json()["stats"] == {"Sedih": 2}
 
 
+def test_mood_stats_counts_batch_entries(client):
+    client.post(
+        "/entries/batch",
+        json={
+            "entries": [
+                {"content": "a", "mood": "Senang", "timestamp": 1, "client_id": "k1"},
+                {"content": "b", "mood": "Senang", "timestamp": 86_400_001},
+                {"content": "c", "mood": "Marah", "timestamp": 2},
+            ]
+        },
+    )
+    # Sinkronisasi ulang tidak boleh menambah hitungan.
+    client.post(
+        "/entries/batch",
+        json={"entries": [{"content": "a", "mood": "Senang", "timestamp": 1, "client_id": "k1"}]},
+    )
+    assert client.get("/stats/").json()["stats"] == {"Senang": 2, "Marah": 1}
+
+
+def test_mood_timeseries_buckets(client):
+    day = 86_400_000
+    # 2024-01-01 (Senin) dan 2024-01-31, 2024-02-01.
+    jan1, jan31, feb1 = 1704067200000, 1706659200000, 1706745600000
+    for ts, mood in ((jan1, "Senang"), (jan1 + 1000, "Sedih"), (jan31, "Senang"), (feb1, "Cemas")):
+        client.post("/entries/", json={"content": "x", "mood": mood, "timestamp": ts})
+
+    resp = client.get(
+        "/stats/timeseries", params={"bucket": "month", "from": jan1, "to": feb1 + day - 1}
+    )
+    assert resp.status_code == 200
+    assert resp.json()["buckets"] == [
+        {"start": jan1, "end": feb1, "stats": {"Senang": 2, "Sedih": 1}},
+        {"start": feb1, "end": 1709251200000, "stats": {"Cemas": 1}},
+    ]
+
+    weekly = client.get(
+        "/stats/timeseries", params={"bucket": "week", "from": jan1, "to": jan1 + 7 * day}
+    ).json()["buckets"]
+    assert [b["start"] for b in weekly] == [jan1, jan1 + 7 * day]
+    assert weekly[0]["stats"] == {"Senang": 1, "Sedih": 1}
+    assert weekly[1]["stats"] == {}
+
+    # Bucket tertutup di-cache, tetapi entri yang tersinkron belakangan
+    # menginvalidasi bucket tersebut.
+    params = {"bucket": "day", "from": jan1, "to": jan1 + day - 1}
+    assert client.get("/stats/timeseries", params=params).json()["buckets"][0]["stats"] == {
+        "Senang": 1,
+        "Sedih": 1,
+    }
+    assert stats._get_cached((None, "day", jan1)) == {"Senang": 1, "Sedih": 1}
+    client.post("/entries/", json={"content": "late", "mood": "Marah", "timestamp": jan1 + 5})
+    daily = client.get("/stats/timeseries", params=params).json()["buckets"]
+    assert daily == [
+        {"start": jan1, "end": jan1 + day, "stats": {"Senang": 1, "Sedih": 1, "Marah": 1}}
+    ]
+
+
+def test_mood_timeseries_rejects_bad_range(client):
+    resp = client.get("/stats/timeseries", params={"bucket": "day", "from": 10, "to": 1})
+    assert resp.status_code == 400
+    resp = client.get(
+        "/stats/timeseries", params={"bucket": "day", "from": 0, "to": 86_400_000 * 5000}
+    )
+    assert resp.status_code == 400
+
+
+def test_rebuild_mood_stats():
+    from sqlalchemy import create_engine, select
+    from sqlalchemy.orm import sessionmaker
+    from app import crud
+
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    with sessionmaker(bind=engine)() as db:
+        db.add_all(
+            [
+                models.DiaryEntry(content="a", mood="Sedih", timestamp=1),
+                models.DiaryEntry(content="b", mood="Sedih", timestamp=86_400_000),
+                models.DiaryEntry(content="c", mood="Cemas", timestamp=2),
+            ]
+        )
+        db.commit()
+        assert crud.get_mood_stats(db) == {}
+
+        assert crud.rebuild_mood_stats(db) == 3
+        assert crud.get_mood_stats(db) == {"Sedih": 2, "Cemas": 1}
+        daily = db.execute(
+            select(models.MoodDailyCount.day, models.MoodDailyCount.mood, models.MoodDailyCount.count)
+            .order_by(models.MoodDailyCount.day, models.MoodDailyCount.mood)
+        ).all()
+        assert [tuple(r) for r in daily] == [(0, "Cemas", 1), (0, "Sedih", 1), (1, "Sedih", 1)]
+
+
+def test_entries_by_activity_and_activity_stats(client):
+    client.post(
+        "/entries/",
+        json={"content": "a", "mood": "Senang", "timestamp": 1, "activities": ["Lari", "Baca"]},
+    )
+    client.post(
+        "/entries/batch",
+        json={
+            "entries": [
+                {"content": "b", "mood": "Sedih", "timestamp": 2, "activities": ["Baca"]},
+                {"content": "c", "mood": "Senang", "timestamp": 3, "activities": ["Baca", "Baca"]},
+                {"content": "d", "mood": "Cemas", "timestamp": 4},
+            ]
+        },
+    )
+
+    entries = client.get("/entries/").json()
+    assert [e["activities"] for e in entries] == [[], ["Baca"], ["Baca"], ["Lari", "Baca"]]
+
+    first = client.get("/entries/", params={"activity": "Baca", "limit": 2})
+    assert [e["content"] for e in first.json()] == ["c", "b"]
+    second = client.get(
+        "/entries/",
+        params={"activity": "Baca", "limit": 2, "cursor": first.headers["X-Next-Cursor"]},
+    )
+    assert [e["content"] for e in second.json()] == ["a"]
+    assert client.get("/entries/", params={"activity": "Tidur"}).json() == []
+
+    assert client.get("/stats/activities").json() == [
+        {"activity": "Baca", "total": 3, "stats": {"Senang": 2, "Sedih": 1}},
+        {"activity": "Lari", "total": 1, "stats": {"Senang": 1}},
+    ]
+    assert client.get("/stats/activities", params={"activity": "Lari"}).json() == [
+        {"activity": "Lari", "total": 1, "stats": {"Senang": 1}}
+    ]
+
+
+def test_entry_reads_return_rows_without_orm_objects():
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from app import crud, schemas
+
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    with sessionmaker(bind=engine)() as db:
+        created = crud.create_diary_entry(
+            db,
+            schemas.DiaryEntryCreate(
+                content="hari ini ☀", mood="Senang", timestamp=5, activities=["Lari", "Baca"]
+            ),
+        )
+        db.expunge_all()
+
+        entries = crud.get_diary_entries(db)
+        assert entries == [
+            {
+                "id": created.id,
+                "content": "hari ini ☀",
+                "mood": "Senang",
+                "timestamp": 5,
+                "analysis": None,
+                "analysis_status": None,
+                "activities": ["Lari", "Baca"],
+            }
+        ]
+        assert crud.get_diary_entry(db, created.id) == entries[0]
+        assert len(db.identity_map) == 0
+
+
+@pytest.fixture
+def analysis_sessions(client, monkeypatch):
+    """Session factory shared by the API and the analysis worker in a test."""
+    from app import analysis
+
+    engine = create_async_engine(
+        "sqlite+aiosqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool
+    )
+    sessions = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+
+    async def override_get_async_db():
+        async with sessions() as db:
+            yield db
+
+    client.portal.call(_create_tables, engine)
+    app.dependency_overrides[get_async_db] = override_get_async_db
+    monkeypatch.setattr(analysis, "ANALYSIS_ON_CREATE", True)
+    monkeypatch.setattr(analysis, "ANALYSIS_RETRY_DELAY", 0)
+    yield sessions
+    client.portal.call(engine.dispose)
+
+
+def test_new_entries_are_analyzed_in_background(client, analysis_sessions, monkeypatch):
+    from app import analysis
+
+    sessions = analysis_sessions
+
+    calls = []
+
+    async def fake_analyze(text):
+        calls.append(text)
+        if len(calls) == 1:
+            raise RuntimeError("upstream 429")
+        return f"analisis: {text}"
+
+    monkeypatch.setattr(analysis.openrouter, "analyze_text", fake_analyze)
+
+    created = client.post("/entries/", json={"content": "lelah", "mood": "Sedih", "timestamp": 1})
+    assert created.json()["analysis_status"] == "pending"
+    batch = client.post(
+        "/entries/batch",
+        json={"entries": [{"content": "senang", "mood": "Senang", "timestamp": 2}]},
+    )
+    assert batch.json()[0]["analysis_status"] == "pending"
+
+    # Percobaan pertama gagal dan dijadwalkan ulang; berikutnya berhasil.
+    assert client.portal.call(analysis.process_batch, sessions) == 2
+    assert client.portal.call(analysis.process_batch, sessions) == 1
+    assert client.portal.call(analysis.process_batch, sessions) == 0
+    assert len(calls) == 3
+
+    entries = {e["content"]: e for e in client.get("/entries/").json()}
+    assert entries["lelah"]["analysis"] == "analisis: lelah"
+    assert entries["senang"]["analysis_status"] == "done"
+
+
+def test_analysis_gives_up_after_max_attempts(client, analysis_sessions, monkeypatch):
+    from app import analysis
+
+    sessions = analysis_sessions
+    monkeypatch.setattr(analysis, "ANALYSIS_MAX_ATTEMPTS", 2)
+
+    async def broken(text):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(analysis.openrouter, "analyze_text", broken)
+    entry_id = client.post(
+        "/entries/", json={"content": "x", "mood": "Cemas", "timestamp": 1}
+    ).json()["id"]
+
+    assert client.portal.call(analysis.process_batch, sessions) == 1
+    assert client.portal.call(analysis.process_batch, sessions) == 1
+    assert client.portal.call(analysis.process_batch, sessions) == 0
+    assert client.get(f"/entries/{entry_id}").json()["analysis_status"] == "failed"
+
+
+def test_migrate_legacy_activities():
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from app import crud
+
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    with sessionmaker(bind=engine)() as db:
+        db.add_all(
+            [
+                models.DiaryEntry(content="a", mood="Sedih", timestamp=1, legacy_activities="Lari|Baca"),
+                models.DiaryEntry(content="b", mood="Senang", timestamp=2, legacy_activities=""),
+            ]
+        )
+        db.commit()
+
+        assert crud.migrate_legacy_activities(db, batch_size=1) == 1
+        assert crud.migrate_legacy_activities(db) == 0
+        entries = crud.get_diary_entries(db)
+        assert [e["activities"] for e in entries] == [[], ["Lari", "Baca"]]
+        assert crud.get_activity_mood_stats(db) == {"Lari": {"Sedih": 1}, "Baca": {"Sedih": 1}}
+
+
+@pytest.mark.parametrize(
+    "old_schema",
+    [
+        # Skema awal: belum ada client_id, user_id maupun kolom analisis.
+        [],
+        # client_id sudah ada tetapi masih unik global.
+        [
+            "ALTER TABLE diary_entries ADD COLUMN client_id VARCHAR(64)",
+            "CREATE UNIQUE INDEX ix_diary_entries_client_id ON diary_entries (client_id)",
+        ],
+    ],
+)
+def test_migrations_upgrade_baseline_schema(old_schema):
+    from sqlalchemy import create_engine, text
+    from sqlalchemy.orm import sessionmaker
+    from app import crud, schemas
+
+    engine = create_engine("sqlite://")
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "CREATE TABLE diary_entries (id INTEGER PRIMARY KEY, content VARCHAR NOT NULL,"
+                " mood VARCHAR NOT NULL, activities VARCHAR NOT NULL, timestamp BIGINT NOT NULL)"
+            )
+        )
+        for statement in old_schema:
+            conn.execute(text(statement))
+        conn.execute(
+            text("INSERT INTO diary_entries (content, mood, activities, timestamp)"
+                 " VALUES ('lama', 'Sedih', 'Lari', 1)")
+        )
+    Base.metadata.create_all(bind=engine)
+    with sessionmaker(bind=engine)() as db:
+        crud.migrate_user_scope(db)
+        crud.migrate_entry_client_id(db)
+        crud.migrate_entry_analysis(db)
+        assert crud.migrate_legacy_activities(db) == 1
+
+        entry = schemas.DiaryEntryCreate(content="baru", mood="Senang", timestamp=2, client_id="k1")
+        first = crud.create_diary_entry(db, entry)
+        assert crud.create_diary_entry(db, entry).id == first.id
+        assert crud.create_diary_entry(db, entry, user_id=1).id != first.id
+        assert [e["content"] for e in crud.get_diary_entries(db)] == ["baru", "lama"]
+
+
 def test_analyze_entry(client, monkeypatch):
     class MockResp:
         def __init__(self, content="Positif"):
@@ -88,7 +793,7 @@ def test_analyze_entry(client, monkeypatch):
                 (),
                 {
                     "completions": type(
-                        "Comp", (), {"create": lambda self, **kwargs: resp}
+                        "Comp", (), {"create": _returning(resp)}
                     )()
                 },
             )()
@@ -127,7 +832,7 @@ def test_openrouter_articles(client, monkeypatch):
                 (),
                 {
                     "completions": type(
-                        "Comp", (), {"create": lambda self, **kwargs: resp}
+                        "Comp", (), {"create": _returning(resp)}
                     )()
                 },
             )()
@@ -145,6 +850,116 @@ def test_openrouter_articles(client, monkeypatch):
     assert resp.json() == [{"title": "A", "summary": "B"}]
 
 
+def test_openrouter_articles_cached(client, monkeypatch):
+    calls = []
+    mock = _scripted_client(['[{"title": "A", "summary": "B"}]'] * 2, calls)
+    monkeypatch.setenv("OPENROUTER_API_KEY", "dummy")
+    monkeypatch.setattr("app.ai_utils.get_openrouter_client", lambda: mock)
+
+    before = dict(cache.ai_cache.counters["articles"])
+    first = client.post("/articles/", json={"text": "Hari  ini sedih"})
+    second = client.post("/articles/", json={"text": "hari ini SEDIH "})
+    assert first.headers["X-Cache"] == "MISS"
+    assert second.headers["X-Cache"] == "HIT"
+    assert second.json() == first.json() == [{"title": "A", "summary": "B"}]
+    assert len(calls) == 1
+
+    bypass = client.post(
+        "/articles/", json={"text": "hari ini sedih"}, headers={"X-Cache-Bypass": "1"}
+    )
+    assert bypass.headers["X-Cache"] == "BYPASS"
+    assert len(calls) == 2
+    after = cache.ai_cache.counters["articles"]
+    assert {k: after[k] - before[k] for k in after} == {"HIT": 1, "MISS": 1, "BYPASS": 1}
+
+
+def test_memory_cache_evicts_by_size_and_ttl(monkeypatch):
+    store = cache.MemoryCache(max_entries=2, max_bytes=10)
+    store.set("a", "1234", ttl=60)
+    store.set("b", "1234", ttl=60)
+    store.get("a")
+    store.set("c", "1234", ttl=60)
+    assert store.get("b") is None
+    assert store.get("a") == "1234"
+
+    store.set("d", "123456789", ttl=60)
+    assert store.get("a") is None and store.get("c") is None
+
+    store.set("e", "x", ttl=-1)
+    assert store.get("e") is None
+
+
+def test_sqlite_cache_roundtrip(tmp_path):
+    store = cache.SQLiteCache(str(tmp_path / "cache.db"), max_entries=2)
+    store.set("a", "1", ttl=60)
+    store.set("b", "2", ttl=60)
+    store.set("c", "3", ttl=60)
+    assert store.get("a") is None
+    assert store.get("c") == "3"
+    other = cache.SQLiteCache(str(tmp_path / "cache.db"), max_entries=2)
+    assert other.get("b") == "2"
+    other.close()
+    store.close()
+
+
+def test_concurrent_identical_articles_share_one_upstream_call(monkeypatch):
+    from app import ai_utils
+    from app.singleflight import flights
+
+    calls = []
+
+    async def create(_self, **kw):
+        calls.append(kw)
+        await asyncio.sleep(0.05)
+        message = type("M", (), {"content": '[{"title": "A", "summary": "B"}]'})()
+        return type("R", (), {"choices": [type("C", (), {"message": message})()]})()
+
+    mock = type(
+        "Client",
+        (),
+        {"chat": type("Chat", (), {"completions": type("Comp", (), {"create": create})()})()},
+    )()
+    monkeypatch.setenv("OPENROUTER_API_KEY", "dummy")
+    monkeypatch.setattr("app.ai_utils.get_openrouter_client", lambda: mock)
+
+    async def scenario():
+        return await asyncio.gather(
+            *(ai_utils.generate_articles_with_openrouter("sama") for _ in range(5)),
+            ai_utils.generate_articles_with_openrouter("beda"),
+        )
+
+    started = metrics.singleflight_requests.value("started")
+    shared = metrics.singleflight_requests.value("shared")
+    results = asyncio.run(scenario())
+    assert len(calls) == 2
+    assert all(r[0].title == "A" for r in results)
+    assert flights.in_flight() == 0
+    assert metrics.singleflight_requests.value("started") - started == 2
+    assert metrics.singleflight_requests.value("shared") - shared == 4
+
+
+def test_singleflight_shares_errors():
+    from app.singleflight import SingleFlight
+
+    group = SingleFlight()
+    runs = []
+
+    async def boom():
+        runs.append(1)
+        await asyncio.sleep(0.01)
+        raise ValueError("bad")
+
+    async def scenario():
+        return await asyncio.gather(
+            group.do("k", boom), group.do("k", boom), return_exceptions=True
+        )
+
+    results = asyncio.run(scenario())
+    assert len(runs) == 1
+    assert all(isinstance(r, ValueError) for r in results)
+    assert group.shared == 1
+
+
 def test_openrouter_articles_error(client, monkeypatch):
     class MockClient:
         def __init__(self):
@@ -156,9 +971,7 @@ def test_openrouter_articles_error(client, monkeypatch):
                         "Comp",
                         (),
                         {
-                            "create": lambda self, **kwargs: (_ for _ in ()).throw(
-                                Exception("bad")
-                            )
+                            "create": _raising(Exception("bad"))
                         },
                     )()
                 },
@@ -194,7 +1007,7 @@ def test_openrouter_articles_bad_json(client, monkeypatch):
                 (),
                 {
                     "completions": type(
-                        "Comp", (), {"create": lambda self, **kwargs: BadResp()}
+                        "Comp", (), {"create": _returning(BadResp())}
                     )()
                 },
             )()
@@ -223,7 +1036,7 @@ def test_openrouter_caption(client, monkeypatch):
                 (),
                 {
                     "completions": type(
-                        "Comp", (), {"create": lambda self, **kw: MockResp()}
+                        "Comp", (), {"create": _returning(MockResp())}
                     )()
                 },
             )()
@@ -253,9 +1066,7 @@ def test_openrouter_caption_error(client, monkeypatch):
                         "Comp",
                         (),
                         {
-                            "create": lambda self, **kw: (_ for _ in ()).throw(
-                                Exception("bad")
-                            )
+                            "create": _raising(Exception("bad"))
                         },
                     )()
                 },
@@ -285,9 +1096,7 @@ def test_openrouter_caption_network_error(client, monkeypatch):
                         "Comp",
                         (),
                         {
-                            "create": lambda self, **kw: (_ for _ in ()).throw(
-                                httpx.HTTPError("boom")
-                            )
+                            "create": _raising(httpx.HTTPError("boom"))
                         },
                     )()
                 },
@@ -306,6 +1115,111 @@ def test_openrouter_caption_network_error(client, monkeypatch):
     assert resp.status_code == 502
 
 
+def test_analyze_answers_confident_texts_locally(client, monkeypatch):
+    def no_upstream():
+        raise AssertionError("OpenRouter tidak boleh dipanggil")
+
+    monkeypatch.setattr("app.openrouter.get_openrouter_client", no_upstream)
+    resp = client.post("/analyze/", json={"text": "Aku sangat bahagia dan bersyukur hari ini"})
+    assert resp.status_code == 200
+    body = resp.json()
+    assert body["source"] == "local"
+    assert body["mood"] == "Senang"
+    assert body["confidence"] >= 0.7
+    assert metrics.sentiment_predictions.value("local") == 1
+
+
+def test_local_sentiment_answers_are_never_rate_limited(client, monkeypatch):
+    from app import ratelimit
+
+    monkeypatch.setattr(
+        ratelimit,
+        "ai_limiter",
+        ratelimit.RateLimiter(
+            ratelimit.MemoryBuckets(100),
+            user=ratelimit.Limit(rate=1 / 60, burst=1),
+            ip=ratelimit.Limit(rate=1 / 60, burst=1),
+        ),
+    )
+    fake = _model_client(_returning(_reply("Netral")))
+    monkeypatch.setattr("app.openrouter.get_openrouter_client", lambda: fake)
+    monkeypatch.setenv("OPENROUTER_API_KEY", "dummy")
+
+    for _ in range(5):
+        resp = client.post("/analyze/", json={"text": "Aku sangat bahagia dan bersyukur hari ini"})
+        assert resp.status_code == 200
+        assert resp.json()["source"] == "local"
+    # Token bucket masih utuh untuk satu panggilan OpenRouter, lalu habis.
+    assert client.post("/analyze/", json={"text": "hari ini biasa saja"}).status_code == 200
+    assert client.post("/analyze/", json={"text": "besok juga biasa"}).status_code == 429
+    assert metrics.rate_limited.value("ip") == 1
+
+
+def test_cached_ai_answers_are_never_rate_limited(client, monkeypatch):
+    from app import ratelimit
+
+    monkeypatch.setattr(
+        ratelimit,
+        "ai_limiter",
+        ratelimit.RateLimiter(
+            ratelimit.MemoryBuckets(100),
+            user=ratelimit.Limit(rate=1 / 60, burst=2),
+            ip=ratelimit.Limit(rate=1 / 60, burst=2),
+        ),
+    )
+
+    async def create(_self, **kw):
+        content = kw["messages"][0]["content"]
+        if isinstance(content, list):
+            return _reply("Sebuah dermaga")
+        return _reply('[{"title": "A", "summary": "B"}]')
+
+    fake = _model_client(create)
+    monkeypatch.setenv("OPENROUTER_API_KEY", "dummy")
+    monkeypatch.setattr("app.ai_utils.get_openrouter_client", lambda: fake)
+
+    # Dua cache miss menghabiskan burst; permintaan berikutnya dilayani cache.
+    for _ in range(5):
+        resp = client.post("/articles/", json={"text": "lelah"})
+        assert resp.status_code == 200
+        caption = client.post("/openrouter_caption/", json={"image_url": "http://example.com/a.jpg"})
+        assert caption.status_code == 200
+        assert caption.json()["caption"] == "Sebuah dermaga"
+    assert resp.headers["X-Cache"] == caption.headers["X-Cache"] == "HIT"
+    # Yang benar-benar memanggil OpenRouter tetap dibatasi, dengan status 429.
+    limited = client.post("/articles/", json={"text": "lain"})
+    assert limited.status_code == 429
+    assert "Retry-After" in limited.headers
+
+
+@pytest.mark.parametrize(
+    "text, mood",
+    [
+        ("sedih banget, aku menangis semalaman", "Sedih"),
+        ("I am so anxious and worried about the exam", "Cemas"),
+        ("kesal dan benci sama sikapnya", "Marah"),
+        ("malu banget ketemu dia, salting", "Tersipu"),
+        ("happy and grateful today", "Senang"),
+    ],
+)
+def test_sentiment_classifier_moods(text, mood):
+    from app import sentiment
+
+    prediction = sentiment.classify(text)
+    assert prediction.mood == mood
+    assert prediction.is_confident()
+
+
+def test_sentiment_classifier_escalates_when_unsure():
+    from app import sentiment
+
+    assert sentiment.classify("hari ini biasa saja").mood is None
+    # Satu kata isyarat saja belum cukup yakin; negasi tidak dihitung sebagai marah.
+    assert not sentiment.classify("saya senang").is_confident()
+    assert sentiment.classify("aku tidak marah, cuma capek").mood == "Sedih"
+    assert sentiment.classify("tidak senang").mood == "Sedih"
+
+
 def test_openrouter_analyze(client, monkeypatch):
     class MockResp:
         def __init__(self, content="Positif"):
@@ -320,7 +1234,7 @@ def test_openrouter_analyze(client, monkeypatch):
                 (),
                 {
                     "completions": type(
-                        "Comp", (), {"create": lambda self, **kw: MockResp()}
+                        "Comp", (), {"create": _returning(MockResp())}
                     )()
                 },
             )()
@@ -333,7 +1247,7 @@ def test_openrouter_analyze(client, monkeypatch):
     monkeypatch.setattr("app.openrouter.get_openrouter_client", lambda: MockClient())
     resp = client.post("/analyze/", json={"text": "hello"})
     assert resp.status_code == 200
-    assert resp.json() == {"analysis": "Positif"}
+    assert resp.json() == {"analysis": "Positif", "mood": None, "confidence": 0.0, "source": "llm"}
 
 
 def test_openrouter_analyze_error(client, monkeypatch):
@@ -347,9 +1261,7 @@ def test_openrouter_analyze_error(client, monkeypatch):
                         "Comp",
                         (),
                         {
-                            "create": lambda self, **kw: (_ for _ in ()).throw(
-                                Exception("bad")
-                            )
+                            "create": _raising(Exception("bad"))
                         },
                     )()
                 },
@@ -377,7 +1289,7 @@ def test_chat_success(client, monkeypatch):
             ]
             self._iter = iter(responses)
 
-            def create(_self, **kw):
+            async def create(_self, **kw):
                 return next(self._iter)
 
             self.chat = type("Chat", (), {"completions": type("Comp", (), {"create": create})()})()
@@ -390,6 +1302,122 @@ def test_chat_success(client, monkeypatch):
     resp = client.post("/chat/", json={"text": "hi", "history": "prev"})
     assert resp.status_code == 200
     assert resp.text == "Take a breath"
+    assert resp.headers["X-Chat-Pipeline"] == "two_step"
+
+
+def _delta_chunk(content):
+    delta = type("D", (), {"content": content})()
+    return type("Chunk", (), {"choices": [type("C", (), {"delta": delta})()]})()
+
+
+def test_chat_stream_sse(client, monkeypatch):
+    analysis = type(
+        "R",
+        (),
+        {
+            "choices": [
+                type(
+                    "C",
+                    (),
+                    {
+                        "message": type(
+                            "M",
+                            (),
+                            {"content": '{"issue": "stress", "technique": "breathing", "tone": "calm"}'},
+                        )()
+                    },
+                )()
+            ]
+        },
+    )()
+
+    async def tokens():
+        for piece in ("Take", " a\nbreath"):
+            yield _delta_chunk(piece)
+
+    async def create(_self, stream=False, **kw):
+        return tokens() if stream else analysis
+
+    mock = type(
+        "Client",
+        (),
+        {"chat": type("Chat", (), {"completions": type("Comp", (), {"create": create})()})()},
+    )()
+    monkeypatch.setenv("OPENROUTER_API_KEY", "dummy")
+    monkeypatch.setattr("app.ai_utils.get_openrouter_client", lambda: mock)
+
+    resp = client.post("/chat/", json={"text": "hi", "stream": True})
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/event-stream")
+    assert resp.text == (
+        "data: Take\n\n"
+        "data:  a\ndata: breath\n\n"
+        "event: done\ndata: \n\n"
+    )
+
+
+def test_chat_stream_network_error_before_first_token(client, monkeypatch):
+    class MockClient:
+        def __init__(self):
+            self.chat = type(
+                "Chat",
+                (),
+                {
+                    "completions": type(
+                        "Comp",
+                        (),
+                        {
+                            "create": _raising(httpx.HTTPError("boom"))
+                        },
+                    )()
+                },
+            )()
+
+    monkeypatch.setenv("OPENROUTER_API_KEY", "dummy")
+    mock = MockClient()
+    monkeypatch.setattr("app.ai_utils.get_openrouter_client", lambda: mock)
+
+    resp = client.post("/chat/", json={"text": "hi", "stream": True})
+    assert resp.status_code == 502
+
+
+def test_chat_single_call_pipeline(client, monkeypatch):
+    calls = []
+    mock = _scripted_client(
+        ['{"issue": "stress", "technique": "breathing", "tone": "calm", "reply": "Tarik napas?"}'],
+        calls,
+    )
+    monkeypatch.setenv("OPENROUTER_API_KEY", "dummy")
+    monkeypatch.setattr("app.ai_utils.CHAT_PIPELINE", "single")
+    monkeypatch.setattr("app.ai_utils.get_openrouter_client", lambda: mock)
+
+    resp = client.post("/chat/", json={"text": "hi"})
+    assert resp.status_code == 200
+    assert resp.text == "Tarik napas?"
+    assert resp.headers["X-Chat-Pipeline"] == "single"
+    assert len(calls) == 1
+    assert calls[0]["response_format"]["type"] == "json_schema"
+
+
+def test_chat_single_call_falls_back_on_invalid_output(client, monkeypatch):
+    calls = []
+    mock = _scripted_client(
+        [
+            '{"issue": "stress"}',
+            '{"issue": "stress", "technique": "breathing", "tone": "calm"}',
+            "Take a breath",
+        ],
+        calls,
+    )
+    monkeypatch.setenv("OPENROUTER_API_KEY", "dummy")
+    monkeypatch.setattr("app.ai_utils.CHAT_PIPELINE", "single")
+    monkeypatch.setattr("app.ai_utils.get_openrouter_client", lambda: mock)
+
+    resp = client.post("/chat/", json={"text": "hi"})
+    assert resp.status_code == 200
+    assert resp.text == "Take a breath"
+    assert resp.headers["X-Chat-Pipeline"] == "fallback"
+    assert len(calls) == 3
 
 
 def test_chat_bad_json(client, monkeypatch):
@@ -402,7 +1430,7 @@ def test_chat_bad_json(client, monkeypatch):
             self.chat = type(
                 "Chat",
                 (),
-                {"completions": type("Comp", (), {"create": lambda _s, **kw: MockResp("not-json")})()},
+                {"completions": type("Comp", (), {"create": _returning(MockResp("not-json"))})()},
             )()
 
     monkeypatch.setenv("OPENROUTER_API_KEY", "dummy")
@@ -425,9 +1453,7 @@ def test_chat_network_error(client, monkeypatch):
                         "Comp",
                         (),
                         {
-                            "create": lambda _s, **kw: (_ for _ in ()).throw(
-                                httpx.HTTPError("boom")
-                            )
+                            "create": _raising(httpx.HTTPError("boom"))
                         },
                     )()
                 },
@@ -442,6 +1468,446 @@ def test_chat_network_error(client, monkeypatch):
     assert resp.status_code == 502
 
 
+def _conversation_client(prompts):
+    """Fake OpenRouter answering the two-step chat flow and summary requests."""
+
+    async def create(_self, **kw):
+        prompt = kw["messages"][0]["content"]
+        prompts.append(prompt)
+        if prompt.startswith("Ringkas percakapan"):
+            return _reply(f"ringkasan {len(prompts)}")
+        if prompt.startswith("Identifikasi"):
+            return _reply('{"issue": "stres", "technique": "napas", "tone": "lembut"}')
+        return _reply(f"balasan {len(prompts)}")
+
+    return _model_client(create)
+
+
+def test_chat_conversation_keeps_history_on_server(client, monkeypatch):
+    prompts = []
+    fake = _conversation_client(prompts)
+    monkeypatch.setenv("OPENROUTER_API_KEY", "dummy")
+    monkeypatch.setattr("app.ai_utils.get_openrouter_client", lambda: fake)
+
+    created = client.post("/conversations/")
+    assert created.status_code == 201
+    conversation_id = created.json()["id"]
+
+    first = client.post("/chat/", json={"text": "aku capek", "conversation_id": conversation_id})
+    assert first.text == "balasan 2"
+    client.post(
+        "/chat/",
+        json={"text": "masih capek", "history": "diabaikan", "conversation_id": conversation_id},
+    )
+    # Giliran kedua membawa riwayat dari server, bukan dari klien.
+    assert "Pengguna: aku capek\nAsisten: balasan 2" in prompts[2]
+    assert "diabaikan" not in prompts[2]
+
+    stored = client.get(f"/conversations/{conversation_id}").json()
+    assert stored["summary"] is None
+    assert [(m["role"], m["content"]) for m in stored["messages"]] == [
+        ("user", "aku capek"),
+        ("assistant", "balasan 2"),
+        ("user", "masih capek"),
+        ("assistant", "balasan 4"),
+    ]
+
+    unknown = client.post("/chat/", json={"text": "hi", "conversation_id": "tidak-ada"})
+    assert unknown.status_code == 404
+
+
+def test_chat_conversation_compacts_old_turns_into_summary(client, monkeypatch):
+    from app import conversations
+
+    prompts = []
+    fake = _conversation_client(prompts)
+    monkeypatch.setenv("OPENROUTER_API_KEY", "dummy")
+    monkeypatch.setattr("app.ai_utils.get_openrouter_client", lambda: fake)
+    monkeypatch.setattr(conversations, "CHAT_HISTORY_TOKEN_BUDGET", 40)
+    monkeypatch.setattr(conversations, "CHAT_HISTORY_RECENT_TOKENS", 15)
+    conversation_id = client.post("/conversations/").json()["id"]
+
+    for turn in range(4):
+        text = f"cerita ke {turn} tentang pekerjaan yang membuat kepala pusing"
+        client.post("/chat/", json={"text": text, "conversation_id": conversation_id})
+
+    summaries = [p for p in prompts if p.startswith("Ringkas percakapan")]
+    # Ringkasan hanya dibuat ulang saat jendela riwayat meluap, tidak setiap giliran.
+    assert 1 <= len(summaries) < 3
+    assert metrics.chat_history_compactions.value("ok") == len(summaries)
+
+    stored = client.get(f"/conversations/{conversation_id}").json()
+    assert stored["summary"].startswith("ringkasan")
+    assert len(stored["messages"]) == 8
+    last_history = prompts[-2]
+    assert f"Ringkasan percakapan sebelumnya: {stored['summary']}" in last_history
+    assert "cerita ke 0" not in last_history
+
+
+def test_chat_conversation_stream_saves_reply(client, monkeypatch):
+    async def chunks():
+        for piece in ("Tarik ", "napas"):
+            yield _delta_chunk(piece)
+
+    async def create(_self, stream=False, **kw):
+        if stream:
+            return chunks()
+        return _reply('{"issue": "stres", "technique": "napas", "tone": "lembut"}')
+
+    fake = _model_client(create)
+    monkeypatch.setenv("OPENROUTER_API_KEY", "dummy")
+    monkeypatch.setattr("app.ai_utils.get_openrouter_client", lambda: fake)
+    conversation_id = client.post("/conversations/").json()["id"]
+
+    resp = client.post(
+        "/chat/", json={"text": "hi", "stream": True, "conversation_id": conversation_id}
+    )
+    assert "event: done" in resp.text
+    messages = client.get(f"/conversations/{conversation_id}").json()["messages"]
+    assert [m["content"] for m in messages] == ["hi", "Tarik napas"]
+
+
+def test_chat_conversation_stream_reports_failed_save(client, monkeypatch):
+    async def chunks():
+        yield _delta_chunk("Tarik napas")
+
+    async def create(_self, stream=False, **kw):
+        if stream:
+            return chunks()
+        return _reply('{"issue": "stres", "technique": "napas", "tone": "lembut"}')
+
+    async def broken_record_turn(*args, **kwargs):
+        raise RuntimeError("database is locked")
+
+    fake = _model_client(create)
+    monkeypatch.setenv("OPENROUTER_API_KEY", "dummy")
+    monkeypatch.setattr("app.ai_utils.get_openrouter_client", lambda: fake)
+    monkeypatch.setattr("app.conversations.record_turn", broken_record_turn)
+    conversation_id = client.post("/conversations/").json()["id"]
+
+    resp = client.post(
+        "/chat/", json={"text": "hi", "stream": True, "conversation_id": conversation_id}
+    )
+    assert resp.status_code == 200
+    assert "data: Tarik napas" in resp.text
+    assert resp.text.endswith("event: error\ndata: Gagal menyimpan percakapan\n\n")
+    assert "event: done" not in resp.text
+
+
+def test_conversations_are_scoped_to_their_owner(client):
+    from app import auth
+
+    token, _ = auth.create_access_token(7)
+    headers = {"Authorization": f"Bearer {token}"}
+    conversation_id = client.post("/conversations/", headers=headers).json()["id"]
+
+    assert client.get(f"/conversations/{conversation_id}").status_code == 404
+    assert client.post(
+        "/chat/", json={"text": "hi", "conversation_id": conversation_id}
+    ).status_code == 404
+    assert client.delete(f"/conversations/{conversation_id}").status_code == 404
+    assert client.delete(f"/conversations/{conversation_id}", headers=headers).status_code == 204
+    assert client.get(f"/conversations/{conversation_id}", headers=headers).status_code == 404
+
+
+def test_chat_history_token_budget():
+    from app import conversations
+
+    assert conversations.estimate_tokens("") == 0
+    assert conversations.estimate_tokens("aku senang sekali!") == 6
+    history = " ".join(f"kata{i}" for i in range(100))
+    trimmed = conversations.trim_to_budget(history, 20)
+    assert history.endswith(trimmed) and trimmed.startswith("kata90")
+    assert conversations.estimate_tokens(trimmed) <= 20
+    assert conversations.trim_to_budget("pendek", 20) == "pendek"
+
+
+def test_openrouter_client_is_reused(monkeypatch):
+    from app import openrouter_client
+
+    monkeypatch.setenv("OPENROUTER_API_KEY", "dummy")
+    asyncio.run(openrouter_client.close_openrouter_client())
+    try:
+        first = openrouter_client.get_openrouter_client()
+        assert openrouter_client.get_openrouter_client() is first
+
+        monkeypatch.setenv("OPENROUTER_API_KEY", "rotated")
+        assert openrouter_client.get_openrouter_client() is not first
+
+        fake = object()
+        openrouter_client.set_openrouter_client(fake)
+        assert openrouter_client.get_openrouter_client() is fake
+    finally:
+        openrouter_client.set_openrouter_client(None)
+        asyncio.run(openrouter_client.close_openrouter_client())
+
+
+def test_upstream_slots_reject_after_queue_timeout(monkeypatch):
+    from app import openrouter_client
+    from app.ai_utils import UpstreamBusyError
+
+    monkeypatch.setattr(openrouter_client, "OPENROUTER_MAX_CONCURRENCY_PER_MODEL", 1)
+    monkeypatch.setattr(openrouter_client, "OPENROUTER_QUEUE_TIMEOUT", 0.01)
+
+    async def scenario():
+        openrouter_client.reset_concurrency_limits()
+        async with openrouter_client.upstream_slot("m"):
+            with pytest.raises(UpstreamBusyError):
+                async with openrouter_client.upstream_slot("m"):
+                    pass
+            # Model lain tidak ikut tertahan oleh model yang penuh.
+            async with openrouter_client.upstream_slot("other"):
+                pass
+        async with openrouter_client.upstream_slot("m"):
+            pass
+
+    asyncio.run(scenario())
+    openrouter_client.reset_concurrency_limits()
+
+
+def _status_error(cls, status, headers=None):
+    response = httpx.Response(
+        status, headers=headers, request=httpx.Request("POST", "https://openrouter.test")
+    )
+    return cls("gagal", response=response, body=None)
+
+
+def _reply(content):
+    message = type("M", (), {"content": content})()
+    return type("R", (), {"choices": [type("C", (), {"message": message})()]})()
+
+
+def test_upstream_retries_transient_errors_then_succeeds(monkeypatch):
+    import openai
+    from app import openrouter_client
+
+    monkeypatch.setattr(openrouter_client, "OPENROUTER_RETRY_BASE_DELAY", 0)
+    calls = []
+
+    async def create(_self, **kw):
+        calls.append(kw["model"])
+        if len(calls) < 3:
+            raise _status_error(openai.InternalServerError, 502)
+        return _reply("ok")
+
+    async def scenario():
+        openrouter_client.reset_concurrency_limits()
+        return await openrouter_client.create_chat_completion(
+            _model_client(create), messages=[]
+        )
+
+    assert asyncio.run(scenario()).choices[0].message.content == "ok"
+    assert calls == [openrouter_client.OPENROUTER_MODEL] * 3
+
+    async def bad_request(_self, **kw):
+        calls.append(kw["model"])
+        raise _status_error(openai.BadRequestError, 400)
+
+    calls.clear()
+    with pytest.raises(openai.BadRequestError):
+        asyncio.run(openrouter_client.create_chat_completion(_model_client(bad_request), messages=[]))
+    assert len(calls) == 1
+
+
+def test_upstream_retry_delay_honours_retry_after(monkeypatch):
+    import time
+    import openai
+    from app import openrouter_client
+
+    monkeypatch.setattr(openrouter_client, "OPENROUTER_RETRY_BASE_DELAY", 0)
+    limited = _status_error(openai.RateLimitError, 429, {"Retry-After": "3"})
+    far, near = time.monotonic() + 60, time.monotonic() + 1
+
+    assert openrouter_client._retry_delay(limited, 0, far) == 3
+    # Menunggu Retry-After akan melewati deadline: pindah ke model berikutnya.
+    assert openrouter_client._retry_delay(limited, 0, near) is None
+    assert openrouter_client._retry_delay(limited, openrouter_client.OPENROUTER_MAX_RETRIES, far) is None
+
+
+def test_upstream_circuit_opens_and_falls_back(monkeypatch):
+    from app import openrouter_client
+
+    monkeypatch.setattr(openrouter_client, "OPENROUTER_MODEL", "primary")
+    monkeypatch.setattr(openrouter_client, "OPENROUTER_FALLBACK_MODELS", ["backup"])
+    monkeypatch.setattr(openrouter_client, "OPENROUTER_MAX_RETRIES", 1)
+    monkeypatch.setattr(openrouter_client, "OPENROUTER_RETRY_BASE_DELAY", 0)
+    monkeypatch.setattr(openrouter_client, "OPENROUTER_BREAKER_FAILURES", 2)
+    metrics.clear()
+    calls = []
+
+    async def create(_self, **kw):
+        calls.append(kw["model"])
+        if kw["model"] == "primary":
+            raise httpx.ConnectError("down")
+        return _reply(kw["model"])
+
+    async def scenario():
+        openrouter_client.reset_concurrency_limits()
+        client = _model_client(create)
+        first = await openrouter_client.create_chat_completion(client, messages=[])
+        second = await openrouter_client.create_chat_completion(client, messages=[])
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert first.choices[0].message.content == second.choices[0].message.content == "backup"
+    # Circuit "primary" terbuka setelah dua kegagalan, panggilan kedua langsung ke cadangan.
+    assert calls == ["primary", "primary", "backup", "backup"]
+    assert openrouter_client.circuit_states() == {"primary": "open", "backup": "closed"}
+    assert metrics.upstream_circuit_opened.value("primary") == 1
+    assert metrics.upstream_fallbacks.value("backup", "completion") == 2
+
+    monkeypatch.setattr(openrouter_client, "OPENROUTER_FALLBACK_MODELS", [])
+    with pytest.raises(openrouter_client.CircuitOpenError):
+        asyncio.run(openrouter_client.create_chat_completion(_model_client(create), messages=[]))
+    openrouter_client.reset_concurrency_limits()
+
+
+def test_saturated_model_falls_back(monkeypatch):
+    from app import openrouter_client
+
+    monkeypatch.setattr(openrouter_client, "OPENROUTER_MODEL", "primary")
+    monkeypatch.setattr(openrouter_client, "OPENROUTER_FALLBACK_MODELS", ["backup"])
+    monkeypatch.setattr(openrouter_client, "OPENROUTER_QUEUE_TIMEOUT", 0.01)
+    calls = []
+
+    async def chunks(model):
+        yield _delta_chunk(model)
+
+    async def create(_self, stream=False, **kw):
+        calls.append(kw["model"])
+        return chunks(kw["model"]) if stream else _reply(kw["model"])
+
+    async def scenario():
+        openrouter_client.reset_concurrency_limits()
+        # Semua slot model utama terpakai.
+        openrouter_client._model_slots["primary"] = asyncio.Semaphore(0)
+        client = _model_client(create)
+        answered = openrouter_client.track_answering_models()
+        reply = await openrouter_client.create_chat_completion(client, messages=[])
+        deltas = [d async for d in openrouter_client.stream_chat_completion(client, messages=[])]
+        return reply, deltas, answered
+
+    reply, deltas, answered = asyncio.run(scenario())
+    assert reply.choices[0].message.content == "backup"
+    assert deltas == ["backup"]
+    assert calls == answered == ["backup", "backup"]
+    # Slot yang penuh bukan tanda model utama bermasalah.
+    assert openrouter_client.circuit_states()["primary"] == "closed"
+
+    monkeypatch.setattr(openrouter_client, "OPENROUTER_FALLBACK_MODELS", [])
+
+    async def saturated():
+        openrouter_client.reset_concurrency_limits()
+        openrouter_client._model_slots["primary"] = asyncio.Semaphore(0)
+        await openrouter_client.create_chat_completion(_model_client(create), messages=[])
+
+    with pytest.raises(openrouter_client.UpstreamBusyError):
+        asyncio.run(saturated())
+    openrouter_client.reset_concurrency_limits()
+
+
+def test_fallback_answers_are_cached_under_the_fallback_model(client, monkeypatch):
+    from app import cache, openrouter, openrouter_client
+
+    monkeypatch.setattr(openrouter_client, "OPENROUTER_MODEL", "primary")
+    monkeypatch.setattr(openrouter_client, "OPENROUTER_FALLBACK_MODELS", ["backup"])
+    monkeypatch.setattr(openrouter_client, "OPENROUTER_MAX_RETRIES", 0)
+    primary_down = True
+
+    async def create(_self, **kw):
+        if kw["model"] == "primary" and primary_down:
+            raise httpx.ConnectError("down")
+        return _reply(f"jawaban {kw['model']}")
+
+    fake = _model_client(create)
+    monkeypatch.setenv("OPENROUTER_API_KEY", "dummy")
+    monkeypatch.setattr("app.openrouter.get_openrouter_client", lambda: fake)
+
+    def cached(model):
+        key = cache.make_cache_key(
+            "analyze", model, openrouter.ANALYZE_PROMPT_VERSION, cache.normalize_text("biasa saja")
+        )
+        return cache.ai_cache.backend.get(key)
+
+    resp = client.post("/analyze/", json={"text": "biasa saja"})
+    assert resp.json()["analysis"] == "jawaban backup"
+    assert cached("backup") is not None
+    assert cached("primary") is None
+
+    primary_down = False
+    resp = client.post("/analyze/", json={"text": "biasa saja"})
+    # Jawaban model cadangan tidak dipakai sebagai jawaban model utama.
+    assert resp.headers["X-Cache"] == "MISS"
+    assert resp.json()["analysis"] == "jawaban primary"
+    resp = client.post("/analyze/", json={"text": "biasa saja"})
+    assert resp.headers["X-Cache"] == "HIT"
+    assert resp.json()["analysis"] == "jawaban primary"
+
+
+def test_upstream_attempt_timeout(monkeypatch):
+    from app import openrouter_client
+    from app.ai_utils import UPSTREAM_ERRORS
+
+    monkeypatch.setattr(openrouter_client, "OPENROUTER_ATTEMPT_TIMEOUT", 0.05)
+    monkeypatch.setattr(openrouter_client, "OPENROUTER_MAX_RETRIES", 0)
+
+    async def slow(_self, **kw):
+        await asyncio.sleep(5)
+
+    async def scenario():
+        openrouter_client.reset_concurrency_limits()
+        await openrouter_client.create_chat_completion(_model_client(slow), messages=[])
+
+    with pytest.raises(openrouter_client.UpstreamTimeoutError) as excinfo:
+        asyncio.run(scenario())
+    assert isinstance(excinfo.value, UPSTREAM_ERRORS)
+    openrouter_client.reset_concurrency_limits()
+
+
+def test_upstream_hedges_slow_attempts(monkeypatch):
+    from app import openrouter_client
+
+    monkeypatch.setattr(openrouter_client, "OPENROUTER_HEDGE", True)
+    monkeypatch.setattr(openrouter_client, "OPENROUTER_HEDGE_MIN_SAMPLES", 1)
+    metrics.clear()
+    model = openrouter_client.OPENROUTER_MODEL
+    calls = []
+
+    async def create(_self, **kw):
+        calls.append(kw["model"])
+        if len(calls) == 1:
+            await asyncio.sleep(5)
+        return _reply(f"attempt {len(calls)}")
+
+    async def scenario():
+        openrouter_client.reset_concurrency_limits()
+        openrouter_client._latencies[model] = openrouter_client.resilience.LatencyTracker()
+        openrouter_client._latencies[model].add(0.01)
+        return await openrouter_client.create_chat_completion(_model_client(create), messages=[])
+
+    assert asyncio.run(scenario()).choices[0].message.content == "attempt 2"
+    assert metrics.upstream_hedged.value(model, "completion") == 1
+    openrouter_client.reset_concurrency_limits()
+
+
+def test_upstream_health_reports_circuits(client):
+    resp = client.get("/health/upstream")
+    assert resp.status_code == 200
+    assert resp.json()["circuits"] == {}
+
+
+def test_analyze_busy_returns_503(client, monkeypatch):
+    from app.ai_utils import UpstreamBusyError
+
+    async def busy(text):
+        raise UpstreamBusyError("penuh")
+
+    monkeypatch.setattr("app.openrouter.analyze_text", busy)
+    resp = client.post("/analyze/", json={"text": "hello"})
+    assert resp.status_code == 503
+    assert resp.headers["Retry-After"] == "1"
+
+
 def test_chat_missing_key(client, monkeypatch):
     monkeypatch.delenv("OPENROUTER_API_KEY", raising=False)
     resp = client.post("/chat/", json={"text": "hi"})
@@ -2,40 +2,44 @@ import sys
 import os
 import pytest
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.pool import StaticPool
 
 os.environ["SQLALCHEMY_DATABASE_URL"] = "sqlite:///:memory:"
 sys.path.append("app/backend_api")
 
 from app.main import app
-from app import models
-from app.database import Base, get_db
+from app import auth, models
+from app.database import Base, get_async_db
+
+
+async def _create_tables(engine):
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
 
 
 @pytest.fixture
 def client():
-    engine = create_engine(
-        "sqlite://",
+    engine = create_async_engine(
+        "sqlite+aiosqlite://",
         connect_args={"check_same_thread": False},
         poolclass=StaticPool,
     )
-    TestingSessionLocal = sessionmaker(
-        autocommit=False, autoflush=False, bind=engine, future=True
+    TestingSessionLocal = async_sessionmaker(
+        bind=engine, autoflush=False, expire_on_commit=False
     )
-    Base.metadata.create_all(bind=engine)
 
-    def override_get_db():
-        db = TestingSessionLocal()
-        try:
+    async def override_get_async_db():
+        async with TestingSessionLocal() as db:
             yield db
-        finally:
-            db.close()
 
-    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_async_db] = override_get_async_db
+    auth.token_cache.clear()
+    auth.revocations.clear()
     with TestClient(app) as c:
+        c.portal.call(_create_tables, engine)
         yield c
+        c.portal.call(engine.dispose)
 
 
 def test_register_and_login(client):
@@ -53,3 +57,176 @@ def test_login_fail(client):
     client.post("/register/", json={"email": "b@a.com", "password": "x", "name": "Bob"})
     resp = client.post("/login/", json={"email": "b@a.com", "password": "bad"})
     assert resp.status_code == 400
+
+
+def test_login_rehashes_when_cost_changes(client, monkeypatch):
+    from passlib.context import CryptContext
+    from app import crud, passwords
+
+    monkeypatch.setattr(
+        passwords, "pwd_context", CryptContext(schemes=["bcrypt"], bcrypt__rounds=4)
+    )
+    client.post("/register/", json={"email": "c@a.com", "password": "x", "name": "Cy"})
+
+    monkeypatch.setattr(
+        passwords, "pwd_context", CryptContext(schemes=["bcrypt"], bcrypt__rounds=5)
+    )
+    updates = []
+    update = crud.update_password_hash
+    monkeypatch.setattr(
+        crud, "update_password_hash", lambda db, user, h: updates.append(h) or update(db, user, h)
+    )
+    for _ in range(2):
+        resp = client.post("/login/", json={"email": "c@a.com", "password": "x"})
+        assert resp.status_code == 200
+    assert len(updates) == 1 and updates[0].startswith("$2b$05$")
+
+
+def test_login_unknown_email_still_verifies(client, monkeypatch):
+    from app import passwords
+
+    calls = []
+    verify = passwords._verify
+    monkeypatch.setattr(
+        passwords, "_verify", lambda password, hashed: calls.append(hashed) or verify(password, hashed)
+    )
+    resp = client.post("/login/", json={"email": "nobody@a.com", "password": "x"})
+    assert resp.status_code == 400
+    assert calls == [None]
+
+
+def test_login_unknown_email_hashes_nothing(client, monkeypatch):
+    from app import passwords
+
+    hashes = []
+    hash_ = passwords.pwd_context.hash
+    monkeypatch.setattr(
+        passwords.pwd_context, "hash", lambda secret, **kw: hashes.append(secret) or hash_(secret, **kw)
+    )
+    # Hash dummy sudah dibuat saat startup: login pertama dengan email tak
+    # dikenal hanya menjalankan satu verifikasi bcrypt, seperti login biasa.
+    resp = client.post("/login/", json={"email": "nobody@a.com", "password": "x"})
+    assert resp.status_code == 400
+    assert hashes == []
+
+
+def test_password_pool_busy(client, monkeypatch):
+    import asyncio
+    from app import passwords
+
+    monkeypatch.setattr(passwords, "PASSWORD_HASH_QUEUE_TIMEOUT", 0.01)
+    monkeypatch.setattr(passwords, "_slots", asyncio.Semaphore(0))
+    resp = client.post("/register/", json={"email": "d@a.com", "password": "x", "name": "Di"})
+    assert resp.status_code == 503
+    assert resp.headers["Retry-After"] == "1"
+
+
+@pytest.fixture
+def fast_hash(monkeypatch):
+    from passlib.context import CryptContext
+    from app import passwords
+
+    monkeypatch.setattr(
+        passwords, "pwd_context", CryptContext(schemes=["bcrypt"], bcrypt__rounds=4)
+    )
+
+
+def _login(client, email):
+    client.post("/register/", json={"email": email, "password": "x", "name": email})
+    resp = client.post("/login/", json={"email": email, "password": "x"})
+    assert resp.json()["token_type"] == "bearer"
+    return {"Authorization": f"Bearer {resp.json()['token']}"}
+
+
+def test_entries_are_scoped_per_user(client, fast_hash):
+    alice = _login(client, "alice@a.com")
+    bob = _login(client, "bob@a.com")
+    entry = {"content": "rahasia", "mood": "Sedih", "timestamp": 1, "activities": ["Tidur"]}
+    own = client.post("/entries/", json=entry, headers=alice).json()
+    client.post("/entries/", json={**entry, "mood": "Senang"}, headers=bob)
+    client.post("/entries/", json={**entry, "mood": "Cemas"})
+
+    assert [e["mood"] for e in client.get("/entries/", headers=alice).json()] == ["Sedih"]
+    assert [e["mood"] for e in client.get("/entries/").json()] == ["Cemas"]
+    assert client.get(f"/entries/{own['id']}", headers=alice).status_code == 200
+    assert client.get(f"/entries/{own['id']}", headers=bob).status_code == 404
+    assert client.get("/stats/", headers=bob).json() == {"stats": {"Senang": 1}}
+    hits = client.get("/entries/search", params={"q": "rahasia"}, headers=alice).json()
+    assert [h["id"] for h in hits] == [own["id"]]
+    assert client.get("/stats/activities", headers=alice).json() == [
+        {"activity": "Tidur", "total": 1, "stats": {"Sedih": 1}}
+    ]
+    export = client.get("/entries/export", headers=bob).text.splitlines()
+    assert len(export) == 1 and '"Senang"' in export[0]
+
+
+def test_client_ids_are_unique_per_user(client, fast_hash):
+    alice = _login(client, "alice@a.com")
+    bob = _login(client, "bob@a.com")
+    entry = {"content": "a", "mood": "Sedih", "timestamp": 1, "client_id": "k1"}
+
+    ids = {
+        client.post("/entries/", json=entry, headers=alice).json()["id"],
+        client.post("/entries/", json=entry, headers=bob).json()["id"],
+        client.post("/entries/", json=entry).json()["id"],
+    }
+    assert len(ids) == 3
+    batch = client.post(
+        "/entries/batch", json={"entries": [{**entry, "client_id": "k2"}]}, headers=alice
+    )
+    again = client.post(
+        "/entries/batch", json={"entries": [entry, {**entry, "client_id": "k2"}]}, headers=bob
+    )
+    assert batch.status_code == again.status_code == 201
+    assert again.json()[1]["id"] != batch.json()[0]["id"]
+    # Ulangan oleh pemilik yang sama tetap memakai entri yang ada.
+    assert client.post("/entries/", json=entry, headers=alice).json()["id"] in ids
+
+
+def test_client_id_unique_for_anonymous_entries():
+    from sqlalchemy import create_engine
+    from sqlalchemy.exc import IntegrityError
+    from sqlalchemy.orm import sessionmaker
+
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    with sessionmaker(bind=engine)() as db:
+        db.add(models.DiaryEntry(content="a", mood="Sedih", timestamp=1, client_id="k"))
+        db.commit()
+        db.add(models.DiaryEntry(content="b", mood="Sedih", timestamp=2, client_id="k"))
+        with pytest.raises(IntegrityError):
+            db.commit()
+
+
+def test_logout_revokes_token(client, fast_hash):
+    headers = _login(client, "c@a.com")
+    assert client.get("/entries/", headers=headers).status_code == 200
+    assert client.post("/logout/", headers=headers).status_code == 204
+    assert client.get("/entries/", headers=headers).status_code == 401
+
+    auth.revocations.clear()  # worker lain memuat daftar dari database
+    assert client.get("/entries/", headers=headers).status_code == 401
+
+
+def test_invalid_and_expired_tokens(client, fast_hash, monkeypatch):
+    bad = {"Authorization": "Bearer not-a-token"}
+    assert client.get("/entries/", headers=bad).status_code == 401
+    assert client.post("/logout/").status_code == 401
+
+    monkeypatch.setattr(auth, "ACCESS_TOKEN_TTL", -1)
+    assert client.get("/entries/", headers=_login(client, "d@a.com")).status_code == 401
+
+
+def test_verified_tokens_are_cached(client, fast_hash, monkeypatch):
+    headers = _login(client, "e@a.com")
+    calls = []
+    decode = auth.jwt.decode
+    monkeypatch.setattr(auth.jwt, "decode", lambda *a, **kw: calls.append(1) or decode(*a, **kw))
+    for _ in range(3):
+        assert client.get("/entries/", headers=headers).status_code == 200
+    assert len(calls) == 1
+
+
+def test_auth_required(client, monkeypatch):
+    monkeypatch.setattr(auth, "AUTH_REQUIRED", True)
+    assert client.get("/entries/").status_code == 401
@@ -0,0 +1,51 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "benchmarks"))
+
+import bench  # noqa: E402
+
+
+def _result(p95, rps, error_rate=0.0, rate_limited=0):
+    return {
+        "results": {
+            "stats": {
+                "p95_ms": p95,
+                "throughput_rps": rps,
+                "error_rate": error_rate,
+                "rate_limited": rate_limited,
+            }
+        }
+    }
+
+
+def test_percentile_interpolates():
+    values = [1.0, 2.0, 3.0, 4.0]
+    assert bench.percentile(values, 50) == 2.5
+    assert bench.percentile(values, 100) == 4.0
+    assert bench.percentile([], 95) == 0.0
+
+
+def test_summarize_counts_errors():
+    summary = bench.summarize([0.01, 0.02], errors=2, elapsed=1.0)
+    assert summary["requests"] == 4
+    assert summary["error_rate"] == 0.5
+    assert summary["throughput_rps"] == 2.0
+
+
+def test_summarize_keeps_rate_limited_apart_from_errors():
+    summary = bench.summarize([0.01, 0.02], errors=0, elapsed=1.0, rate_limited=2)
+    assert summary["requests"] == 4
+    assert summary["errors"] == 0
+    assert summary["error_rate"] == 0.0
+    assert summary["rate_limited"] == 2
+
+
+def test_compare_flags_regressions():
+    baseline = _result(p95=100.0, rps=200.0)
+    assert bench.compare(baseline, _result(p95=105.0, rps=195.0), 0.10) == []
+    problems = bench.compare(baseline, _result(p95=130.0, rps=150.0, error_rate=0.05), 0.10)
+    assert len(problems) == 3
+    problems = bench.compare(baseline, _result(p95=100.0, rps=200.0, rate_limited=5), 0.10)
+    assert problems == ["stats: rate limited (429) 0 -> 5"]
+    assert bench.compare(baseline, {"results": {}}, 0.10) == ["stats: tidak ada di hasil baru"]